@@ -6,6 +6,7 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from django.contrib.auth.hashers import make_password
 from django.db import transaction
+from chat.presence import online_user_ids
 from .models import User, Interest, AlumniProfile, StudentProfile, FacultyProfile, RecruiterProfile, AdminProfile
 from .serializers import (
     UserSerializer, UserRegistrationSerializer, CustomTokenObtainPairSerializer,
@@ -171,7 +172,13 @@ def get_users_by_type(request, user_type):
     
     users = User.objects.filter(user_type=user_type, status='active')
     serializer = UserSerializer(users, many=True)
-    return Response(serializer.data)
+    data = serializer.data
+    
+    # One bulk presence lookup for the whole directory page
+    online = online_user_ids([user['id'] for user in data])
+    for user in data:
+        user['is_online'] = user['id'] in online
+    return Response(data)
 
 
 @api_view(['POST'])
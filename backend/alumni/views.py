@@ -2,6 +2,7 @@ from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
+from blobstore.variants import image_variants
 from .models import AlumniSpotlight, Club
 
 User = get_user_model()
@@ -13,7 +14,7 @@ def spotlight_list(request):
     """
     Get list of alumni spotlights
     """
-    spotlights = AlumniSpotlight.objects.filter(is_featured=True).order_by('-created_at')
+    spotlights = AlumniSpotlight.objects.filter(is_featured=True).select_related('alumni').order_by('-created_at')
     data = []
     for spotlight in spotlights:
         data.append({
@@ -23,7 +24,9 @@ def spotlight_list(request):
             'alumni_name': spotlight.alumni.get_full_name(),
             'alumni_position': spotlight.alumni.current_position,
             'alumni_company': spotlight.alumni.company,
+            'alumni_avatar': image_variants(spotlight.alumni.profile_picture, presets=['thumb']),
             'image_url': spotlight.image.url if spotlight.image else None,
+            'image_variants': image_variants(spotlight.image),
             'created_at': spotlight.created_at
         })
     return Response(data)
@@ -76,6 +79,8 @@ def clubs_list(request):
             'category': club.category,
             'member_count': club.members.count(),
             'is_member': request.user in club.members.all(),
+            'logo_url': club.logo.url if club.logo else None,
+            'logo_variants': image_variants(club.logo, presets=['thumb', 'small']),
             'created_at': club.created_at
         })
     return Response(data)
@@ -2,15 +2,21 @@
 ASGI config for alumni_backend project.
 """
 import os
-from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-import chat.routing
+from alumni_backend.executor import get_asgi_http_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alumni_backend.settings')
 
+# Sets Django up: the websocket stack below imports models
+http_application = get_asgi_http_application()
+
+from channels.auth import AuthMiddlewareStack  # noqa: E402
+import chat.routing  # noqa: E402
+from chat.lifespan import LifespanApplication  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": http_application,
+    "lifespan": LifespanApplication(),
     "websocket": AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
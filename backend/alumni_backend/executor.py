@@ -0,0 +1,113 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import close_old_connections, connections
+from prometheus_client import Gauge, Histogram
+
+QUEUE_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+QUEUE_WAIT = Histogram(
+    'db_executor_queue_wait_seconds', 'Time sync database units wait for an executor thread',
+    ['executor'], buckets=QUEUE_WAIT_BUCKETS
+)
+QUEUED = Gauge(
+    'db_executor_queued_units', 'Sync database units waiting for an executor thread',
+    ['executor'], multiprocess_mode='livesum'
+)
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+class DatabaseExecutor(ThreadPoolExecutor):
+    """
+    A sized thread pool for sync database work in the ASGI process.
+
+    Each thread keeps its own connections for `conn_max_age` seconds instead
+    of opening one per unit, with Django's health check before the first
+    query of every unit. Time spent waiting for a free thread is recorded in
+    db_executor_queue_wait_seconds.
+    """
+
+    def __init__(self, name, threads, conn_max_age):
+        super().__init__(
+            max_workers=threads, thread_name_prefix=f'{name}-db',
+            initializer=self._init_thread, initargs=(conn_max_age,)
+        )
+        self.name = name
+        self.queue_wait = QUEUE_WAIT.labels(name)
+        self.queued = QUEUED.labels(name)
+
+    @staticmethod
+    def _init_thread(conn_max_age):
+        # Connections are per thread, but share the DATABASES dict; give this thread's its own lifetime settings
+        for conn in connections.all():
+            conn.settings_dict = {**conn.settings_dict, 'CONN_MAX_AGE': conn_max_age, 'CONN_HEALTH_CHECKS': True}
+
+    def submit(self, fn, /, *args, **kwargs):
+        self.queued.inc()
+        return super().submit(self._run_unit, time.perf_counter(), fn, args, kwargs)
+
+    def _run_unit(self, queued_at, fn, args, kwargs):
+        self.queued.dec()
+        self.queue_wait.observe(time.perf_counter() - queued_at)
+        # Drops connections past their age or left unusable, and arms the health check for this unit
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+
+def get_executor(name, threads):
+    """
+    The process-wide executor `name`, created with `threads` threads on first use; None when threads is 0
+    """
+    if not threads:
+        return None
+    executor = _executors.get(name)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                executor = _executors[name] = DatabaseExecutor(
+                    name, threads, getattr(settings, 'DB_EXECUTOR_CONN_MAX_AGE', 600)
+                )
+    return executor
+
+
+class ExecutorASGIHandler(ASGIHandler):
+    """
+    ASGI handler running each request's middleware and view as one unit on a DatabaseExecutor.
+
+    Django's handler adapts every sync middleware and the view separately,
+    each a hop to a thread started for that request, whose connection is
+    opened and closed with it.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        super().__init__()
+
+    def load_middleware(self, is_async=False):
+        # The whole chain runs synchronously on an executor thread
+        super().load_middleware(is_async=False)
+
+    async def get_response_async(self, request):
+        return await sync_to_async(self.get_response, thread_sensitive=False, executor=self.executor)(request)
+
+
+def get_asgi_http_application():
+    """
+    Django's ASGI application, running requests on the 'http' executor when ASGI_HTTP_THREADS is set
+    """
+    django.setup(set_prefix=False)
+    executor = get_executor('http', getattr(settings, 'ASGI_HTTP_THREADS', 0))
+    if executor is None:
+        return ASGIHandler()
+    return ExecutorASGIHandler(executor)
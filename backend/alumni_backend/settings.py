@@ -39,6 +39,7 @@ LOCAL_APPS = [
     'mentorship',
     'crowdfunding',
     'chat',
+    'blobstore',
 ]
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
@@ -83,6 +84,12 @@ DATABASES = {
     }
 }
 
+# Sync database work under ASGI (alumni_backend/executor.py). Threads (and database connections) per process
+# that run each HTTP request's middleware and view in one hop; 0 keeps Django's new thread per request
+ASGI_HTTP_THREADS = config('ASGI_HTTP_THREADS', default=0, cast=int)
+# Seconds executor threads keep their database connections, health-checked before each reuse
+DB_EXECUTOR_CONN_MAX_AGE = config('DB_EXECUTOR_CONN_MAX_AGE', default=600, cast=int)
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -203,19 +210,119 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Spread channel-layer traffic over several Redis hosts by consistent hashing
+# (see chat/layers.py). While adding or removing hosts, set
+# CHANNEL_REDIS_PREVIOUS_SHARDS to the old list until
+# `manage.py rebalance_channel_layer` has run.
+CHANNEL_REDIS_SHARDS = config('CHANNEL_REDIS_SHARDS', default='', cast=lambda v: [s.strip() for s in v.split(',') if s.strip()])
+CHANNEL_REDIS_PREVIOUS_SHARDS = config('CHANNEL_REDIS_PREVIOUS_SHARDS', default='', cast=lambda v: [s.strip() for s in v.split(',') if s.strip()])
+if CHANNEL_REDIS_SHARDS:
+    CHANNEL_LAYERS['default'] = {
+        'BACKEND': 'chat.layers.ShardedRedisChannelLayer',
+        'CONFIG': {
+            'hosts': CHANNEL_REDIS_SHARDS,
+            'previous_hosts': CHANNEL_REDIS_PREVIOUS_SHARDS or None,
+        },
+    }
+
+# Chat Configuration
+CHAT_AUTH_CACHE_TTL = config('CHAT_AUTH_CACHE_TTL', default=300, cast=int)
+CHAT_AUTH_CACHE_MAX_ENTRIES = config('CHAT_AUTH_CACHE_MAX_ENTRIES', default=10000, cast=int)
+# Write-behind persistence for chat messages (see chat/writebehind.py)
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=200, cast=int)
+CHAT_WRITE_BEHIND_INTERVAL = config('CHAT_WRITE_BEHIND_INTERVAL', default=0.05, cast=float)
+CHAT_WRITE_BEHIND_SEQ_BLOCK = config('CHAT_WRITE_BEHIND_SEQ_BLOCK', default=100, cast=int)
+CHAT_WORKER_ID = config('CHAT_WORKER_ID', default=None)
+# Batched ActivityLog inserts from the chat consumer
+CHAT_ACTIVITY_BATCH_SIZE = config('CHAT_ACTIVITY_BATCH_SIZE', default=100, cast=int)
+CHAT_ACTIVITY_FLUSH_INTERVAL = config('CHAT_ACTIVITY_FLUSH_INTERVAL', default=1.0, cast=float)
+# Ephemeral typing indicators: expiry, broadcast coalescing and optional DB persistence
+CHAT_TYPING_TTL = config('CHAT_TYPING_TTL', default=6.0, cast=float)
+CHAT_TYPING_INTERVAL = config('CHAT_TYPING_INTERVAL', default=2.0, cast=float)
+CHAT_TYPING_PERSIST = config('CHAT_TYPING_PERSIST', default=False, cast=bool)
+# Presence: shared Redis store for multi-node deployments, in-process otherwise
+CHAT_PRESENCE_REDIS_URL = config('CHAT_PRESENCE_REDIS_URL', default='')
+CHAT_PRESENCE_TTL = config('CHAT_PRESENCE_TTL', default=90, cast=int)
+CHAT_PRESENCE_HEARTBEAT = config('CHAT_PRESENCE_HEARTBEAT', default=30, cast=int)
+CHAT_PRESENCE_MAX_QUERY = config('CHAT_PRESENCE_MAX_QUERY', default=1000, cast=int)
+# Keyset-paginated message history (GET /api/chat/rooms/<id>/history/)
+CHAT_HISTORY_PAGE_SIZE = config('CHAT_HISTORY_PAGE_SIZE', default=50, cast=int)
+CHAT_HISTORY_MAX_PAGE_SIZE = config('CHAT_HISTORY_MAX_PAGE_SIZE', default=200, cast=int)
+# Reconnect catch-up over the WebSocket 'sync' frame
+CHAT_SYNC_MAX_ROOMS = config('CHAT_SYNC_MAX_ROOMS', default=200, cast=int)
+CHAT_SYNC_ROOM_LIMIT = config('CHAT_SYNC_ROOM_LIMIT', default=200, cast=int)
+CHAT_SYNC_BATCH_SIZE = config('CHAT_SYNC_BATCH_SIZE', default=50, cast=int)
+# Per-connection outbound queue; connections over the cap for the grace period are closed with 4008
+CHAT_OUTBOUND_MAX_MESSAGES = config('CHAT_OUTBOUND_MAX_MESSAGES', default=200, cast=int)
+CHAT_OUTBOUND_MAX_BYTES = config('CHAT_OUTBOUND_MAX_BYTES', default=1048576, cast=int)
+CHAT_OUTBOUND_OVERFLOW_GRACE = config('CHAT_OUTBOUND_OVERFLOW_GRACE', default=10.0, cast=float)
+# Offer the compact 'chat.msgpack.v1' WebSocket subprotocol. Off by default: while on, every
+# broadcast is encoded twice, as JSON and as MessagePack, whether or not a client negotiated it
+CHAT_WIRE_MSGPACK = config('CHAT_WIRE_MSGPACK', default=False, cast=bool)
+# Operations allowed in one WebSocket 'batch' frame
+CHAT_BATCH_MAX_OPS = config('CHAT_BATCH_MAX_OPS', default=100, cast=int)
+# Token-bucket limits on client frames: (burst, refill per second) per connection and per user.
+# Per-user buckets are shared through CHAT_RATE_LIMIT_REDIS_URL when set, in-process otherwise
+CHAT_RATE_LIMIT_ENABLED = config('CHAT_RATE_LIMIT_ENABLED', default=True, cast=bool)
+CHAT_RATE_LIMIT_REDIS_URL = config('CHAT_RATE_LIMIT_REDIS_URL', default='')
+CHAT_RATE_LIMITS = {
+    'message': {'connection': (20, 2.0), 'user': (30, 3.0)},
+    'meeting_request': {'connection': (5, 0.1), 'user': (5, 0.1)},
+    'meeting_approval': {'connection': (10, 0.5), 'user': (20, 1.0)},
+    'typing': {'connection': (20, 5.0)},
+    'read_receipt': {'connection': (100, 20.0)},
+    'read_up_to': {'connection': (100, 20.0)},
+    'presence': {'connection': (10, 1.0)},
+    'sync': {'connection': (5, 0.2)},
+    'batch': {'connection': (10, 1.0)},
+    '*': {'connection': (60, 10.0)},
+}
+# Bearer token for the Prometheus scrape endpoint (GET /api/chat/metrics/); the endpoint is off when unset.
+# With several daphne workers, also set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers
+CHAT_METRICS_TOKEN = config('CHAT_METRICS_TOKEN', default='')
+# Threads (and database connections) per process for the consumer's per-frame database work.
+# 0 runs it on Django's single thread-sensitive thread, which SQLite and test transactions need
+CHAT_DB_THREADS = config('CHAT_DB_THREADS', default=0, cast=int)
+# Age after which archive_chat_messages moves messages from chat_messages to chat_message_archive
+CHAT_ARCHIVE_AFTER_DAYS = config('CHAT_ARCHIVE_AFTER_DAYS', default=180, cast=int)
+CHAT_ARCHIVE_BATCH_SIZE = config('CHAT_ARCHIVE_BATCH_SIZE', default=1000, cast=int)
+
 # AWS S3 Configuration (for production file storage)
 AWS_ACCESS_KEY_ID = config('AWS_ACCESS_KEY_ID', default='')
 AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY', default='')
 AWS_STORAGE_BUCKET_NAME = config('AWS_STORAGE_BUCKET_NAME', default='')
 AWS_S3_REGION_NAME = config('AWS_S3_REGION_NAME', default='us-east-1')
-AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
+# An S3-compatible server such as MinIO instead of AWS; URLs then point at the endpoint
+AWS_S3_ENDPOINT_URL = config('AWS_S3_ENDPOINT_URL', default=None)
+AWS_S3_CUSTOM_DOMAIN = None if AWS_S3_ENDPOINT_URL else f'{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
+AWS_S3_ADDRESSING_STYLE = 'path' if AWS_S3_ENDPOINT_URL else None
 AWS_DEFAULT_ACL = None
 AWS_S3_OBJECT_PARAMETERS = {
     'CacheControl': 'max-age=86400',
 }
 
 # File storage configuration
-# For production, configure S3 storage separately
+# Uploads are stored once per content digest under blobs/ and reference-counted (blobstore app).
+# MEDIA_BLOB_BACKEND is 'local' (MEDIA_ROOT) or 's3' (the AWS_* settings above)
+MEDIA_BLOB_BACKEND = config('MEDIA_BLOB_BACKEND', default='local')
+# Hours an unreferenced blob is kept before collect_media_blobs deletes it
+MEDIA_BLOB_GRACE_HOURS = config('MEDIA_BLOB_GRACE_HOURS', default=24, cast=int)
+STORAGES = {
+    'default': {'BACKEND': 'blobstore.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# Derived image sizes, name -> (width, height, crop), each stored in every IMAGE_VARIANT_FORMATS;
+# a size added here is rendered for existing images the first time its URL is requested
+IMAGE_VARIANTS = {
+    'thumb': (96, 96, True),
+    'small': (320, 320, False),
+    'medium': (960, 960, False),
+}
+IMAGE_VARIANT_FORMATS = ['webp', 'jpeg']
+# Processes rendering variants after each image upload; 0 renders in a thread of the server process
+IMAGE_VARIANT_WORKERS = config('IMAGE_VARIANT_WORKERS', default=2, cast=int)
 
 # Stripe Configuration
 STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY', default='')
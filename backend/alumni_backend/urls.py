@@ -14,7 +14,8 @@ urlpatterns = [
     # path('api/events/', include('events.urls')),
     # path('api/mentorship/', include('mentorship.urls')),
     # path('api/crowdfunding/', include('crowdfunding.urls')),
-    # path('api/chat/', include('chat.urls')),
+    path('api/chat/', include('chat.urls')),
+    path('api/media/', include('blobstore.urls')),
 ]
 
 # Serve media files in development
@@ -0,0 +1,236 @@
+"""
+Chat frame latency under concurrent REST load, with and without the database executors.
+
+REST clients fetch 100-message history pages of a room while chat pairs
+exchange message frames and a sync client replays the same room (a slow
+frame), each at a fixed rate. Chat latency is send to echo for a message
+frame.
+
+By default Django's ASGI handler starts a thread per request and adapts
+each sync middleware and the view as a separate hop, and every chat frame's
+database unit queues on the one thread-sensitive thread, behind the slow
+sync frames. With ASGI_HTTP_THREADS and CHAT_DB_THREADS, requests run in one
+hop on a sized pool and chat units on a pool of their own, so a slow unit
+holds one thread instead of the queue.
+
+    python -m benchmarks.asgi_mixed_load [--rest-clients 4] [--chat-pairs 8] [--db-latency 5]
+
+The database is a SQLite file in WAL mode, which lets the pool threads read
+concurrently; writers still take turns. In-process SQLite has no round
+trips, so --db-latency adds a sleep to every query in their place: the time
+a thread spends waiting on a database server is what the pools overlap.
+With --db-latency 0 on a single core they can only reorder CPU work.
+"""
+import argparse
+import asyncio
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.common import create_users, setup_django, summarize, teardown_django
+
+HOST = (b'host', b'testserver')
+
+
+async def paced(rate, deadline):
+    """
+    Yield at `rate` per second until `deadline`, without catching up on a slow response
+    """
+    interval = 1 / rate
+    next_at = time.perf_counter()
+    while next_at < deadline:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        yield
+        next_at = max(next_at + interval, time.perf_counter())
+
+
+async def rest_client(application, path, token, rate, deadline, latencies):
+    from channels.testing import HttpCommunicator
+
+    headers = [HOST, (b'authorization', f'Bearer {token}'.encode())]
+    async for _ in paced(rate, deadline):
+        started = time.perf_counter()
+        response = await HttpCommunicator(application, 'GET', path, headers=headers).get_response(timeout=60)
+        assert response['status'] == 200, response['status']
+        latencies.append(time.perf_counter() - started)
+
+
+async def receive_type(communicator, frame_type):
+    while True:
+        frame = await communicator.receive_json_from(timeout=60)
+        if frame['type'] == frame_type:
+            return frame
+
+
+async def chat_client(sender, recipient_id, rate, deadline, latencies):
+    i = 0
+    async for _ in paced(rate, deadline):
+        started = time.perf_counter()
+        await sender.send_json_to({'type': 'message', 'to_user': recipient_id, 'content': f'Message {i}'})
+        await receive_type(sender, 'message')
+        latencies.append(time.perf_counter() - started)
+        i += 1
+
+
+async def sync_client(communicator, room_id, rate, deadline, latencies):
+    async for _ in paced(rate, deadline):
+        started = time.perf_counter()
+        await communicator.send_json_to({'type': 'sync', 'rooms': {str(room_id): 0}})
+        await receive_type(communicator, 'sync_complete')
+        latencies.append(time.perf_counter() - started)
+
+
+async def drain(communicator):
+    # Recipients' inbound frames are not measured; keep their queues empty
+    try:
+        while True:
+            await communicator.receive_output(timeout=60)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        pass
+
+
+async def run_scenario(http_application, rest_path, rest_users, chat_pairs, sync_users, room_id, rates, duration):
+    from channels.testing import WebsocketCommunicator
+    from chat.consumers import ChatConsumer
+
+    def connect(token):
+        return WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={token}")
+
+    senders = []
+    recipients = []
+    for (_, sender_token), (recipient, recipient_token) in chat_pairs:
+        sender, receiver = connect(sender_token), connect(recipient_token)
+        await sender.connect()
+        await receiver.connect()
+        senders.append((sender, recipient.id))
+        recipients.append(receiver)
+    syncers = []
+    for _, token in sync_users:
+        communicator = connect(token)
+        await communicator.connect()
+        syncers.append(communicator)
+    drains = [asyncio.ensure_future(drain(receiver)) for receiver in recipients]
+
+    rest, chat, sync = [], [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *(rest_client(http_application, rest_path, token, rates['rest'], deadline, rest) for _, token in rest_users),
+        *(chat_client(sender, recipient_id, rates['chat'], deadline, chat) for sender, recipient_id in senders),
+        *(sync_client(communicator, room_id, rates['sync'], deadline, sync) for communicator in syncers),
+    )
+
+    for task in drains:
+        task.cancel()
+    for communicator in [sender for sender, _ in senders] + recipients + syncers:
+        await communicator.disconnect()
+    return rest, chat, sync
+
+
+def add_query_latency(seconds):
+    """
+    Sleep before every query, standing in for the round trip to a database server
+    """
+    from django.db.backends.utils import CursorWrapper
+
+    def delayed(method):
+        def wrapper(self, *args, **kwargs):
+            time.sleep(seconds)
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    CursorWrapper.execute = delayed(CursorWrapper.execute)
+    CursorWrapper.executemany = delayed(CursorWrapper.executemany)
+
+
+def queue_wait(name):
+    from prometheus_client import REGISTRY
+
+    labels = {'executor': name}
+    count = REGISTRY.get_sample_value('db_executor_queue_wait_seconds_count', labels) or 0
+    total = REGISTRY.get_sample_value('db_executor_queue_wait_seconds_sum', labels) or 0.0
+    return count, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rest-clients', type=int, default=4)
+    parser.add_argument('--chat-pairs', type=int, default=8)
+    parser.add_argument('--sync-clients', type=int, default=1)
+    parser.add_argument('--room-messages', type=int, default=300,
+                        help='Messages in the room the REST clients page through and the sync clients replay')
+    parser.add_argument('--rest-rate', type=float, default=1.0, help='Requests per second per REST client')
+    parser.add_argument('--chat-rate', type=float, default=2.0, help='Message frames per second per chat pair')
+    parser.add_argument('--sync-rate', type=float, default=1.0, help='Sync frames per second per sync client')
+    parser.add_argument('--http-threads', type=int, default=8)
+    parser.add_argument('--chat-threads', type=int, default=4)
+    parser.add_argument('--db-latency', type=float, default=5.0, help='Milliseconds added to every query')
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    directory = Path(tempfile.mkdtemp(prefix='asgi-mixed-load-'))
+    setup_django(test_database=directory / 'bench.sqlite3')
+    try:
+        from django.conf import settings
+        from django.db import connection
+        from django.core.handlers.asgi import ASGIHandler
+        from alumni_backend.executor import ExecutorASGIHandler, get_executor
+        from chat.models import ChatRoom, ChatMessage
+
+        users = create_users(args.rest_clients + 2 * args.chat_pairs + args.sync_clients + 1, prefix='mixed')
+        owner = users[0][0]
+        readers = users[1:1 + args.rest_clients + args.sync_clients]
+        chat_users = users[1 + args.rest_clients + args.sync_clients:]
+        room = ChatRoom.objects.create(room_type='group', name='Mixed load', created_by=owner)
+        room.participants.add(owner, *(user for user, _ in readers))
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room=room, sender=owner, content=f'History message {i}', seq=i + 1)
+            for i in range(args.room_messages)
+        ])
+        ChatRoom.objects.filter(id=room.id).update(last_seq=args.room_messages)
+        rest_path = f'/api/chat/rooms/{room.id}/history/?limit=100'
+        rest_users = readers[:args.rest_clients]
+        sync_users = readers[args.rest_clients:]
+        chat_pairs = list(zip(chat_users[0::2], chat_users[1::2]))
+        add_query_latency(args.db_latency / 1000)
+        rates = {'rest': args.rest_rate, 'chat': args.chat_rate, 'sync': args.sync_rate}
+
+        scenarios = [
+            ('default', 0, 0),
+            (f'executors ({args.http_threads} http, {args.chat_threads} chat)', args.http_threads, args.chat_threads),
+        ]
+        print(f"{connection.vendor}: {args.rest_clients} REST clients on {args.room_messages} messages, "
+              f"{args.chat_pairs} chat pairs, {args.sync_clients} sync clients, {args.duration:.0f}s each")
+        print()
+        print(f"{'':<32}{'chat p50':>10}{'p95':>9}{'p99':>9}{'rest p50':>10}{'p95':>9}{'sync p50':>10}"
+              f"{'http wait':>11}{'chat wait':>11}  (ms)")
+        for name, http_threads, chat_threads in scenarios:
+            settings.CHAT_DB_THREADS = chat_threads
+            if http_threads:
+                http_application = ExecutorASGIHandler(get_executor('http', http_threads))
+            else:
+                http_application = ASGIHandler()
+            waits_before = {executor: queue_wait(executor) for executor in ('http', 'chat')}
+            rest, chat, sync = asyncio.run(run_scenario(
+                http_application, rest_path, rest_users, chat_pairs, sync_users, room.id, rates, args.duration
+            ))
+            waits = []
+            for executor in ('http', 'chat'):
+                count, total = queue_wait(executor)
+                count -= waits_before[executor][0]
+                waits.append((total - waits_before[executor][1]) / count * 1000 if count else float('nan'))
+            chat_stats, rest_stats, sync_stats = summarize(chat), summarize(rest), summarize(sync)
+            print(f"{name:<32}{chat_stats['p50'] * 1000:>10.1f}{chat_stats['p95'] * 1000:>9.1f}"
+                  f"{chat_stats['p99'] * 1000:>9.1f}{rest_stats['p50'] * 1000:>10.1f}{rest_stats['p95'] * 1000:>9.1f}"
+                  f"{sync_stats['p50'] * 1000:>10.1f}{waits[0]:>11.2f}{waits[1]:>11.2f}")
+        print()
+        print("wait: mean time a unit queued for an executor thread (none without the executors)")
+    finally:
+        teardown_django()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
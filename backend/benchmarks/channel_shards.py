@@ -0,0 +1,159 @@
+"""
+group_send throughput of the sharded channel layer as shards are added.
+
+By default each shard is an in-process fakeredis server that executes one
+command at a time, each taking --service-us microseconds, like a
+single-threaded Redis. Receiving channels belong to --nodes simulated daphne
+processes; channels_redis keeps each process's channel queue under one key.
+
+Two throughputs are reported:
+- "measured" is wall-clock throughput of this single process. The
+  fakeredis stand-ins run in the same process, so it is capped by this
+  process's CPU.
+- "shard-bound" is the ceiling set by the busiest shard: sends divided by
+  that shard's command count times the service time. This is what adding
+  shards raises.
+
+Pass --redis-urls to measure against real servers instead, e.g. several
+local redis-server processes on different ports.
+
+Also reports how many groups change shard when one shard is added, for the
+ring and for channels_redis' built-in modulo placement.
+
+    python -m benchmarks.channel_shards [--shards 1,2,4,8] [--sends 2000] [--service-us 100] [--nodes 16]
+    python -m benchmarks.channel_shards --redis-urls redis://localhost:6379,redis://localhost:6380
+"""
+import argparse
+import asyncio
+import random
+import uuid
+
+from benchmarks.common import Timer
+
+
+def build_modelled_connection_class():
+    from fakeredis.aioredis import FakeAsyncRedisConnection
+
+    class ModelledShardConnection(FakeAsyncRedisConnection):
+        """
+        fakeredis connection whose server runs one command at a time with a fixed service time
+        """
+
+        def __init__(self, *args, service_time=0.0, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.service_time = service_time
+
+        async def read_response(self, **kwargs):
+            server = self._server
+            if not hasattr(server, 'bench_lock'):
+                server.bench_lock = asyncio.Lock()
+                server.bench_commands = 0
+            async with server.bench_lock:
+                server.bench_commands += 1
+                await asyncio.sleep(self.service_time)
+            return await super().read_response(**kwargs)
+
+    return ModelledShardConnection
+
+
+def modelled_hosts(count, service_time):
+    import fakeredis
+
+    connection_class = build_modelled_connection_class()
+    servers = [fakeredis.FakeServer() for _ in range(count)]
+    hosts = [
+        {'connection_class': connection_class, 'server': server, 'service_time': service_time}
+        for server in servers
+    ]
+    return hosts, servers
+
+
+async def run_scenario(hosts, servers, groups, sends, concurrency, nodes):
+    from chat.layers import ShardedRedisChannelLayer
+
+    layer = ShardedRedisChannelLayer(hosts=hosts, capacity=10 ** 9)
+    node_prefixes = [uuid.uuid4().hex for _ in range(nodes)]
+    group_names = [f"user_{i}" for i in range(groups)]
+    for i, group in enumerate(group_names):
+        channel = f"specific.{node_prefixes[i % nodes]}!{uuid.uuid4().hex}"
+        await layer.group_add(group, channel)
+    for server in servers:
+        server.bench_commands = 0
+
+    message = {'type': 'chat.frame', 'text': 'x' * 200}
+    remaining = iter(range(sends))
+
+    async def sender():
+        for _ in remaining:
+            await layer.group_send(random.choice(group_names), message)
+
+    with Timer() as timer:
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+    commands = [server.bench_commands for server in servers]
+    await layer.flush()
+    return timer, commands
+
+
+def moved_share(groups, shards):
+    from channels_redis.utils import _consistent_hash
+    from chat.layers import HashRing
+
+    names = [f"user_{i}" for i in range(groups)]
+    before = HashRing(enumerate(f"shard{i}" for i in range(shards)))
+    after = HashRing(enumerate(f"shard{i}" for i in range(shards + 1)))
+    ring = sum(1 for name in names if before.get_index(name) != after.get_index(name)) / groups
+    modulo = sum(1 for name in names if _consistent_hash(name, shards) != _consistent_hash(name, shards + 1)) / groups
+    return ring, modulo
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shards', default='1,2,4,8')
+    parser.add_argument('--groups', type=int, default=2000)
+    parser.add_argument('--sends', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--service-us', type=float, default=100.0)
+    parser.add_argument('--nodes', type=int, default=16)
+    parser.add_argument('--redis-urls', default='')
+    args = parser.parse_args()
+
+    shard_counts = [int(count) for count in args.shards.split(',')]
+    redis_urls = [url for url in args.redis_urls.split(',') if url]
+    if redis_urls:
+        shard_counts = [count for count in shard_counts if count <= len(redis_urls)]
+        print(f"real Redis servers: {', '.join(redis_urls)}")
+    else:
+        print(f"modelled shards, {args.service_us:.0f} us per command")
+    print(f"{args.sends} group_sends to {args.groups} groups on {args.nodes} nodes, "
+          f"{args.concurrency} concurrent senders")
+    print(f"{'shards':>6}{'measured/s':>12}{'busiest shard':>15}{'shard-bound/s':>15}{'speedup':>9}")
+
+    baseline = None
+    for count in shard_counts:
+        servers = []
+        if redis_urls:
+            hosts = redis_urls[:count]
+        else:
+            hosts, servers = modelled_hosts(count, args.service_us / 1e6)
+        timer, commands = asyncio.run(
+            run_scenario(hosts, servers, args.groups, args.sends, args.concurrency, args.nodes)
+        )
+        measured = args.sends / timer.wall
+        if servers:
+            busiest = f"{max(commands) / sum(commands) * 100:.1f}%"
+            bound = args.sends / (max(commands) * args.service_us / 1e6)
+        else:
+            busiest, bound = '-', measured
+        baseline = baseline or bound
+        print(f"{count:>6}{measured:>12.0f}{busiest:>15}{bound:>15.0f}{bound / baseline:>8.2f}x")
+
+    print()
+    print(f"{'shards':>6}{'moved by ring':>15}{'moved by modulo':>17}   (adding one shard)")
+    for count in shard_counts:
+        ring, modulo = moved_share(args.groups, count)
+        print(f"{count:>3}->{count + 1:<2}{ring * 100:>14.1f}%{modulo * 100:>16.1f}%")
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    main()
@@ -0,0 +1,163 @@
+"""
+Table size and read latency before and after archiving cold chat messages.
+
+Seeds --messages messages sent evenly over --days days, with every room's
+read cursors a few messages behind the newest. It then measures
+chat_messages' size (table and indexes) and the latency of the reads that
+touch it:
+
+- the room list's unread counts
+- the newest history page and a page --deep-days back
+- reconnect sync
+- search
+
+It then runs the archive mover for --older-than-days and measures
+everything again, including the mover's throughput. With the defaults a
+room keeps about 25 of its 100 messages live, so the newest page of 50 also
+reads the archive, for only the rows the live table could not fill.
+
+    python -m benchmarks.chat_archive [--messages 500000] [--days 730] [--older-than-days 180]
+
+Sizes come from SQLite's dbstat (after VACUUM, which on PostgreSQL would be
+VACUUM FULL or pg_repack) or pg_total_relation_size.
+"""
+import argparse
+import random
+
+from benchmarks.chat_search import seed
+from benchmarks.common import Timer, setup_django, summarize, teardown_django
+
+
+def table_bytes(table):
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+        else:
+            cursor.execute(
+                "SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = %s)", [table]
+            )
+        return cursor.fetchone()[0]
+
+
+def vacuum():
+    from django.db import connection
+
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
+
+
+def measure(user, deep_days, runs):
+    from datetime import timedelta
+    from django.utils import timezone
+    from chat.history import encode_cursor, history_page, missed_messages
+    from chat.models import ChatRoom, ChatMessage, ArchivedMessage
+    from chat.search import search_messages
+
+    rooms = list(ChatRoom.objects.filter(participants=user))
+    room = rooms[0]
+    deep = (
+        ChatMessage.objects.filter(room=room, created_at__lt=timezone.now() - timedelta(days=deep_days))
+        .order_by('-created_at').first()
+    ) or (
+        ArchivedMessage.objects.filter(room=room, created_at__lt=timezone.now() - timedelta(days=deep_days))
+        .order_by('-created_at').first()
+    )
+    deep_cursor = encode_cursor(deep)
+    sync_seqs = {r.id: max(r.last_seq - 10, 0) for r in rooms}
+
+    reads = {
+        'room list unread counts': lambda: list(
+            ChatRoom.with_unread_counts(ChatRoom.objects.filter(participants=user), user.id)
+        ),
+        'newest history page': lambda: history_page(room.id, limit=50, archived_until=room.archived_until),
+        f'history {deep_days} days back': lambda: history_page(
+            room.id, before=deep_cursor, limit=50, archived_until=room.archived_until
+        ),
+        'reconnect sync': lambda: missed_messages(user.id, sync_seqs, 200),
+        'search': lambda: search_messages(user.id, 'placement', limit=20),
+    }
+    results = {}
+    for name, read in reads.items():
+        samples = []
+        for _ in range(runs):
+            with Timer() as timer:
+                read()
+            samples.append(timer.wall)
+        results[name] = summarize(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=500000)
+    parser.add_argument('--rooms', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--older-than-days', type=int, default=180)
+    parser.add_argument('--deep-days', type=int, default=365)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    try:
+        from django.db import connection
+        from django.db.models import F
+        from chat.archive import archive_batch, archive_cutoff, optimize_search_index
+        from chat.models import ChatRoom, ChatMessage, ArchivedMessage, RoomReadCursor
+
+        random.seed(0)
+        user = seed(args.messages, args.rooms, args.users, days=args.days)
+        # Readers are a few messages behind, as in an active deployment
+        RoomReadCursor.objects.bulk_create([
+            RoomReadCursor(room_id=room_id, user_id=user_id, last_read_seq=max(last_seq - 3, 0))
+            for room_id, user_id, last_seq in
+            ChatRoom.participants.through.objects.annotate(last_seq=F('chatroom__last_seq'))
+            .values_list('chatroom_id', 'user_id', 'last_seq')
+        ], ignore_conflicts=True)
+        vacuum()
+
+        live = ChatMessage._meta.db_table
+        archive = ArchivedMessage._meta.db_table
+        before = measure(user, args.deep_days, args.runs)
+        size_before = table_bytes(live), ChatMessage.objects.count()
+
+        moved = 0
+        last_id = 0
+        cutoff = archive_cutoff(args.older_than_days)
+        with Timer() as timer:
+            while True:
+                count, last_id = archive_batch(cutoff, after_id=last_id, batch_size=args.batch_size)
+                if not count:
+                    break
+                moved += count
+            optimize_search_index()
+        mover_seconds = timer.wall
+        size_after_move = table_bytes(live)
+        vacuum()
+        size_after = table_bytes(live), ChatMessage.objects.count()
+        after = measure(user, args.deep_days, args.runs)
+
+        mb = 1024 * 1024
+        print(f"{connection.vendor}: {args.messages} messages over {args.days} days in {args.rooms} rooms")
+        print(f"Archived {moved} messages older than {args.older_than_days} days in {mover_seconds:.1f}s "
+              f"({moved / mover_seconds:.0f} messages/s, batches of {args.batch_size})")
+        print()
+        print(f"{live}: {size_before[1]} rows, {size_before[0] / mb:.1f} MB -> {size_after[1]} rows, "
+              f"{size_after[0] / mb:.1f} MB ({size_after_move / mb:.1f} MB before VACUUM)")
+        print(f"{archive}: {ArchivedMessage.objects.count()} rows, {table_bytes(archive) / mb:.1f} MB")
+        print()
+        print(f"{'read':<28}{'before p50':>12}{'p95':>9}{'after p50':>12}{'p95':>9}  (ms)")
+        for name in before:
+            print(f"{name:<28}{before[name]['p50'] * 1000:>12.2f}{before[name]['p95'] * 1000:>9.2f}"
+                  f"{after[name]['p50'] * 1000:>12.2f}{after[name]['p95'] * 1000:>9.2f}")
+    finally:
+        teardown_django()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Per-message CPU of the chat fan-out pipeline.
+
+Replays the 50-message scenario from tests/test_websocket.py
+(WebSocketPerformanceTests.test_message_throughput) through the current
+encode-once broadcast and through the previous pipeline, which serialized the
+message once per recipient group over a database_sync_to_async hop and
+re-encoded it with json.dumps in every receiving consumer.
+
+    python -m benchmarks.chat_broadcast [--messages 50] [--rounds 5]
+"""
+import argparse
+import asyncio
+
+from benchmarks.common import Timer, create_users, setup_django, teardown_django
+
+
+def build_legacy_consumer():
+    from channels.db import database_sync_to_async
+    from chat.consumers import ChatConsumer
+
+    @database_sync_to_async
+    def legacy_serialize(message):
+        return {
+            'id': message.id,
+            'sender': {
+                'id': message.sender.id,
+                'name': message.sender.get_full_name(),
+                'email': message.sender.email
+            },
+            'content': message.content,
+            'message_type': message.message_type,
+            'created_at': message.created_at.isoformat(),
+            'meeting_data': None
+        }
+
+    class LegacyFanoutConsumer(ChatConsumer):
+        async def handle_message(self, data):
+            to_user_id = data.get('to_user')
+            room_id = await self.get_or_create_room(to_user_id)
+            message, _ = await self.create_message(room_id, data.get('content', ''))
+            for user_id in (to_user_id, self.user_id):
+                await self.channel_layer.group_send(
+                    f"user_{user_id}",
+                    {'type': 'chat_message', 'message': await legacy_serialize(message)}
+                )
+            await self.update_user_streak()
+
+    return LegacyFanoutConsumer
+
+
+async def run_scenario(consumer_class, sender, recipient, messages):
+    from channels.testing import WebsocketCommunicator
+
+    (_, sender_token), (recipient_user, recipient_token) = sender, recipient
+    communicator1 = WebsocketCommunicator(consumer_class.as_asgi(), f"/ws/chat/?token={sender_token}")
+    communicator2 = WebsocketCommunicator(consumer_class.as_asgi(), f"/ws/chat/?token={recipient_token}")
+    await communicator1.connect()
+    await communicator2.connect()
+
+    with Timer() as timer:
+        for i in range(messages):
+            await communicator1.send_json_to({
+                'type': 'message',
+                'to_user': recipient_user.id,
+                'content': f'Message {i}'
+            })
+        for i in range(messages):
+            await communicator2.receive_json_from(timeout=5)
+            await communicator1.receive_json_from(timeout=5)
+
+    await communicator1.disconnect()
+    await communicator2.disconnect()
+    return timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+    try:
+        from chat.consumers import ChatConsumer
+
+        sender, recipient = create_users(2)
+        pipelines = [('legacy per-recipient', build_legacy_consumer()), ('encode-once', ChatConsumer)]
+        results = {}
+        for name, consumer_class in pipelines:
+            # Warm up caches and the thread executor before measuring
+            asyncio.run(run_scenario(consumer_class, sender, recipient, 5))
+            cpu = wall = 0.0
+            for _ in range(args.rounds):
+                timer = asyncio.run(run_scenario(consumer_class, sender, recipient, args.messages))
+                cpu += timer.cpu
+                wall += timer.wall
+            total = args.rounds * args.messages
+            results[name] = (cpu / total * 1e6, wall / total * 1e6)
+
+        print(f"{args.messages} messages x {args.rounds} rounds")
+        print(f"{'pipeline':<24}{'cpu us/msg':>12}{'wall us/msg':>13}")
+        for name, (cpu, wall) in results.items():
+            print(f"{name:<24}{cpu:>12.1f}{wall:>13.1f}")
+        legacy_cpu = results['legacy per-recipient'][0]
+        saved = legacy_cpu - results['encode-once'][0]
+        print(f"CPU saved per message: {saved:.1f} us ({saved / legacy_cpu * 100:.1f}%)")
+    finally:
+        teardown_django()
+
+
+if __name__ == '__main__':
+    main()
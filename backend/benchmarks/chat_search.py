@@ -0,0 +1,158 @@
+"""
+Latency of chat full-text search on a large seeded history.
+
+Seeds --messages messages (1M by default) over --rooms direct rooms with
+Zipf-distributed vocabulary, then times GET /api/chat/search/-equivalent
+queries for one user through chat.search.search_messages: a rare word, a
+mid-frequency word, a very common word, a two-word query, a prefix and a
+second page. For reference, the unranked `content__icontains` scan over the
+user's rooms is timed on the same words: it stops at the newest --limit hits,
+so it is cheap for common words but cannot rank, stem or highlight.
+
+    python -m benchmarks.chat_search [--messages 1000000] [--rooms 5000] [--runs 50]
+
+Seeding 1M messages takes a few minutes and ~1 GB of memory on the
+in-memory SQLite test database.
+"""
+import argparse
+import random
+
+from benchmarks.common import Timer, create_users, setup_django, summarize, teardown_django
+
+VOCABULARY = (
+    "the you to and thanks hi meeting tomorrow call please when free week resume interview "
+    "internship referral alumni campus placement project deadline offer congrats career advice "
+    "batch mentor startup research thesis conference workshop scholarship portfolio networking "
+    "hackathon sponsorship fellowship"
+).split()
+# Zipf weights: the first words are far more common than the last
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+QUERIES = [
+    ('rare word', 'fellowship'),
+    ('mid-frequency word', 'placement'),
+    ('common word', 'meeting'),
+    ('two words', 'internship referral'),
+    ('prefix', 'schol'),
+]
+
+
+def seed(message_count, room_count, user_count, days=365):
+    """
+    Seed messages sent evenly over the last `days` days; returns the user in the most rooms
+    """
+    from django.db import transaction
+    from django.utils import timezone
+    from datetime import timedelta
+    from chat.models import ChatRoom, ChatMessage
+
+    users = [user for user, _ in create_users(user_count, prefix='search')]
+    pairs = []
+    for i in range(room_count):
+        # The first user is in every 100th room, like a well-connected alum
+        first = users[0] if i % 100 == 0 else users[1 + i % (user_count - 1)]
+        second = users[1 + (i * 7 + 3) % (user_count - 1)]
+        if second == first:
+            second = users[1 + (i * 7 + 4) % (user_count - 1)]
+        pairs.append((first, second))
+    rooms = ChatRoom.objects.bulk_create([
+        ChatRoom(room_type='direct', direct_key=f'seed:{i}', created_by=first)
+        for i, (first, _) in enumerate(pairs)
+    ])
+    Participant = ChatRoom.participants.through
+    Participant.objects.bulk_create([
+        Participant(chatroom_id=room.id, user_id=user.id)
+        for room, pair in zip(rooms, pairs) for user in pair
+    ])
+    members = {room.id: [first.id, second.id] for room, (first, second) in zip(rooms, pairs)}
+
+    started = timezone.now() - timedelta(days=days)
+    spacing = days * 86400 / message_count
+    seqs = dict.fromkeys(members, 0)
+    batch_size = 20000
+    room_ids = list(members)
+    for start in range(0, message_count, batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, message_count)):
+            room_id = room_ids[i % len(room_ids)]
+            seqs[room_id] += 1
+            batch.append(ChatMessage(
+                room_id=room_id,
+                sender_id=members[room_id][i % 2],
+                content=' '.join(random.choices(VOCABULARY, weights=WEIGHTS, k=random.randint(4, 18))),
+                seq=seqs[room_id],
+                created_at=started + timedelta(seconds=i * spacing)
+            ))
+        with transaction.atomic():
+            ChatMessage.objects.bulk_create(batch)
+        print(f"\rSeeded {min(start + batch_size, message_count)} messages", end='', flush=True)
+    print()
+    for room_id, seq in seqs.items():
+        ChatRoom.objects.filter(id=room_id).update(last_seq=seq)
+    return users[0]
+
+
+def naive_search(user_id, text, limit):
+    from chat.models import ChatMessage
+
+    messages = ChatMessage.objects.filter(room__participants=user_id)
+    for term in text.split():
+        messages = messages.filter(content__icontains=term)
+    return list(messages.order_by('-created_at', '-id').values_list('id', flat=True)[:limit])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--rooms', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--naive-runs', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    try:
+        from django.db import connection
+        from chat.models import ChatMessage
+        from chat.search import encode_search_cursor, search_messages
+
+        random.seed(0)
+        with Timer() as timer:
+            user = seed(args.messages, args.rooms, args.users)
+        visible = ChatMessage.objects.filter(room__participants=user).count()
+        print(f"{args.messages} messages in {args.rooms} rooms seeded in {timer.wall:.0f}s; "
+              f"the searching user sees {visible} of them ({connection.vendor})")
+        print()
+        print(f"{'query':<22}{'matches':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'icontains p50':>14}")
+
+        queries = QUERIES + [('second page', QUERIES[2][1])]
+        for name, text in queries:
+            after = None
+            if name == 'second page':
+                page, _ = search_messages(user.id, text, limit=args.limit)
+                after = encode_search_cursor(page[-1])
+            samples = []
+            for _ in range(args.runs):
+                with Timer() as timer:
+                    results, _ = search_messages(user.id, text, after=after, limit=args.limit)
+                samples.append(timer.wall)
+            naive = []
+            if name not in ('prefix', 'second page'):
+                for _ in range(args.naive_runs):
+                    with Timer() as timer:
+                        naive_search(user.id, text, args.limit)
+                    naive.append(timer.wall)
+            matches = ChatMessage.objects.filter(room__participants=user)
+            for term in text.split():
+                matches = matches.filter(content__icontains=term)
+            stats = summarize(samples)
+            naive_p50 = f"{summarize(naive)['p50'] * 1000:>14.1f}" if naive else f"{'-':>14}"
+            print(f"{name:<22}{matches.count():>9}{stats['p50'] * 1000:>9.1f}{stats['p95'] * 1000:>9.1f}"
+                  f"{stats['p99'] * 1000:>9.1f}{naive_p50}")
+    finally:
+        teardown_django()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Shared setup for the standalone benchmarks.
+
+Run a benchmark from the backend directory, e.g.:
+
+    python -m benchmarks.chat_broadcast
+"""
+import logging
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import django
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def setup_django(test_database=None):
+    """
+    Configure Django against a throwaway test database and an in-memory channel layer, without rate limits.
+
+    `test_database` puts a SQLite test database in that file, in WAL mode, so
+    that threads with their own connections can read and write it together;
+    the default shared in-memory database locks tables across connections.
+    """
+    sys.path.insert(0, str(BACKEND_DIR))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alumni_backend.settings')
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    # Benchmarks drive the socket far faster than any client is allowed to
+    settings.CHAT_RATE_LIMIT_ENABLED = False
+    logging.disable(logging.INFO)
+    setup_test_environment()
+    if test_database:
+        connection.settings_dict['TEST']['NAME'] = str(test_database)
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    if test_database and connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+
+
+def teardown_django():
+    from django.db import connection
+    connection.creation.destroy_test_db(connection.settings_dict['NAME'], verbosity=0)
+
+
+def create_users(count, prefix='bench'):
+    """
+    Create synthetic users, returning them with a fresh access token each
+    """
+    from django.contrib.auth import get_user_model
+    from rest_framework_simplejwt.tokens import RefreshToken
+
+    User = get_user_model()
+    users = []
+    for i in range(count):
+        user = User.objects.create_user(
+            username=f'{prefix}{i}',
+            email=f'{prefix}{i}@example.com',
+            password=f'{prefix}{i}pass123',
+            first_name=f'{prefix.title()}{i}',
+            last_name='User',
+            user_type='student'
+        )
+        users.append((user, str(RefreshToken.for_user(user).access_token)))
+    return users
+
+
+class Timer:
+    """
+    Context manager recording wall and CPU time of a block
+    """
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.wall_start
+        self.cpu = time.process_time() - self.cpu_start
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        'mean': statistics.mean(samples) if samples else 0.0,
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+    }
@@ -0,0 +1,322 @@
+"""
+Concurrent-frame throughput of the consumer's database access.
+
+Pairs of users run rounds of meeting_request, meeting_approval and message
+frames at the same time. Two earlier consumers are compared with the current
+one, all of their hops serialized on Django's single thread-sensitive thread:
+
+- per-query hops: the original consumer, one database_sync_to_async per
+  query and per serialization. A meeting request looked up the room, created
+  the message and the record, and serialized both for each of its two
+  recipients: seven hops. An approval made six, a message five, including
+  the streak update every message made.
+- per-helper hops: the consumer just before per-frame units. Rooms were
+  cached per connection and serialization no longer touched the database,
+  but each helper still hopped: two for a meeting request, two for an
+  approval and one for a message.
+
+The current consumer makes one hop per frame, optionally on a CHAT_DB_THREADS pool.
+
+Hops are counted as thread handoffs; throughput is frames per second of wall
+time with every pair sending concurrently, the median of --runs runs that
+take turns between the consumers so none gains from running later.
+
+    python -m benchmarks.db_hops [--pairs 20] [--rounds 10] [--runs 3] [--threads 0,4]
+
+SQLite allows one writer at a time, so pooled runs are skipped on the
+default test database; run with a PostgreSQL DATABASES setting to see the
+pool's effect on concurrent frames.
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.common import Timer, create_users, percentile, setup_django, teardown_django
+
+
+def build_legacy_consumers():
+    """
+    (per-query, per-helper) consumers making the thread hops the two earlier consumers made
+    """
+    from datetime import datetime
+
+    from channels.db import database_sync_to_async
+    from chat.activity import credit_streak
+    from chat.consumers import ChatConsumer, User
+    from chat.models import ActivityLog, ChatMessage, ChatRoom, MeetingRequest
+
+    class PerHelperHopsConsumer(ChatConsumer):
+        """
+        The consumer before per-frame units: one thread hop per database helper
+        """
+
+        async def get_or_create_room(self, other_user_id):
+            room_id = self.room_cache.get(int(other_user_id))
+            if room_id is None:
+                room_id = await database_sync_to_async(self.direct_room_id)(other_user_id)
+            return room_id
+
+        @database_sync_to_async
+        def create_message(self, room_id, content, attachments=None, client_msg_id=None):
+            return self._create_message(room_id, content, attachments, client_msg_id)
+
+        async def handle_message(self, data):
+            room_id = await self.get_or_create_room(data['to_user'])
+            message, created = await self.create_message(room_id, data['content'])
+            await self.broadcast([data['to_user'], self.user_id], 'message', self.serialize_message(message))
+            await self.update_user_streak()
+
+        async def handle_meeting_request(self, data):
+            room_id = await self.get_or_create_room(data['to_user'])
+            message = await self.create_meeting_request_message(room_id, data['datetime'], data['topic'])
+            meeting_request = await self.create_meeting_request_record(
+                room_id, message, data['to_user'], data['datetime'], data['topic']
+            )
+            await self.broadcast([data['to_user'], self.user_id], 'meeting_request', {
+                'message': self.serialize_message(message),
+                'meeting_request': self.serialize_meeting_request(meeting_request)
+            })
+
+        async def handle_meeting_approval(self, data):
+            meeting_request = await self.update_meeting_request(data['meeting_id'], data['status'])
+            message = await self.create_meeting_response_message(meeting_request, data['status'])
+            await self.broadcast([meeting_request.requester_id, meeting_request.recipient_id], 'meeting_response', {
+                'message': self.serialize_message(message),
+                'meeting_request': self.serialize_meeting_request(meeting_request)
+            })
+
+        @database_sync_to_async
+        def create_meeting_request_message(self, room_id, datetime_str, topic):
+            return ChatMessage.objects.create(
+                room_id=room_id,
+                sender_id=self.user_id,
+                sender_name=self.user.get_full_name(),
+                content=f"Meeting request: {topic}",
+                message_type='meeting_request',
+                meeting_datetime=datetime.fromisoformat(datetime_str.replace('Z', '+00:00')),
+                meeting_topic=topic,
+                meeting_status='pending'
+            )
+
+        @database_sync_to_async
+        def create_meeting_request_record(self, room_id, message, to_user_id, datetime_str, topic):
+            return MeetingRequest.objects.create(
+                requester_id=self.user_id,
+                recipient=User.objects.only('id', 'first_name', 'last_name').get(id=to_user_id),
+                room_id=room_id,
+                message=message,
+                datetime=datetime.fromisoformat(datetime_str.replace('Z', '+00:00')),
+                topic=topic,
+                status='pending'
+            )
+
+        @database_sync_to_async
+        def update_meeting_request(self, meeting_id, status):
+            meeting_request = MeetingRequest.objects.select_related(
+                'requester', 'recipient', 'message'
+            ).get(id=meeting_id)
+            meeting_request.status = status
+            meeting_request.save()
+            meeting_request.message.meeting_status = status
+            meeting_request.message.save()
+            return meeting_request
+
+        @database_sync_to_async
+        def create_meeting_response_message(self, meeting_request, status):
+            return ChatMessage.objects.create(
+                room_id=meeting_request.room_id,
+                sender_id=self.user_id,
+                sender_name=self.user.get_full_name(),
+                content=f"Meeting {status}: {meeting_request.topic}",
+                message_type=f'meeting_{status}',
+                meeting_datetime=meeting_request.datetime,
+                meeting_topic=meeting_request.topic,
+                meeting_status=status
+            )
+
+    class PerQueryHopsConsumer(PerHelperHopsConsumer):
+        """
+        The original consumer: no room cache, and serialization and streak updates hop too
+        """
+
+        async def get_or_create_room(self, other_user_id):
+            return await database_sync_to_async(self.direct_room)(other_user_id)
+
+        def direct_room(self, other_user_id):
+            return ChatRoom.get_or_create_direct(self.user_id, int(other_user_id)).id
+
+        async def handle_message(self, data):
+            room_id = await self.get_or_create_room(data['to_user'])
+            message, created = await self.create_message(room_id, data['content'])
+            for user_id in (data['to_user'], self.user_id):
+                await self.broadcast([user_id], 'message', await self.serialize_message_hop(message))
+            await self.update_user_streak()
+
+        async def handle_meeting_request(self, data):
+            room_id = await self.get_or_create_room(data['to_user'])
+            message = await self.create_meeting_request_message(room_id, data['datetime'], data['topic'])
+            meeting_request = await self.create_meeting_request_record(
+                room_id, message, data['to_user'], data['datetime'], data['topic']
+            )
+            for user_id in (data['to_user'], self.user_id):
+                await self.broadcast([user_id], 'meeting_request', {
+                    'message': await self.serialize_message_hop(message),
+                    'meeting_request': await self.serialize_meeting_request_hop(meeting_request)
+                })
+
+        async def handle_meeting_approval(self, data):
+            meeting_request = await self.update_meeting_request(data['meeting_id'], data['status'])
+            message = await self.create_meeting_response_message(meeting_request, data['status'])
+            for user_id in (meeting_request.requester_id, meeting_request.recipient_id):
+                await self.broadcast([user_id], 'meeting_response', {
+                    'message': await self.serialize_message_hop(message),
+                    'meeting_request': await self.serialize_meeting_request_hop(meeting_request)
+                })
+
+        @database_sync_to_async
+        def update_user_streak(self):
+            credit_streak(self.user_id)
+            ActivityLog.objects.create(user_id=self.user_id, activity_type='login', description='User connected to chat')
+
+        @database_sync_to_async
+        def serialize_message_hop(self, message):
+            return self.serialize_message(message)
+
+        @database_sync_to_async
+        def serialize_meeting_request_hop(self, meeting_request):
+            return self.serialize_meeting_request(meeting_request)
+
+    return PerQueryHopsConsumer, PerHelperHopsConsumer
+
+
+class HopCounter:
+    """
+    Count thread handoffs made through channels' database_sync_to_async
+    """
+
+    def __init__(self):
+        from channels.db import DatabaseSyncToAsync
+
+        self.count = 0
+        self.cls = DatabaseSyncToAsync
+        self.original = DatabaseSyncToAsync.thread_handler
+        counter = self
+
+        def thread_handler(self, loop, *args, **kwargs):
+            counter.count += 1
+            return counter.original(self, loop, *args, **kwargs)
+
+        DatabaseSyncToAsync.thread_handler = thread_handler
+
+    def restore(self):
+        self.cls.thread_handler = self.original
+
+
+async def receive_type(communicator, frame_type):
+    while True:
+        frame = await communicator.receive_json_from(timeout=30)
+        if frame['type'] == frame_type:
+            return frame
+
+
+async def pair_session(requester, recipient, recipient_id, rounds, latencies):
+    for i in range(rounds):
+        started = time.perf_counter()
+        await requester.send_json_to({
+            'type': 'meeting_request',
+            'to_user': recipient_id,
+            'datetime': '2030-01-15T14:00:00Z',
+            'topic': f'Round {i}'
+        })
+        request = await receive_type(recipient, 'meeting_request')
+        await receive_type(requester, 'meeting_request')
+        await recipient.send_json_to({
+            'type': 'meeting_approval',
+            'meeting_id': request['data']['meeting_request']['id'],
+            'status': 'approved'
+        })
+        await receive_type(requester, 'meeting_response')
+        await receive_type(recipient, 'meeting_response')
+        await requester.send_json_to({'type': 'message', 'to_user': recipient_id, 'content': f'See you in round {i}'})
+        await receive_type(recipient, 'message')
+        await receive_type(requester, 'message')
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_scenario(consumer_class, pairs, rounds):
+    from channels.testing import WebsocketCommunicator
+
+    connections = []
+    for (requester, requester_token), (recipient, recipient_token) in pairs:
+        requester_ws = WebsocketCommunicator(consumer_class.as_asgi(), f"/ws/chat/?token={requester_token}")
+        recipient_ws = WebsocketCommunicator(consumer_class.as_asgi(), f"/ws/chat/?token={recipient_token}")
+        await requester_ws.connect()
+        await recipient_ws.connect()
+        connections.append((requester_ws, recipient_ws, recipient.id))
+
+    latencies = []
+    counter = HopCounter()
+    try:
+        with Timer() as timer:
+            await asyncio.gather(*(
+                pair_session(requester_ws, recipient_ws, recipient_id, rounds, latencies)
+                for requester_ws, recipient_ws, recipient_id in connections
+            ))
+    finally:
+        counter.restore()
+
+    for requester_ws, recipient_ws, _ in connections:
+        await requester_ws.disconnect()
+        await recipient_ws.disconnect()
+    return timer, counter.count, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pairs', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--threads', default='0,4',
+                        help='Comma-separated CHAT_DB_THREADS values to run the current consumer with')
+    args = parser.parse_args()
+
+    setup_django()
+    try:
+        from django.conf import settings
+        from chat.consumers import ChatConsumer
+
+        users = create_users(args.pairs * 2)
+        pairs = [(users[i], users[args.pairs + i]) for i in range(args.pairs)]
+        frames = args.pairs * args.rounds * 3
+        per_query, per_helper = build_legacy_consumers()
+        variants = [('per-query hops (original)', per_query, 0), ('per-helper hops (before units)', per_helper, 0)]
+        for threads in (int(value) for value in args.threads.split(',')):
+            variants.append((f'one hop per frame, threads={threads}', ChatConsumer, threads))
+
+        print(f"{args.pairs} concurrent pairs x {args.rounds} rounds of "
+              f"meeting_request + meeting_approval + message ({frames} frames), "
+              f"{settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1]}")
+        print(f"{'consumer':<34}{'frames/s':>10}{'hops/frame':>12}{'round p50 ms':>14}{'round p95 ms':>14}")
+        sqlite = settings.DATABASES['default']['ENGINE'].endswith('sqlite3')
+        skipped = [variant for variant in variants if variant[2] and sqlite]
+        variants = [variant for variant in variants if variant not in skipped]
+        results = {name: [] for name, _, _ in variants}
+        for _ in range(args.runs):
+            for name, consumer_class, threads in variants:
+                settings.CHAT_DB_THREADS = threads
+                # Warm up room caches and the thread pool before measuring
+                asyncio.run(run_scenario(consumer_class, pairs, 1))
+                results[name].append(asyncio.run(run_scenario(consumer_class, pairs, args.rounds)))
+
+        for name, _, _ in variants:
+            timer, hops, latencies = sorted(results[name], key=lambda result: result[0].wall)[len(results[name]) // 2]
+            print(f"{name:<34}{frames / timer.wall:>10.0f}{hops / frames:>12.2f}"
+                  f"{percentile(latencies, 50) * 1000:>14.1f}{percentile(latencies, 95) * 1000:>14.1f}")
+        for name, _, _ in skipped:
+            print(f"{name:<34}  skipped: SQLite's in-memory test database takes one writer at a time")
+    finally:
+        teardown_django()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Fan-out of one message to a 500-member group room.
+
+Compares routing through every member's user_<id> group (one group_send per
+member) with a single group_send to the room's room_<id> group. Each member
+is one subscribed channel; latency is measured from the start of the
+broadcast until every member channel has received the frame.
+
+    python -m benchmarks.group_fanout [--members 500] [--messages 50]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.common import Timer, setup_django, summarize, teardown_django
+
+
+def build_counting_layer():
+    from channels.layers import InMemoryChannelLayer
+
+    class CountingChannelLayer(InMemoryChannelLayer):
+        """
+        In-memory layer that counts calls made by consumers and per-channel deliveries
+        """
+
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.group_sends = 0
+            self.deliveries = 0
+
+        async def group_send(self, group, message):
+            self.group_sends += 1
+            await super().group_send(group, message)
+
+        async def send(self, channel, message):
+            self.deliveries += 1
+            await super().send(channel, message)
+
+    return CountingChannelLayer()
+
+
+async def run_scenario(mode, members, messages):
+    from chat.consumers import ChatConsumer
+    from chat.rooms import room_group_name, user_group_name
+
+    layer = build_counting_layer()
+    room_id = 1
+    member_ids = list(range(1, members + 1))
+    channels = []
+    for user_id in member_ids:
+        channel = await layer.new_channel()
+        channels.append(channel)
+        await layer.group_add(user_group_name(user_id), channel)
+        await layer.group_add(room_group_name(room_id), channel)
+
+    consumer = ChatConsumer()
+    consumer.channel_layer = layer
+    payload = {'id': 0, 'room_id': room_id, 'sender': {'id': 1, 'name': 'Bench User'}, 'content': 'x' * 120}
+
+    latencies = []
+    with Timer() as timer:
+        for i in range(messages):
+            payload['id'] = i
+            started = time.perf_counter()
+            if mode == 'per-user':
+                await consumer.broadcast(member_ids, 'message', payload)
+            else:
+                await consumer.broadcast_room(room_id, 'message', payload)
+            for channel in channels:
+                await layer.receive(channel)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    return latencies, timer, layer.group_sends / messages, layer.deliveries / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    try:
+        print(f"{args.members}-member room, {args.messages} messages")
+        print(f"{'routing':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'cpu ms/msg':>12}"
+              f"{'group_send/msg':>16}{'deliveries/msg':>16}")
+        for mode in ('per-user', 'room'):
+            # Warm up before measuring
+            asyncio.run(run_scenario(mode, args.members, 5))
+            latencies, timer, group_sends, deliveries = asyncio.run(run_scenario(mode, args.members, args.messages))
+            stats = summarize(latencies)
+            print(f"{mode:<10}{stats['mean']:>10.2f}{stats['p50']:>10.2f}{stats['p95']:>10.2f}"
+                  f"{timer.cpu / args.messages * 1000:>12.2f}{group_sends:>16.0f}{deliveries:>16.0f}")
+    finally:
+        teardown_django()
+
+
+if __name__ == '__main__':
+    main()
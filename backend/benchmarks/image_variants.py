@@ -0,0 +1,102 @@
+"""
+Bytes served and render cost of derived image sizes against the uploaded originals.
+
+Generates --images synthetic photos of --width x --height (noise over
+gradients, saved as JPEG at quality 90 like a phone camera's output) and
+renders every IMAGE_VARIANTS size in every IMAGE_VARIANT_FORMATS. It reports:
+
+- the bytes a list page of --page-items images downloads as originals and
+  at each variant (noise shrinks away when downscaled, so real photos
+  gain somewhat less)
+- render time per image in the calling thread, which is what an upload
+  request would wait for if it rendered its own variants
+- throughput of the --workers spawned worker processes
+
+    python -m benchmarks.image_variants [--images 24] [--width 4000] [--height 3000] [--workers 2]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from benchmarks.common import Timer, setup_django, summarize, teardown_django
+
+
+def photo(width, height, seed):
+    from PIL import Image
+
+    rng = random.Random(seed)
+    channels = []
+    for _ in range(3):
+        gradient = Image.linear_gradient('L').rotate(rng.randrange(360)).resize((width, height))
+        noise = Image.effect_noise((width, height), rng.randrange(20, 60))
+        channels.append(Image.blend(gradient, noise, 0.35))
+    out = BytesIO()
+    Image.merge('RGB', channels).save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=24)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--page-items', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    setup_django()
+    try:
+        from blobstore.imaging import render_variants
+        from blobstore.variants import all_specs, spec_token, variant_specs
+
+        specs = all_specs()
+        originals = [photo(args.width, args.height, seed) for seed in range(args.images)]
+
+        samples = []
+        rendered = []
+        for data in originals:
+            with Timer() as timer:
+                rendered.append(render_variants(data, specs))
+            samples.append(timer.wall)
+        inline = summarize(samples)
+
+        pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            # Start the workers before timing, as a long-running server would have them
+            list(pool.map(render_variants, originals[:args.workers], [specs[:1]] * args.workers))
+            with Timer() as timer:
+                list(pool.map(render_variants, originals, [specs] * len(originals)))
+        finally:
+            pool.shutdown()
+
+        sizes = {}
+        for variants in rendered:
+            for spec, content, _ in variants:
+                sizes.setdefault(spec, []).append(len(content))
+        mean_original = sum(map(len, originals)) / len(originals)
+
+        kb = 1024
+        print(f"{args.images} photos of {args.width}x{args.height}, {mean_original / kb:.0f} KB each on average")
+        print()
+        print(f"{'served as':<20}{'mean KB':>10}{f'page of {args.page_items} KB':>18}{'of original':>13}")
+        print(f"{'original':<20}{mean_original / kb:>10.1f}{mean_original * args.page_items / kb:>18.0f}{'100%':>13}")
+        for preset, preset_specs in variant_specs().items():
+            for spec in preset_specs:
+                mean = sum(sizes[spec]) / len(sizes[spec])
+                label = f"{preset} {spec_token(spec)}"
+                print(f"{label:<20}{mean / kb:>10.1f}{mean * args.page_items / kb:>18.0f}"
+                      f"{mean / mean_original * 100:>12.2f}%")
+        print()
+        print(f"Rendering all {len(specs)} variants of one photo in the calling thread: "
+              f"p50 {inline['p50'] * 1000:.0f} ms, p95 {inline['p95'] * 1000:.0f} ms")
+        print(f"{args.workers} worker processes: {args.images / timer.wall:.1f} photos/s "
+              f"({os.cpu_count()} CPUs), off the request threads")
+    finally:
+        teardown_django()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Bytes and CPU per frame for the JSON and MessagePack WebSocket encodings.
+
+Frames are shaped like the ones ChatConsumer sends: chat messages, meeting
+responses, typing and read_up_to updates, and 50-message sync batches, with
+varied message text. Encode time is the server's cost, paid once per
+broadcast; decode time is a stand-in for the client's cost.
+
+permessage-deflate is negotiated by the ASGI server, not the consumer, so
+it is modelled here with zlib raw deflate:
+- "deflate" compresses each frame on its own (no context takeover)
+- "deflate+ctx" keeps one compressor per connection, as browsers and most
+  servers do by default, so repeated keys and names compress against
+  earlier frames
+
+    python -m benchmarks.wire_format [--frames 2000]
+"""
+import argparse
+import random
+import time
+import zlib
+
+WORDS = (
+    "hi thanks meeting tomorrow career advice resume internship alumni batch "
+    "project deadline interview referral campus placement offer congrats "
+    "please share the link when you are free next week call"
+).split()
+
+
+def message_data(i, with_meeting=False):
+    return {
+        'id': 100000 + i,
+        'room_id': 4200 + i % 7,
+        'seq': 5000 + i,
+        'client_msg_id': f"c{random.getrandbits(48):012x}",
+        'sender': {'id': 17 + i % 5, 'name': 'Priya Raman', 'email': 'priya.raman@example.com'},
+        'content': ' '.join(random.choice(WORDS) for _ in range(random.randint(3, 25))),
+        'message_type': 'meeting_response' if with_meeting else 'message',
+        'created_at': f"2024-11-0{1 + i % 9}T10:{i % 60:02d}:{i * 7 % 60:02d}.{i % 1000:03d}000+00:00",
+        'meeting_data': {
+            'datetime': '2024-12-25T14:00:00+00:00',
+            'topic': 'Career Discussion',
+            'status': 'approved'
+        } if with_meeting else None
+    }
+
+
+def history_data(i):
+    data = message_data(i)
+    del data['meeting_data']
+    data.update({'reply_to_id': None, 'attachments': [], 'is_read': bool(i % 2), 'meeting_data': None})
+    return data
+
+
+def build_frames(count):
+    """
+    A mixed stream of frames in roughly the proportions a busy connection sees
+    """
+    kinds = {
+        'message': lambda i: {'type': 'message', 'data': message_data(i)},
+        'meeting_response': lambda i: {'type': 'meeting_response', 'data': {
+            'message': message_data(i, with_meeting=True),
+            'meeting_request': {
+                'id': 900 + i,
+                'requester': {'id': 17, 'name': 'Priya Raman'},
+                'recipient': {'id': 23, 'name': 'Arjun Mehta'},
+                'datetime': '2024-12-25T14:00:00+00:00',
+                'topic': 'Career Discussion',
+                'status': 'approved',
+                'created_at': '2024-11-01T09:00:00+00:00'
+            }
+        }},
+        'typing': lambda i: {'type': 'typing', 'data': {
+            'room_id': 4200 + i % 7, 'user_id': 23, 'user_name': 'Arjun Mehta',
+            'is_typing': bool(i % 2), 'expires_in': 6.0 if i % 2 else 0
+        }},
+        'read_up_to': lambda i: {'type': 'read_up_to', 'data': {'room_id': 4200 + i % 7, 'user_id': 23, 'seq': 5000 + i}},
+        'sync': lambda i: {'type': 'sync', 'data': {
+            'room_id': 4200 + i % 7, 'messages': [history_data(i * 50 + j) for j in range(50)]
+        }},
+    }
+    weights = {'message': 60, 'meeting_response': 2, 'typing': 25, 'read_up_to': 12, 'sync': 1}
+    names = random.choices(list(weights), weights=list(weights.values()), k=count)
+    return [(name, kinds[name](i)) for i, name in enumerate(names)]
+
+
+def build_codecs():
+    from chat.wire import JsonCodec, MsgpackCodec
+
+    return {'json': JsonCodec(), 'msgpack': MsgpackCodec()}
+
+
+def deflate(payloads, context_takeover):
+    """
+    Compressed sizes as permessage-deflate would send them, and the CPU spent
+    """
+    sizes = []
+    compressor = zlib.compressobj(wbits=-15)
+    started = time.process_time()
+    for payload in payloads:
+        if isinstance(payload, str):
+            payload = payload.encode('utf8')
+        if not context_takeover:
+            compressor = zlib.compressobj(wbits=-15)
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        # The trailing empty block is stripped on the wire
+        sizes.append(len(data) - 4)
+    return sizes, time.process_time() - started
+
+
+def measure(codec, frames):
+    started = time.process_time()
+    payloads = [codec.encode(frame) for _, frame in frames]
+    encode_cpu = time.process_time() - started
+
+    started = time.process_time()
+    for payload in payloads:
+        if isinstance(payload, bytes):
+            codec.decode(bytes_data=payload)
+        else:
+            codec.decode(text_data=payload)
+    decode_cpu = time.process_time() - started
+
+    sizes = [len(payload.encode('utf8') if isinstance(payload, str) else payload) for payload in payloads]
+    return payloads, sizes, encode_cpu, decode_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    frames = build_frames(args.frames)
+    codecs = build_codecs()
+    kinds = sorted({name for name, _ in frames})
+
+    print(f"{args.frames} frames: " + ', '.join(
+        f"{sum(1 for name, _ in frames if name == kind)} {kind}" for kind in kinds
+    ))
+    print()
+    print("Mean bytes per frame")
+    print(f"{'encoding':<20}" + ''.join(f"{kind:>18}" for kind in kinds) + f"{'all':>10}")
+    results = {}
+    for codec_name, codec in codecs.items():
+        # Warm up before measuring
+        measure(codec, frames[:200])
+        payloads, sizes, encode_cpu, decode_cpu = measure(codec, frames)
+        rows = [(codec_name, sizes, 0.0)]
+        for context_takeover, suffix in ((False, '+deflate'), (True, '+deflate+ctx')):
+            deflated, cpu = deflate(payloads, context_takeover)
+            rows.append((codec_name + suffix, deflated, cpu))
+        for name, row_sizes, compress_cpu in rows:
+            by_kind = {
+                kind: [size for (frame_kind, _), size in zip(frames, row_sizes) if frame_kind == kind]
+                for kind in kinds
+            }
+            print(f"{name:<20}" + ''.join(
+                f"{sum(by_kind[kind]) / len(by_kind[kind]):>18.0f}" for kind in kinds
+            ) + f"{sum(row_sizes) / len(row_sizes):>10.0f}")
+            results[name] = (sum(row_sizes), encode_cpu + compress_cpu, decode_cpu)
+
+    print()
+    print("Per frame, averaged over the stream")
+    print(f"{'encoding':<20}{'bytes':>8}{'vs json':>9}{'encode us':>11}{'decode us':>11}")
+    json_bytes = results['json'][0]
+    for name, (total, encode_cpu, decode_cpu) in results.items():
+        print(f"{name:<20}{total / args.frames:>8.0f}{total / json_bytes * 100:>8.0f}%"
+              f"{encode_cpu / args.frames * 1e6:>11.1f}{decode_cpu / args.frames * 1e6:>11.1f}")
+    print()
+    print("encode us includes compression for the deflate rows; decode us excludes decompression.")
+
+
+if __name__ == '__main__':
+    main()
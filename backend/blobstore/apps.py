@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class BlobstoreConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'blobstore'
+
+    def ready(self):
+        from .signals import connect_file_fields
+
+        connect_file_fields()
@@ -0,0 +1,77 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import BLOB_PREFIX, Blob
+from .variants import delete_variants, is_image
+
+
+def collect_cutoff(hours=None):
+    """
+    Last-use time before which unreferenced blobs are deleted, MEDIA_BLOB_GRACE_HOURS ago by default
+    """
+    if hours is None:
+        hours = getattr(settings, 'MEDIA_BLOB_GRACE_HOURS', 24)
+    return timezone.now() - timedelta(hours=hours)
+
+
+def collect_batch(storage, cutoff, batch_size=500):
+    """
+    Delete up to `batch_size` blobs unreferenced since before `cutoff`, files and image variants first.
+
+    The rows stay locked until their files are gone, so an upload of the
+    same bytes waits and then stores them again. Returns (blobs, bytes).
+    """
+    with transaction.atomic():
+        blobs = list(
+            Blob.objects.select_for_update()
+            .filter(ref_count=0, last_used_at__lt=cutoff)
+            .order_by('last_used_at')[:batch_size]
+        )
+        for blob in blobs:
+            storage.backend.delete(blob.key)
+            if is_image(blob.key):
+                delete_variants(blob.key)
+        Blob.objects.filter(key__in=[blob.key for blob in blobs]).delete()
+    return len(blobs), sum(blob.size for blob in blobs)
+
+
+def adopt_stray_files(storage, cutoff):
+    """
+    Give blob files without a row, left by uploads that failed or rolled back, an unreferenced row.
+
+    Only files last modified before `cutoff` are adopted, and collect_batch
+    then deletes them like any other orphan. Walks the whole blob tree, so
+    it is worth running only occasionally. Returns the number adopted.
+    """
+    adopted = 0
+    for keys in _blob_files(storage):
+        existing = set(Blob.objects.filter(key__in=keys).values_list('key', flat=True))
+        strays = []
+        for key in keys:
+            if key in existing:
+                continue
+            modified = storage.backend.get_modified_time(key)
+            if modified < cutoff:
+                strays.append(Blob(key=key, size=storage.backend.size(key), last_used_at=modified))
+        Blob.objects.bulk_create(strays, ignore_conflicts=True)
+        adopted += len(strays)
+    return adopted
+
+
+def _blob_files(storage):
+    # One list of keys per leaf directory of blobs/ab/cd/
+    root = BLOB_PREFIX.rstrip('/')
+    try:
+        first_level, _ = storage.backend.listdir(root)
+    except FileNotFoundError:
+        return
+    for first in first_level:
+        second_level, _ = storage.backend.listdir(f"{root}/{first}")
+        for second in second_level:
+            directory = f"{root}/{first}/{second}"
+            _, files = storage.backend.listdir(directory)
+            if files:
+                yield [f"{directory}/{name}" for name in files]
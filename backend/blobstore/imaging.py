@@ -0,0 +1,55 @@
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Runs in the variant worker processes: Pillow only, nothing that needs Django set up
+
+QUALITY = 80
+PILLOW_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG', 'png': 'PNG'}
+
+
+def render_variants(data, specs):
+    """
+    Encode the image in `data` at each (width, height, crop, format) of `specs`.
+
+    Cropped variants fill the box, the others fit inside it; neither is
+    enlarged past the source. Returns [(spec, encoded bytes, (width, height))].
+    """
+    largest = max(max(width, height) for width, height, _, _ in specs)
+    with Image.open(BytesIO(data)) as source:
+        # JPEG decodes straight at a reduced scale no smaller than the largest box
+        source.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(source)
+        image.load()
+
+    rendered = []
+    for spec in specs:
+        width, height, crop, fmt = spec
+        if crop:
+            # A source smaller than the box gets the box's shape at the size it has
+            scale = min(1, image.width / width, image.height / height)
+            box = (max(1, round(width * scale)), max(1, round(height * scale)))
+            variant = ImageOps.fit(image, box, Image.LANCZOS)
+        else:
+            variant = image.copy()
+            variant.thumbnail((width, height), Image.LANCZOS)
+        variant = _encodable(variant, fmt)
+        out = BytesIO()
+        variant.save(out, PILLOW_FORMATS[fmt], quality=QUALITY)
+        rendered.append((spec, out.getvalue(), variant.size))
+    return rendered
+
+
+def _encodable(image, fmt):
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    if fmt == 'jpeg':
+        if has_alpha:
+            # JPEG has no alpha channel: flatten onto white
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image if image.mode in ('RGB', 'L') else image.convert('RGB')
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        return image.convert('RGBA' if has_alpha else 'RGB')
+    return image
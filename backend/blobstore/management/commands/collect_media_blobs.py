@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from blobstore.collect import adopt_stray_files, collect_batch, collect_cutoff
+from blobstore.models import Blob
+from blobstore.storage import ContentAddressedStorage
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete media blobs that no file field has referenced for MEDIA_BLOB_GRACE_HOURS. '
+        'Each batch commits on its own, so the command can be stopped and rerun at any time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=int, default=None,
+                            help='Keep unreferenced blobs this many hours after their last use '
+                                 '(default: MEDIA_BLOB_GRACE_HOURS)')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Blobs deleted per transaction')
+        parser.add_argument('--scan-storage', action='store_true',
+                            help='Also collect blob files that have no row, left by failed uploads; '
+                                 'lists every stored blob')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the blobs that would be deleted')
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            raise CommandError('The default storage is not blobstore.storage.ContentAddressedStorage')
+        hours = options['grace_hours']
+        if hours is None:
+            hours = getattr(settings, 'MEDIA_BLOB_GRACE_HOURS', 24)
+        if hours < 0:
+            raise CommandError('--grace-hours cannot be negative')
+        cutoff = collect_cutoff(hours)
+
+        if options['dry_run']:
+            count = Blob.objects.filter(ref_count=0, last_used_at__lt=cutoff).count()
+            self.stdout.write(f"{count} unreferenced blobs last used before {cutoff:%Y-%m-%d %H:%M} would be deleted")
+            return
+
+        if options['scan_storage']:
+            adopted = adopt_stray_files(default_storage, cutoff)
+            self.stdout.write(f"Found {adopted} blob files without a row")
+
+        deleted = 0
+        freed = 0
+        while True:
+            count, size = collect_batch(default_storage, cutoff, batch_size=options['batch_size'])
+            if not count:
+                break
+            deleted += count
+            freed += size
+            self.stdout.write(f"Deleted {deleted} blobs")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} unreferenced blobs ({freed / (1024 * 1024):.1f} MB)"
+        ))
@@ -0,0 +1,64 @@
+from collections import Counter
+
+from django.db import models
+from django.db.models import F, Q, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+# Names under this prefix are content-addressed blobs; anything else is a
+# file stored before the blob store, which is neither counted nor collected
+BLOB_PREFIX = 'blobs/'
+
+
+def blob_keys(names):
+    """
+    Count the blob names in `names`, skipping empty and pre-blob names
+    """
+    return Counter(name for name in names if name and name.startswith(BLOB_PREFIX))
+
+
+class BlobManager(models.Manager):
+    def retain(self, names):
+        """
+        Add one reference to the blob behind each name (a name listed twice gets two)
+        """
+        now = timezone.now()
+        for key, count in blob_keys(names).items():
+            self.filter(key=key).update(ref_count=F('ref_count') + count, last_used_at=now)
+
+    def release(self, names):
+        """
+        Drop one reference per name; blobs left at zero wait for collect_media_blobs
+        """
+        now = timezone.now()
+        for key, count in blob_keys(names).items():
+            self.filter(key=key).update(ref_count=Greatest(F('ref_count') - count, Value(0)), last_used_at=now)
+
+
+class Blob(models.Model):
+    """
+    One stored file content, shared by every file field value that names it.
+
+    ref_count is the number of such values (archived chat attachments
+    included). A blob that stays at zero for MEDIA_BLOB_GRACE_HOURS after
+    its last use is deleted, file and row, by collect_media_blobs.
+    """
+    key = models.CharField(max_length=100, primary_key=True)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last upload of these bytes or change to ref_count; the grace period runs from here
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    objects = BlobManager()
+
+    class Meta:
+        db_table = 'media_blobs'
+        verbose_name = 'Media Blob'
+        verbose_name_plural = 'Media Blobs'
+        indexes = [
+            models.Index(fields=['last_used_at'], condition=Q(ref_count=0), name='media_blob_orphan_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.ref_count} refs)"
@@ -0,0 +1,88 @@
+from django.apps import apps
+from django.db import transaction
+from django.db.models import FileField
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+
+from .models import Blob
+from .storage import ContentAddressedStorage
+from .variants import is_image, schedule_variants
+
+# model -> attnames of its file fields stored through ContentAddressedStorage
+counted_fields = {}
+
+
+def stored_name(value):
+    return getattr(value, 'name', value) or None
+
+
+def connect_file_fields():
+    """
+    Count blob references from every model file field whose storage is content-addressed
+    """
+    for model in apps.get_models():
+        attnames = [
+            field.attname for field in model._meta.concrete_fields
+            if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorage)
+        ]
+        if not attnames:
+            continue
+        counted_fields[model] = attnames
+        post_init.connect(remember_names, sender=model, dispatch_uid=f'blobstore_init_{model._meta.label}')
+        pre_save.connect(load_unknown_names, sender=model, dispatch_uid=f'blobstore_pre_save_{model._meta.label}')
+        pre_delete.connect(load_unknown_names, sender=model, dispatch_uid=f'blobstore_pre_delete_{model._meta.label}')
+        post_save.connect(count_saved_names, sender=model, dispatch_uid=f'blobstore_save_{model._meta.label}')
+        post_delete.connect(release_deleted_names, sender=model, dispatch_uid=f'blobstore_delete_{model._meta.label}')
+
+
+def remember_names(sender, instance, **kwargs):
+    # Names as loaded, to tell which changed on save; deferred fields are not in __dict__
+    instance._blob_names = {
+        attname: stored_name(instance.__dict__[attname])
+        for attname in counted_fields[sender] if attname in instance.__dict__
+    }
+
+
+def saved_attnames(sender, update_fields):
+    attnames = counted_fields[sender]
+    if update_fields is None:
+        return attnames
+    return [attname for attname in attnames if attname in update_fields]
+
+
+def load_unknown_names(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Before a save or delete, read the stored names of fields that were deferred when the instance was loaded
+    """
+    if raw or instance._state.adding:
+        return
+    known = instance.__dict__.setdefault('_blob_names', {})
+    unknown = [attname for attname in saved_attnames(sender, update_fields) if attname not in known]
+    if unknown:
+        row = sender._base_manager.using(instance._state.db).filter(pk=instance.pk).values(*unknown).first() or {}
+        known.update({attname: row.get(attname) or None for attname in unknown})
+
+
+def count_saved_names(sender, instance, created, raw, update_fields, **kwargs):
+    """
+    Move references from the names a save replaced to the names it stored
+    """
+    if raw:
+        return
+    previous = {} if created else instance.__dict__.get('_blob_names', {})
+    current = {
+        attname: stored_name(instance.__dict__.get(attname)) for attname in saved_attnames(sender, update_fields)
+    }
+    changed = [attname for attname, name in current.items() if name != previous.get(attname)]
+    stored = [current[attname] for attname in changed]
+    Blob.objects.retain(stored)
+    Blob.objects.release([previous.get(attname) for attname in changed])
+    images = [name for name in stored if is_image(name)]
+    if images:
+        transaction.on_commit(lambda: schedule_variants(images), using=instance._state.db)
+    instance._blob_names = {**previous, **current}
+
+
+def release_deleted_names(sender, instance, **kwargs):
+    # The names as stored, filled in by load_unknown_names
+    known = instance.__dict__.get('_blob_names', {})
+    Blob.objects.release([known.get(attname) for attname in counted_fields[sender]])
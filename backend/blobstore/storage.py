@@ -0,0 +1,127 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+
+from .models import BLOB_PREFIX, Blob
+
+# Kept on the key so URLs serve with the right content type; anything odd is dropped
+EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,9}$')
+
+
+def backing_storage():
+    """
+    The storage blobs are written to, chosen by MEDIA_BLOB_BACKEND
+    """
+    backend = getattr(settings, 'MEDIA_BLOB_BACKEND', 'local')
+    if backend == 'local':
+        return FileSystemStorage()
+    if backend == 's3':
+        from storages.backends.s3 import S3Storage
+
+        # A key's bytes never change, so caches may keep them for good
+        return S3Storage(file_overwrite=True, object_parameters={'CacheControl': 'max-age=31536000, immutable'})
+    raise ImproperlyConfigured(f"Unknown MEDIA_BLOB_BACKEND {backend!r}; use 'local' or 's3'")
+
+
+@deconstructible
+class ContentAddressedStorage(Storage):
+    """
+    Stores each distinct file content once, under blobs/ab/cd/<sha256><ext>.
+
+    The digest is computed while the upload is read in chunks, and bytes
+    already stored are not written again, so every upload of the same file
+    gets the same name. Files go to MEDIA_ROOT or to an S3-compatible bucket
+    (MEDIA_BLOB_BACKEND). References are counted from the model file fields
+    that hold the names (blobstore.signals), not from delete(), since one
+    blob is shared by many rows.
+    """
+
+    def __init__(self, backend=None):
+        if backend is not None:
+            self.backend = backend
+
+    @cached_property
+    def backend(self):
+        return backing_storage()
+
+    def get_available_name(self, name, max_length=None):
+        # The stored name is derived from the content in _save
+        return name
+
+    def _save(self, name, content):
+        digest, size, source = self._digest(content)
+        extension = os.path.splitext(name)[1].lower()
+        key = f"{BLOB_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{extension if EXTENSION_RE.match(extension) else ''}"
+
+        # Touching the row also keeps collect_media_blobs off it while this upload's reference is saved
+        now = timezone.now()
+        if Blob.objects.filter(key=key).update(last_used_at=now):
+            return key
+        saved = self.backend.save(key, source)
+        if saved != key:
+            # Written meanwhile by a concurrent upload, or left by an interrupted one: same bytes
+            self.backend.delete(saved)
+        Blob.objects.get_or_create(key=key, defaults={'size': size, 'last_used_at': now})
+        return key
+
+    def _digest(self, content):
+        """
+        Hash `content` chunk by chunk; returns (hex digest, size, file to store from)
+        """
+        digest = hashlib.sha256()
+        size = 0
+        spool = None
+        if not content.seekable():
+            # A one-pass stream: keep the chunks while hashing them
+            spool = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        for chunk in content.chunks():
+            digest.update(chunk)
+            size += len(chunk)
+            if spool is not None:
+                spool.write(chunk)
+        if spool is None:
+            content.seek(0)
+            return digest.hexdigest(), size, content
+        spool.seek(0)
+        return digest.hexdigest(), size, File(spool)
+
+    def delete(self, name):
+        # Blobs are shared: they go once unreferenced, through collect_media_blobs
+        if name and not name.startswith(BLOB_PREFIX):
+            self.backend.delete(name)
+
+    def _open(self, name, mode='rb'):
+        return self.backend.open(name, mode)
+
+    def exists(self, name):
+        return self.backend.exists(name)
+
+    def url(self, name):
+        return self.backend.url(name)
+
+    def size(self, name):
+        return self.backend.size(name)
+
+    def path(self, name):
+        return self.backend.path(name)
+
+    def listdir(self, path):
+        return self.backend.listdir(path)
+
+    def get_modified_time(self, name):
+        return self.backend.get_modified_time(name)
+
+    def get_created_time(self, name):
+        return self.backend.get_created_time(name)
+
+    def get_accessed_time(self, name):
+        return self.backend.get_accessed_time(name)
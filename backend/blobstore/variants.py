@@ -0,0 +1,199 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+from .imaging import render_variants
+from .models import BLOB_PREFIX
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+VARIANT_PREFIX = 'variants/'
+# Only marks that a variant is stored; a miss falls back to asking the storage
+CACHE_PREFIX = 'image_variant:'
+CACHE_TIMEOUT = 24 * 60 * 60
+
+_pool_lock = threading.Lock()
+_process_pool = None
+_thread_pool = None
+
+
+def is_image(name):
+    return bool(name) and os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def has_variants(name):
+    # Only stored blobs get variants: never a variant itself, or a path a URL made up
+    return is_image(name) and name.startswith(BLOB_PREFIX)
+
+
+def variant_specs(presets=None):
+    """
+    {preset: [(width, height, crop, format)]} for IMAGE_VARIANTS, or only the named presets
+    """
+    configured = getattr(settings, 'IMAGE_VARIANTS', {})
+    formats = getattr(settings, 'IMAGE_VARIANT_FORMATS', ['webp', 'jpeg'])
+    return {
+        preset: [(width, height, crop, fmt) for fmt in formats]
+        for preset, (width, height, crop) in configured.items()
+        if presets is None or preset in presets
+    }
+
+
+def all_specs():
+    return [spec for specs in variant_specs().values() for spec in specs]
+
+
+def spec_token(spec):
+    width, height, crop, fmt = spec
+    return f"{width}x{height}{'c' if crop else ''}.{fmt}"
+
+
+def parse_token(token):
+    """
+    The configured spec a URL token names, or None; sizes nobody configured are never rendered
+    """
+    return next((spec for spec in all_specs() if spec_token(spec) == token), None)
+
+
+def variant_directory(source):
+    """
+    Where the variants of the blob `source` are stored: variants/ab/cd/<blob digest>, so they follow its bytes
+    """
+    base = os.path.basename(source).split('.')[0]
+    return f"{VARIANT_PREFIX}{base[:2]}/{base[2:4]}/{base}"
+
+
+def variant_name(source, spec):
+    return f"{variant_directory(source)}/{spec_token(spec)}"
+
+
+def image_variants(file, presets=None):
+    """
+    Variant URLs for an image field value or stored name, {preset: {format: url}}; None if it is no image blob.
+
+    The URLs go through the image_variant view, which redirects to the
+    stored variant and renders it first if it is not there yet.
+    """
+    name = getattr(file, 'name', file)
+    if not has_variants(name):
+        return None
+    return {
+        preset: {spec[3]: reverse('image_variant', args=[spec_token(spec), name]) for spec in specs}
+        for preset, specs in variant_specs(presets).items()
+    }
+
+
+def variant_storage():
+    # Variant names are exact: write past the content-addressed layer
+    return getattr(default_storage, 'backend', default_storage)
+
+
+def variant_exists(name):
+    if cache.get(CACHE_PREFIX + name):
+        return True
+    if variant_storage().exists(name):
+        cache.set(CACHE_PREFIX + name, True, CACHE_TIMEOUT)
+        return True
+    return False
+
+
+def get_variant_pool():
+    """
+    The process pool variants are rendered in, IMAGE_VARIANT_WORKERS processes; None renders in the calling thread
+    """
+    global _process_pool
+    workers = getattr(settings, 'IMAGE_VARIANT_WORKERS', 2)
+    if not workers:
+        return None
+    with _pool_lock:
+        if _process_pool is None:
+            # Spawned, not forked: the server process has threads and open connections
+            _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _process_pool
+
+
+def _get_thread_pool():
+    # Threads that read sources and store results while the processes render
+    global _thread_pool
+    with _pool_lock:
+        if _thread_pool is None:
+            workers = max(1, getattr(settings, 'IMAGE_VARIANT_WORKERS', 2))
+            _thread_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-variants')
+        return _thread_pool
+
+
+def generate_variants(source, specs):
+    """
+    Render and store `specs` of the image `source`; returns the stored names, [] if it is not a readable image
+    """
+    storage = variant_storage()
+    try:
+        with storage.open(source) as f:
+            data = f.read()
+        pool = get_variant_pool()
+        if pool is None:
+            rendered = render_variants(data, specs)
+        else:
+            rendered = pool.submit(render_variants, data, specs).result()
+    except Exception as e:
+        logger.warning(f"Could not render variants of {source}: {e}")
+        return []
+
+    names = []
+    for spec, content, _ in rendered:
+        name = variant_name(source, spec)
+        saved = storage.save(name, ContentFile(content))
+        if saved != name:
+            # Rendered meanwhile by another worker: same bytes
+            storage.delete(saved)
+        cache.set(CACHE_PREFIX + name, True, CACHE_TIMEOUT)
+        names.append(name)
+    return names
+
+
+def ensure_variant(source, spec):
+    """
+    Stored name of `source`'s variant, rendered now if missing; None if the source is not a readable image
+    """
+    name = variant_name(source, spec)
+    if variant_exists(name):
+        return name
+    return name if generate_variants(source, [spec]) else None
+
+
+def schedule_variants(names):
+    """
+    Render every configured variant of newly stored images in the background; returns the futures
+    """
+    return [_get_thread_pool().submit(_generate_missing, name) for name in set(filter(has_variants, names))]
+
+
+def _generate_missing(source):
+    # An upload of bytes already stored finds its variants there too
+    missing = [spec for spec in all_specs() if not variant_exists(variant_name(source, spec))]
+    return generate_variants(source, missing) if missing else []
+
+
+def delete_variants(source):
+    """
+    Delete the stored variants of `source`, when its blob is collected
+    """
+    storage = variant_storage()
+    directory = variant_directory(source)
+    try:
+        _, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for file_name in files:
+        name = f"{directory}/{file_name}"
+        storage.delete(name)
+        cache.delete(CACHE_PREFIX + name)
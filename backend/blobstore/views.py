@@ -0,0 +1,28 @@
+from django.http import Http404, HttpResponseRedirect
+from django.utils.cache import patch_cache_control
+from rest_framework import permissions
+from rest_framework.decorators import api_view, permission_classes
+
+from .models import Blob
+from .variants import ensure_variant, has_variants, parse_token, variant_storage
+
+# Shorter than the life of a signed S3 URL, which the redirect may point at
+REDIRECT_MAX_AGE = 10 * 60
+
+
+@api_view(['GET'])
+@permission_classes([permissions.AllowAny])
+def image_variant(request, token, source):
+    """
+    Redirect to a stored image variant, rendering it on first request.
+    Media files are public, and so are their variants; only configured sizes of stored image blobs are served
+    """
+    spec = parse_token(token)
+    if spec is None or not has_variants(source) or not Blob.objects.filter(key=source).exists():
+        raise Http404
+    name = ensure_variant(source, spec)
+    if name is None:
+        raise Http404
+    response = HttpResponseRedirect(variant_storage().url(name))
+    patch_cache_control(response, public=True, max_age=REDIRECT_MAX_AGE)
+    return response
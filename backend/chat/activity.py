@@ -0,0 +1,72 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from .batching import BatchWriter
+from .models import UserStreak, ActivityLog
+
+logger = logging.getLogger(__name__)
+
+
+class StreakCreditCache:
+    """
+    Per-process record of the last date each user's streak was credited
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries if max_entries is not None else getattr(settings, 'CHAT_STREAK_CACHE_MAX_ENTRIES', 100000)
+        self._credited = {}
+        self._lock = threading.Lock()
+
+    def is_credited(self, user_id, date=None):
+        date = date or timezone.now().date()
+        return self._credited.get(user_id) == date
+
+    def mark_credited(self, user_id, date=None):
+        date = date or timezone.now().date()
+        with self._lock:
+            if len(self._credited) >= self.max_entries:
+                # Entries from previous days are useless; drop them first
+                self._credited = {uid: day for uid, day in self._credited.items() if day == date}
+                if len(self._credited) >= self.max_entries:
+                    self._credited.clear()
+            self._credited[user_id] = date
+
+    def clear(self):
+        with self._lock:
+            self._credited.clear()
+
+
+def credit_streak(user_id, date=None):
+    """
+    Record today's activity on the user's streak
+    """
+    streak, created = UserStreak.objects.get_or_create(user_id=user_id)
+    streak.update_streak(date)
+    return streak
+
+
+def write_activity_logs(entries):
+    ActivityLog.objects.bulk_create(entries)
+
+
+streak_credits = StreakCreditCache()
+activity_buffer = BatchWriter(
+    write_activity_logs,
+    'CHAT_ACTIVITY_BATCH_SIZE', 'CHAT_ACTIVITY_FLUSH_INTERVAL',
+    default_batch_size=100, default_interval=1.0
+)
+
+
+def log_activity(user_id, activity_type, description, metadata=None):
+    """
+    Buffer an ActivityLog row for batched insertion; must be called from the event loop
+    """
+    activity_buffer.add(ActivityLog(
+        user_id=user_id,
+        activity_type=activity_type,
+        description=description,
+        metadata=metadata or {}
+    ))
@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        import atexit
+        from django.db.backends.signals import connection_created
+        from . import signals  # noqa: F401
+        from .metrics import install_query_counter, mark_process_dead, multiprocess_enabled
+
+        connection_created.connect(install_query_counter)
+        if multiprocess_enabled():
+            # Drop this worker's live gauges from the shared metrics directory
+            atexit.register(mark_process_dead)
@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef, Subquery
+from django.utils import timezone
+
+from blobstore.models import Blob
+
+from .models import ChatRoom, ChatMessage, ArchivedMessage, MeetingRequest
+from .search import SQLITE_FTS_TABLE
+
+
+def archive_cutoff(days=None):
+    """
+    Send time before which messages are archived, CHAT_ARCHIVE_AFTER_DAYS ago by default
+    """
+    if days is None:
+        days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180)
+    return timezone.now() - timedelta(days=days)
+
+
+def archivable_messages(cutoff):
+    """
+    Live messages sent before `cutoff` that can leave chat_messages.
+
+    Messages a meeting request or a live reply still points at stay, since
+    deleting them would cascade to those rows; a replied-to message follows
+    once its replies have been archived.
+    """
+    return ChatMessage.objects.filter(created_at__lt=cutoff).exclude(
+        Exists(MeetingRequest.objects.filter(message=OuterRef('pk')))
+    ).exclude(
+        Exists(ChatMessage.objects.filter(reply_to=OuterRef('pk')))
+    )
+
+
+def archive_batch(cutoff, after_id=0, batch_size=1000):
+    """
+    Move the next `batch_size` archivable messages with id > after_id into the archive.
+
+    The copy, the delete and the rooms' archive markers commit together, so
+    an interrupted run leaves every message in exactly one table and a rerun
+    carries on with whatever is still live. Returns (moved, last id), with
+    a last id of None once nothing is left.
+    """
+    with transaction.atomic():
+        messages = list(
+            archivable_messages(cutoff).filter(id__gt=after_id)
+            .select_for_update()
+            .prefetch_related('attachments')
+            .order_by('id')[:batch_size]
+        )
+        if not messages:
+            return 0, None
+
+        archived = [ArchivedMessage.from_message(message) for message in messages]
+        # The archive keeps the attachments' files referenced once their rows are gone
+        Blob.objects.retain(archived_attachment_files(archived))
+        # Cascades to the attachment rows (their files stay in storage) and legacy read statuses.
+        # Deleted before the copy is inserted, so SQLite's search index drops the id before re-adding it
+        ChatMessage.objects.filter(id__in=[message.id for message in messages]).delete()
+        ArchivedMessage.objects.bulk_create(archived)
+
+        # Read back from the archive's (room, seq) and (room, created_at) indexes
+        archived_rooms = ArchivedMessage.objects.filter(room=OuterRef('pk'))
+        ChatRoom.objects.filter(id__in={message.room_id for message in messages}).update(
+            archived_seq=Subquery(archived_rooms.order_by('-seq').values('seq')[:1]),
+            archived_until=Subquery(archived_rooms.order_by('-created_at').values('created_at')[:1])
+        )
+    return len(messages), messages[-1].id
+
+
+def archived_attachment_files(archived_messages):
+    """
+    Storage names of the attachment files `archived_messages` keep in their `extra`
+    """
+    return [
+        attachment['file']
+        for message in archived_messages
+        for attachment in (message.extra or {}).get('attachments', [])
+    ]
+
+
+def optimize_search_index():
+    """
+    Merge SQLite's FTS5 index after a large move, whose deletes and re-inserts leave it fragmented
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}) VALUES ('optimize')")
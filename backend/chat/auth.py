@@ -0,0 +1,111 @@
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+User = get_user_model()
+
+
+class UserSnapshot(namedtuple('UserSnapshot', ['id', 'full_name', 'email', 'user_type'])):
+    """
+    Compact view of an authenticated chat user, reused by every consumer handler
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.get_full_name(), user.email, user.user_type)
+
+    def get_full_name(self):
+        return self.full_name
+
+    def as_sender(self):
+        """
+        Sender block used in serialized messages
+        """
+        return {
+            'id': self.id,
+            'name': self.full_name,
+            'email': self.email
+        }
+
+
+class ConnectionAuthCache:
+    """
+    Per-process LRU cache of user snapshots keyed by access token jti.
+
+    Entries expire after CHAT_AUTH_CACHE_TTL seconds or when the token itself
+    expires, whichever comes first.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'CHAT_AUTH_CACHE_TTL', 300)
+        self.max_entries = max_entries if max_entries is not None else getattr(settings, 'CHAT_AUTH_CACHE_MAX_ENTRIES', 10000)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, jti):
+        with self._lock:
+            entry = self._entries.get(jti)
+            if entry is None:
+                return None
+            expires_at, snapshot = entry
+            if expires_at <= time.time():
+                del self._entries[jti]
+                return None
+            self._entries.move_to_end(jti)
+            return snapshot
+
+    def set(self, jti, snapshot, token_exp):
+        expires_at = min(time.time() + self.ttl, token_exp)
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[jti] = (expires_at, snapshot)
+            self._entries.move_to_end(jti)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+auth_cache = ConnectionAuthCache()
+
+
+def get_token_from_scope(scope):
+    """
+    Extract the access token from the WebSocket query string
+    """
+    query = parse_qs(scope.get('query_string', b'').decode())
+    tokens = query.get('token')
+    return tokens[0] if tokens else None
+
+
+def decode_access_token(token):
+    """
+    Validate a JWT access token, returning None if it is invalid or expired
+    """
+    try:
+        return AccessToken(token)
+    except (InvalidToken, TokenError):
+        return None
+
+
+def load_user_snapshot(user_id):
+    """
+    Load a user snapshot from the database
+    """
+    user = User.objects.only('id', 'first_name', 'last_name', 'email', 'user_type').filter(id=user_id).first()
+    if user is None:
+        return None
+    return UserSnapshot.from_user(user)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """
+    Per-process buffer that hands pending items to `write_batch` in batches.
+
+    A batch is written as soon as `batch_size` items are pending, or
+    `flush_interval` seconds after the first item was buffered. `write_batch`
+    is a sync callable run through database_sync_to_async. Each flush swaps
+    out the pending list under the lock, so every batch has exactly one
+    writer. `write` buffers an item and waits for its batch's result.
+    """
+
+    def __init__(self, write_batch, batch_size_setting, interval_setting, default_batch_size, default_interval):
+        self.write_batch = write_batch
+        self.batch_size_setting = batch_size_setting
+        self.interval_setting = interval_setting
+        self.default_batch_size = default_batch_size
+        self.default_interval = default_interval
+        self._pending = []
+        self._waiters = {}
+        self._flush_handle = None
+        self._flush_loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self):
+        return getattr(settings, self.batch_size_setting, self.default_batch_size)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, self.interval_setting, self.default_interval)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def add(self, item):
+        """
+        Buffer an item; must be called from the event loop
+        """
+        with self._lock:
+            self._pending.append(item)
+            pending = len(self._pending)
+
+        loop = asyncio.get_running_loop()
+        if pending >= self.batch_size:
+            self._cancel_timer()
+            asyncio.ensure_future(self.flush())
+        elif self._flush_handle is None or self._flush_loop is not loop:
+            self._flush_loop = loop
+            self._flush_handle = loop.call_later(self.flush_interval, self._on_timer)
+
+    async def write(self, item):
+        """
+        Buffer an item and wait for its batch to be written; returns what write_batch returned for the batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._waiters[id(item)] = future
+        self.add(item)
+        return await future
+
+    def clear(self):
+        """
+        Drop pending items without writing them
+        """
+        self._cancel_timer()
+        with self._lock:
+            batch, self._pending = self._pending, []
+            futures = [self._waiters.pop(id(item)) for item in batch if id(item) in self._waiters]
+        for future in futures:
+            _call_on_loop(future, future.cancel)
+
+    def _on_timer(self):
+        self._flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    def _cancel_timer(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _take_batch(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        return batch
+
+    def _finish_batch(self, batch, result=None, error=None):
+        # Wake the callers waiting on items of this batch, each on its own loop
+        with self._lock:
+            futures = [self._waiters.pop(id(item)) for item in batch if id(item) in self._waiters]
+        for future in futures:
+            _call_on_loop(future, _settle, future, result, error)
+
+    async def flush(self):
+        """
+        Write every pending item, returning how many were handed to write_batch
+        """
+        batch = self._take_batch()
+        if not batch:
+            return 0
+        result = error = None
+        try:
+            result = await database_sync_to_async(self.write_batch)(batch)
+        except Exception as e:
+            error = e
+            logger.error(f"Batch write of {len(batch)} items failed: {e}")
+        finally:
+            self._finish_batch(batch, result, error)
+        return len(batch)
+
+
+def _call_on_loop(future, callback, *args):
+    loop = future.get_loop()
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(callback, *args)
+
+
+def _settle(future, result, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
@@ -1,11 +1,27 @@
-import json
+import asyncio
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
 from django.contrib.auth import get_user_model
-from rest_framework_simplejwt.tokens import AccessToken
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from .models import ChatRoom, ChatMessage, MessageAttachment, MessageReadStatus, TypingIndicator, MeetingRequest, UserStreak, ActivityLog
+from .activity import streak_credits, credit_streak, log_activity
+from .db import database_unit, run_database_unit
+from .history import missed_messages
+from .metrics import (
+    AUTH_FAILURES, CONNECTIONS, CONNECTS, DISCONNECTS, RATE_LIMITED, frame_label, observe_frame, observe_group_send
+)
+from .outbound import CLOSE_SLOW_CONSUMER, HIGH, LOW, OutboundQueue, frame_priority
+from .auth import auth_cache, get_token_from_scope, decode_access_token, load_user_snapshot
+from .ratelimit import BurstExceeded, RateLimiter
+from .presence import get_presence_backend, parse_user_ids, presence_heartbeat, presence_ttl
+from .rooms import PeerRoomCache, room_group_name, user_group_name
+from .typing import typing_store
+from .wire import JsonCodec, encode_event, negotiate_codec
+from .lifespan import flush_buffers
+from .writebehind import message_buffer
+from .models import ChatRoom, ChatMessage, ArchivedMessage, RoomReadCursor, TypingIndicator, MeetingRequest
+from .serializers import MessageHistorySerializer
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -16,14 +32,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
     WebSocket consumer for real-time chat functionality
     """
     
+    # JSON text frames unless the client negotiates another subprotocol in connect()
+    codec = JsonCodec()
+    
     async def connect(self):
         """
         Connect to WebSocket and authenticate user
         """
         # Get token from query parameters
-        token = self.scope['query_string'].decode().split('token=')[1] if 'token=' in self.scope['query_string'].decode() else None
+        token = get_token_from_scope(self.scope)
         
         if not token:
+            AUTH_FAILURES.labels('missing_token').inc()
             await self.close(code=4001)  # Unauthorized
             return
         
@@ -36,119 +56,270 @@ class ChatConsumer(AsyncWebsocketConsumer):
             
             self.user = user
             self.user_id = user.id
+            self.room_cache = PeerRoomCache()
+            self.rate_limiter = RateLimiter(self.user_id)
+            self.typing_timers = {}
             
             # Join user's personal channel
-            await self.channel_layer.group_add(f"user_{self.user_id}", self.channel_name)
+            await self.channel_layer.group_add(user_group_name(self.user_id), self.channel_name)
             
-            await self.accept()
+            # Join a channel group per group room, so one group_send reaches every online member
+            group_room_ids, streak_credited = await self.load_connection_state()
+            self.group_rooms = set(group_room_ids)
+            for room_id in self.group_rooms:
+                await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
             
-            # Update user streak for login activity
-            await self.update_user_streak()
+            self.codec = negotiate_codec(self.scope.get('subprotocols'))
+            await self.accept(subprotocol=self.codec.subprotocol)
+            
+            # Frames go out through a bounded queue so a slow client cannot stall handlers
+            self.outbound = OutboundQueue(self.write_frame, self.close_slow_consumer)
+            self.outbound.start()
+            CONNECTS.inc()
+            CONNECTIONS.inc()
+            
+            # Count this connection towards the user's presence
+            self.presence = get_presence_backend()
+            await self.presence.add(self.user_id, self.channel_name, presence_ttl())
+            self.presence_task = asyncio.ensure_future(self.presence_heartbeat())
             
-            logger.info(f"User {self.user.get_full_name()} connected to chat")
+            # Login activity; the streak itself was credited with the room lookup
+            if streak_credited:
+                self.log_streak_activity()
+            
+            logger.info(f"User {self.user.full_name} connected to chat")
             
         except Exception as e:
             logger.error(f"WebSocket connection error: {e}")
+            AUTH_FAILURES.labels('error').inc()
             await self.close(code=4001)
     
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        except asyncio.CancelledError:
+            # Daphne's shutdown cancels connections without a websocket.disconnect;
+            # messages already acked to clients must still reach the database
+            try:
+                await flush_buffers()
+            finally:
+                await self.release_connection()
+            raise
+    
     async def disconnect(self, close_code):
         """
         Disconnect from WebSocket
         """
+        await self.release_connection()
+    
+    async def release_connection(self):
+        """
+        Give up the connection's presence, groups and queue, then flush the write buffers; runs once per connection
+        """
+        if getattr(self, 'released', False):
+            return
+        self.released = True
+        if hasattr(self, 'outbound'):
+            self.outbound.stop()
+            DISCONNECTS.inc()
+            CONNECTIONS.dec()
         if hasattr(self, 'user_id'):
-            await self.channel_layer.group_discard(f"user_{self.user_id}", self.channel_name)
+            await self.clear_typing()
+            if hasattr(self, 'presence_task'):
+                self.presence_task.cancel()
+                await self.presence.remove(self.user_id, self.channel_name)
+            for room_id in getattr(self, 'group_rooms', ()):
+                await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+            await self.channel_layer.group_discard(user_group_name(self.user_id), self.channel_name)
             logger.info(f"User {self.user_id} disconnected from chat")
+        await flush_buffers()
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Receive message from WebSocket
         """
         try:
-            data = json.loads(text_data)
+            data = self.codec.decode(text_data, bytes_data)
+        except ValueError:
+            await self.send_error(f"Invalid {self.codec.label}")
+            return
+        
+        try:
             message_type = data.get('type')
             
-            if message_type == 'message':
-                await self.handle_message(data)
-            elif message_type == 'typing':
-                await self.handle_typing(data)
-            elif message_type == 'meeting_request':
-                await self.handle_meeting_request(data)
-            elif message_type == 'meeting_approval':
-                await self.handle_meeting_approval(data)
-            elif message_type == 'read_receipt':
-                await self.handle_read_receipt(data)
-            else:
-                await self.send_error("Unknown message type")
+            # Enforced before any database work the frame would trigger
+            try:
+                retry_after = await self.rate_limiter.check(message_type, data)
+            except BurstExceeded as e:
+                RATE_LIMITED.labels(frame_label(message_type)).inc()
+                await self.send_error(str(e), code='rate_limited', frame_type=message_type, limit=e.burst)
+                return
+            if retry_after:
+                RATE_LIMITED.labels(frame_label(message_type)).inc()
+                await self.send_error(
+                    "Rate limit exceeded",
+                    code='rate_limited',
+                    frame_type=message_type,
+                    retry_after=round(retry_after, 3)
+                )
+                return
+            
+            with observe_frame(message_type):
+                if message_type == 'message':
+                    await self.handle_message(data)
+                elif message_type == 'typing':
+                    await self.handle_typing(data)
+                elif message_type == 'meeting_request':
+                    await self.handle_meeting_request(data)
+                elif message_type == 'meeting_approval':
+                    await self.handle_meeting_approval(data)
+                elif message_type == 'read_receipt':
+                    await self.handle_read_receipt(data)
+                elif message_type == 'read_up_to':
+                    await self.handle_read_up_to(data)
+                elif message_type == 'presence':
+                    await self.handle_presence(data)
+                elif message_type == 'sync':
+                    await self.handle_sync(data)
+                elif message_type == 'batch':
+                    await self.handle_batch(data)
+                else:
+                    await self.send_error("Unknown message type")
                 
-        except json.JSONDecodeError:
-            await self.send_error("Invalid JSON")
         except Exception as e:
             logger.error(f"Error processing message: {e}")
             await self.send_error("Internal server error")
     
     async def handle_message(self, data):
         """
-        Handle regular chat message
+        Handle regular chat message, sent either to a user (`to_user`) or to a group room (`room_id`)
         """
         to_user_id = data.get('to_user')
+        group_room_id = data.get('room_id')
         content = data.get('content', '')
         attachments = data.get('attachments', [])
+        client_msg_id = data.get('client_msg_id')
         
-        if not to_user_id or not content:
-            await self.send_error("Missing required fields")
+        error = self.message_error(data)
+        if error:
+            await self.send_error(error)
             return
         
-        # Get or create chat room
-        room = await self.get_or_create_room(to_user_id)
-        
-        # Create message
-        message = await self.create_message(room, content, attachments)
+        # Create message, either now or through the write-behind buffer
+        if message_buffer.enabled and not attachments:
+            room_id = group_room_id or await self.get_or_create_room(to_user_id)
+            message, created = await message_buffer.add(
+                room_id, self.user_id, content, client_msg_id, sender_name=self.user.get_full_name()
+            )
+        else:
+            message, created = await self.save_message(group_room_id, to_user_id, content, attachments, client_msg_id)
         
-        # Send message to both users
-        await self.channel_layer.group_send(
-            f"user_{to_user_id}",
-            {
-                'type': 'chat_message',
-                'message': await self.serialize_message(message)
-            }
-        )
+        if not created:
+            # Retried send: echo the original message back to the sender only
+            await self.send_frame({
+                'type': 'message',
+                'data': self.serialize_message(message)
+            })
+            return
         
-        await self.channel_layer.group_send(
-            f"user_{self.user_id}",
-            {
-                'type': 'chat_message',
-                'message': await self.serialize_message(message)
-            }
-        )
+        if group_room_id:
+            await self.broadcast_room(group_room_id, 'message', self.serialize_message(message))
+        else:
+            # Send message to both users
+            await self.broadcast([to_user_id, self.user_id], 'message', self.serialize_message(message))
         
         # Update user streak
         await self.update_user_streak()
     
+    def message_error(self, data):
+        """
+        Validation error for a message frame, or None if it is well formed
+        """
+        group_room_id = data.get('room_id')
+        client_msg_id = data.get('client_msg_id')
+        if not (data.get('to_user') or group_room_id) or not data.get('content'):
+            return "Missing required fields"
+        if client_msg_id is not None and (not isinstance(client_msg_id, str) or len(client_msg_id) > 64):
+            return "Invalid client_msg_id"
+        if group_room_id and group_room_id not in self.group_rooms:
+            return "Chat room not found"
+        return None
+    
     async def handle_typing(self, data):
         """
         Handle typing indicator
         """
         to_user_id = data.get('to_user')
-        is_typing = data.get('is_typing', False)
         
         if not to_user_id:
             await self.send_error("Missing to_user field")
             return
         
-        # Update typing indicator
-        await self.update_typing_indicator(to_user_id, is_typing)
+        room_id = await self.get_or_create_room(to_user_id)
+        await self.set_typing(room_id, to_user_id, bool(data.get('is_typing', False)))
+    
+    async def set_typing(self, room_id, to_user_id, is_typing):
+        """
+        Record this user's typing state in a direct room and tell the other participant if it changed
+        """
+        # Coalesce keystroke events; only state changes and periodic refreshes go out
+        if not typing_store.update(room_id, self.user_id, is_typing):
+            return
+        
+        if getattr(settings, 'CHAT_TYPING_PERSIST', False):
+            await self.update_typing_indicator(room_id, is_typing)
+        
+        if is_typing:
+            self.schedule_typing_expiry(room_id, to_user_id, typing_store.ttl)
         
         # Send typing indicator to recipient
-        await self.channel_layer.group_send(
-            f"user_{to_user_id}",
-            {
-                'type': 'typing_indicator',
-                'user_id': self.user_id,
-                'user_name': self.user.get_full_name(),
-                'is_typing': is_typing
-            }
+        await self.send_typing(room_id, to_user_id, is_typing)
+    
+    async def send_typing(self, room_id, to_user_id, is_typing):
+        """
+        Broadcast this user's typing state to the other participant
+        """
+        await self.broadcast([to_user_id], 'typing', {
+            'room_id': room_id,
+            'user_id': self.user_id,
+            'user_name': self.user.full_name,
+            'is_typing': is_typing,
+            'expires_in': typing_store.ttl if is_typing else 0
+        }, coalesce_key=f"typing:{room_id}:{self.user_id}")
+    
+    def schedule_typing_expiry(self, room_id, to_user_id, delay):
+        """
+        Arrange for "stopped typing" to go out if no further typing event arrives
+        """
+        if room_id in self.typing_timers:
+            return
+        loop = asyncio.get_running_loop()
+        self.typing_timers[room_id] = (
+            to_user_id,
+            loop.call_later(delay, self.on_typing_timer, room_id, to_user_id)
         )
     
+    def on_typing_timer(self, room_id, to_user_id):
+        self.typing_timers.pop(room_id, None)
+        remaining = typing_store.remaining(room_id, self.user_id)
+        if remaining is None:
+            return
+        if remaining > 0:
+            self.schedule_typing_expiry(room_id, to_user_id, remaining)
+            return
+        typing_store.discard(room_id, self.user_id)
+        asyncio.ensure_future(self.send_typing(room_id, to_user_id, False))
+    
+    async def clear_typing(self):
+        """
+        Cancel expiry timers and tell peers this user stopped typing
+        """
+        timers, self.typing_timers = getattr(self, 'typing_timers', {}), {}
+        for room_id, (to_user_id, handle) in timers.items():
+            handle.cancel()
+            if typing_store.discard(room_id, self.user_id):
+                await self.send_typing(room_id, to_user_id, False)
+    
     async def handle_meeting_request(self, data):
         """
         Handle meeting request
@@ -161,33 +332,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error("Missing required fields for meeting request")
             return
         
-        # Get or create chat room
-        room = await self.get_or_create_room(to_user_id)
-        
-        # Create meeting request message
-        message = await self.create_meeting_request_message(room, datetime_str, topic)
-        
-        # Create meeting request record
-        meeting_request = await self.create_meeting_request(room, message, datetime_str, topic)
-        
-        # Send meeting request to recipient
-        await self.channel_layer.group_send(
-            f"user_{to_user_id}",
-            {
-                'type': 'meeting_request',
-                'message': await self.serialize_message(message),
-                'meeting_request': await self.serialize_meeting_request(meeting_request)
-            }
-        )
+        # Room, message and meeting request record in one database hop
+        message, meeting_request = await self.create_meeting_request(to_user_id, datetime_str, topic)
         
-        await self.channel_layer.group_send(
-            f"user_{self.user_id}",
-            {
-                'type': 'meeting_request',
-                'message': await self.serialize_message(message),
-                'meeting_request': await self.serialize_meeting_request(meeting_request)
-            }
-        )
+        # Send meeting request to recipient and requester
+        await self.broadcast([to_user_id, self.user_id], 'meeting_request', {
+            'message': self.serialize_message(message),
+            'meeting_request': self.serialize_meeting_request(meeting_request)
+        })
     
     async def handle_meeting_approval(self, data):
         """
@@ -200,35 +352,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error("Invalid meeting approval data")
             return
         
-        # Update meeting request
-        meeting_request = await self.update_meeting_request(meeting_id, status)
+        # Update meeting request and create the approval/rejection message
+        result = await self.respond_to_meeting_request(meeting_id, status)
         
-        if meeting_request:
-            # Create approval/rejection message
-            message = await self.create_meeting_response_message(meeting_request, status)
-            
+        if result:
+            meeting_request, message = result
             # Send to both users
-            await self.channel_layer.group_send(
-                f"user_{meeting_request.requester.id}",
-                {
-                    'type': 'meeting_response',
-                    'message': await self.serialize_message(message),
-                    'meeting_request': await self.serialize_meeting_request(meeting_request)
-                }
-            )
-            
-            await self.channel_layer.group_send(
-                f"user_{meeting_request.recipient.id}",
-                {
-                    'type': 'meeting_response',
-                    'message': await self.serialize_message(message),
-                    'meeting_request': await self.serialize_meeting_request(meeting_request)
-                }
-            )
+            await self.broadcast([meeting_request.requester_id, meeting_request.recipient_id], 'meeting_response', {
+                'message': self.serialize_message(message),
+                'meeting_request': self.serialize_meeting_request(meeting_request)
+            })
     
     async def handle_read_receipt(self, data):
         """
-        Handle read receipt
+        Handle legacy per-message read receipt by moving the room's read cursor up to that message
         """
         message_id = data.get('message_id')
         
@@ -237,113 +374,491 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         
         # Mark message as read
-        await self.mark_message_as_read(message_id)
+        result = await self.mark_message_as_read(message_id)
+        if result:
+            await self.send_read_up_to(*result)
+    
+    async def handle_read_up_to(self, data):
+        """
+        Handle "read up to" receipt: everything in the room up to seq has been read
+        """
+        room_id = data.get('room_id')
+        seq = data.get('seq')
+        
+        error = self.read_up_to_error(data)
+        if error:
+            await self.send_error(error)
+            return
+        
+        result = await self.mark_room_read(room_id, seq)
+        if result is None:
+            await self.send_error("Chat room not found")
+            return
+        await self.send_read_up_to(room_id, *result)
+    
+    @staticmethod
+    def read_up_to_error(data):
+        """
+        Validation error for a read_up_to frame, or None if it is well formed
+        """
+        room_id = data.get('room_id')
+        seq = data.get('seq')
+        if not isinstance(room_id, int) or not isinstance(seq, int) or seq < 0:
+            return "read_up_to requires integer room_id and seq"
+        return None
+    
+    async def handle_batch(self, data):
+        """
+        Handle a batch of operations: {'type': 'batch', 'id': ..., 'ops': [...]}.
+        
+        Supported operations are message, read_receipt, read_up_to and
+        typing frames, at most CHAT_BATCH_MAX_OPS of them. Their database
+        work runs in one transaction with a savepoint per operation, so a
+        failing operation is rolled back and reported on its own. Once the
+        transaction commits, messages are broadcast, read receipts go out
+        once per room with the highest seq, and a single 'batch_ack' frame
+        lists each operation's outcome in order.
+        """
+        ops = data.get('ops')
+        max_ops = getattr(settings, 'CHAT_BATCH_MAX_OPS', 100)
+        if not isinstance(ops, list) or not ops:
+            await self.send_error("batch requires a non-empty ops list")
+            return
+        if len(ops) > max_ops:
+            await self.send_error(f"batch is limited to {max_ops} ops")
+            return
+        
+        results = []
+        read_updates = {}
+        messages_created = False
+        for index, outcome in enumerate(await self.apply_batch(ops)):
+            kind = outcome[0]
+            if kind == 'error':
+                results.append({'index': index, 'ok': False, 'error': outcome[1]})
+            elif kind == 'message':
+                _, message, created, group_room_id, to_user_id = outcome
+                if created:
+                    messages_created = True
+                    if group_room_id:
+                        await self.broadcast_room(message.room_id, 'message', self.serialize_message(message))
+                    else:
+                        await self.broadcast([to_user_id, self.user_id], 'message', self.serialize_message(message))
+                results.append({
+                    'index': index,
+                    'ok': True,
+                    'id': message.id,
+                    'room_id': message.room_id,
+                    'seq': message.seq,
+                    'client_msg_id': message.client_msg_id,
+                    'created': created
+                })
+            elif kind == 'read':
+                _, room_id, seq, participant_ids = outcome
+                if room_id not in read_updates or seq > read_updates[room_id][0]:
+                    read_updates[room_id] = (seq, participant_ids)
+                results.append({'index': index, 'ok': True, 'room_id': room_id, 'seq': seq})
+            else:
+                _, room_id, to_user_id, is_typing = outcome
+                await self.set_typing(room_id, to_user_id, is_typing)
+                results.append({'index': index, 'ok': True, 'room_id': room_id})
+        
+        for room_id, (seq, participant_ids) in read_updates.items():
+            await self.send_read_up_to(room_id, seq, participant_ids)
+        if messages_created:
+            await self.update_user_streak()
+        
+        await self.send_frame({
+            'type': 'batch_ack',
+            'data': {'id': data.get('id'), 'results': results}
+        })
+    
+    def batch_op_error(self, op):
+        """
+        Validation error for one batch operation, or None if it can be applied
+        """
+        if not isinstance(op, dict):
+            return "Invalid operation"
+        op_type = op.get('type')
+        if op_type == 'message':
+            return self.message_error(op)
+        if op_type == 'read_receipt':
+            return None if op.get('message_id') else "Missing message_id"
+        if op_type == 'read_up_to':
+            return self.read_up_to_error(op)
+        if op_type == 'typing':
+            return None if op.get('to_user') else "Missing to_user field"
+        return "Unsupported operation in batch"
+    
+    async def send_read_up_to(self, room_id, seq, participant_ids):
+        """
+        Tell the room's participants (including the reader's other connections) how far the user has read
+        """
+        await self.broadcast(participant_ids, 'read_up_to', {
+            'room_id': room_id,
+            'user_id': self.user_id,
+            'seq': seq
+        }, coalesce_key=f"read_up_to:{room_id}:{self.user_id}")
+    
+    async def broadcast(self, user_ids, frame_type, data, coalesce_key=None):
+        """
+        Encode a frame once and send the same text to each user's channel group
+        """
+        event = self.frame_event(frame_type, data, coalesce_key)
+        for user_id in user_ids:
+            with observe_group_send('user'):
+                await self.channel_layer.group_send(user_group_name(user_id), event)
+    
+    async def broadcast_room(self, room_id, frame_type, data):
+        """
+        Encode a frame once and send it to every connection subscribed to a group room
+        """
+        event = self.frame_event(frame_type, data)
+        with observe_group_send('room'):
+            await self.channel_layer.group_send(room_group_name(room_id), event)
+    
+    @staticmethod
+    def frame_event(frame_type, data, coalesce_key=None):
+        """
+        Channel layer event carrying the frame in each wire encoding and its outbound priority
+        """
+        event = {
+            'type': 'chat.frame',
+            'priority': frame_priority(frame_type),
+            **encode_event({'type': frame_type, 'data': data})
+        }
+        if coalesce_key:
+            event['coalesce'] = coalesce_key
+        return event
+    
+    async def handle_presence(self, data):
+        """
+        Handle bulk online-status query
+        """
+        try:
+            user_ids = parse_user_ids(data.get('user_ids') or [])
+        except (TypeError, ValueError):
+            await self.send_error("Invalid user_ids")
+            return
+        
+        online = await self.presence.aonline(user_ids)
+        await self.send_frame({
+            'type': 'presence',
+            'data': {'online': [user_id for user_id in user_ids if user_id in online]}
+        }, priority=LOW)
+    
+    async def handle_sync(self, data):
+        """
+        Handle reconnect catch-up: {'rooms': {room_id: last seen seq}}.
+        
+        Missed messages are sent as 'sync' frames of at most
+        CHAT_SYNC_BATCH_SIZE messages, capped at CHAT_SYNC_ROOM_LIMIT per
+        room, followed by one 'sync_complete' frame with each room's latest
+        seq and whether more messages remain to be fetched.
+        """
+        rooms = data.get('rooms')
+        max_rooms = getattr(settings, 'CHAT_SYNC_MAX_ROOMS', 200)
+        try:
+            last_seqs = {int(room_id): int(seq) for room_id, seq in rooms.items()}
+        except (AttributeError, TypeError, ValueError):
+            await self.send_error("sync requires rooms as {room_id: last_seq}")
+            return
+        if len(last_seqs) > max_rooms or any(seq < 0 for seq in last_seqs.values()):
+            await self.send_error("Invalid sync request")
+            return
+        
+        if message_buffer.enabled:
+            # Make this node's buffered messages visible to the query
+            await message_buffer.flush()
+        
+        batch_size = getattr(settings, 'CHAT_SYNC_BATCH_SIZE', 50)
+        complete = {}
+        for room_id, room_last_seq, messages, has_more in await self.load_missed_messages(last_seqs):
+            for start in range(0, len(messages), batch_size):
+                await self.outbound.wait_writable()
+                await self.send_frame({
+                    'type': 'sync',
+                    'data': {'room_id': room_id, 'messages': messages[start:start + batch_size]}
+                })
+            complete[room_id] = {'last_seq': room_last_seq, 'has_more': has_more}
+        
+        await self.send_frame({
+            'type': 'sync_complete',
+            'data': {'rooms': complete}
+        })
+    
+    async def presence_heartbeat(self):
+        """
+        Keep this connection's presence entry alive while the socket is open
+        """
+        while True:
+            await asyncio.sleep(presence_heartbeat())
+            try:
+                await self.presence.add(self.user_id, self.channel_name, presence_ttl())
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed for user {self.user_id}: {e}")
+    
+    async def send(self, text_data=None, bytes_data=None, close=False, priority=HIGH, coalesce_key=None):
+        """
+        Queue a frame on the connection's outbound queue instead of writing inline
+        """
+        outbound = getattr(self, 'outbound', None)
+        if outbound is None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        outbound.put(text_data if text_data is not None else bytes_data, priority, coalesce_key)
+    
+    async def send_frame(self, frame, priority=HIGH, coalesce_key=None):
+        """
+        Encode a frame with the connection's negotiated codec and queue it
+        """
+        await self.send_encoded(self.codec.encode(frame), priority, coalesce_key)
+    
+    async def send_encoded(self, data, priority=HIGH, coalesce_key=None):
+        """
+        Queue an already encoded frame as a text or binary message
+        """
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data, priority=priority, coalesce_key=coalesce_key)
+        else:
+            await self.send(text_data=data, priority=priority, coalesce_key=coalesce_key)
+    
+    async def write_frame(self, frame):
+        """
+        Write one queued frame to the WebSocket; called by the outbound queue's writer
+        """
+        if isinstance(frame, bytes):
+            await super().send(bytes_data=frame)
+        else:
+            await super().send(text_data=frame)
+    
+    async def close_slow_consumer(self):
+        """
+        Close a connection whose outbound queue stayed over its cap
+        """
+        logger.warning(
+            f"Closing slow consumer for user {self.user_id}: "
+            f"{self.outbound.depth} frames, {self.outbound.bytes} bytes queued"
+        )
+        await self.close(code=CLOSE_SLOW_CONSUMER)
+        # A client that stopped reading may never complete the close handshake
+        await self.release_connection()
     
     # WebSocket event handlers
+    async def chat_frame(self, event):
+        """
+        Queue a pre-encoded frame for the WebSocket, in this connection's encoding
+        """
+        await self.send_encoded(self.codec.from_event(event), event.get('priority', HIGH), event.get('coalesce'))
+    
+    async def room_membership(self, event):
+        """
+        Subscribe to or unsubscribe from a group room after a membership change
+        """
+        room_id = event['room_id']
+        if event['joined']:
+            await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+            self.group_rooms.add(room_id)
+        else:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+            self.group_rooms.discard(room_id)
+        await self.send_frame({
+            'type': 'room_membership',
+            'data': {'room_id': room_id, 'joined': event['joined']}
+        })
+    
+    # The per-type handlers below still accept dict payloads from nodes
+    # running the previous event format during a rolling deploy
     async def chat_message(self, event):
         """
         Send chat message to WebSocket
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'message',
             'data': event['message']
-        }))
+        })
     
     async def typing_indicator(self, event):
         """
         Send typing indicator to WebSocket
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'typing',
             'data': {
                 'user_id': event['user_id'],
                 'user_name': event['user_name'],
                 'is_typing': event['is_typing']
             }
-        }))
+        }, priority=LOW)
     
     async def meeting_request(self, event):
         """
         Send meeting request to WebSocket
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'meeting_request',
             'data': {
                 'message': event['message'],
                 'meeting_request': event['meeting_request']
             }
-        }))
+        })
     
     async def meeting_response(self, event):
         """
         Send meeting response to WebSocket
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'meeting_response',
             'data': {
                 'message': event['message'],
                 'meeting_request': event['meeting_request']
             }
-        }))
+        })
     
-    async def send_error(self, message):
+    async def send_error(self, message, **details):
         """
-        Send error message to WebSocket
+        Send error message to WebSocket, with optional machine-readable details such as a code
         """
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'error',
-            'message': message
-        }))
+            'message': message,
+            **details
+        })
     
-    # Database operations
-    @database_sync_to_async
-    def authenticate_user(self, token):
+    async def authenticate_user(self, token):
         """
-        Authenticate user from JWT token
+        Authenticate user from JWT token, reusing the cached snapshot for a known jti
         """
-        try:
-            access_token = AccessToken(token)
-            user_id = access_token['user_id']
-            return User.objects.get(id=user_id)
-        except (InvalidToken, TokenError, User.DoesNotExist):
+        access_token = decode_access_token(token)
+        if access_token is None:
+            AUTH_FAILURES.labels('invalid_token').inc()
             return None
+        
+        jti = access_token.get('jti')
+        user = auth_cache.get(jti) if jti else None
+        if user is None:
+            user = await run_database_unit(load_user_snapshot, access_token.get('user_id'))
+            if user is None:
+                AUTH_FAILURES.labels('unknown_user').inc()
+            elif jti:
+                auth_cache.set(jti, user, access_token['exp'])
+        return user
     
-    @database_sync_to_async
-    def get_or_create_room(self, other_user_id):
+    async def get_or_create_room(self, other_user_id):
         """
-        Get or create chat room between two users
+        Get the id of the direct room with another user, creating the room if needed
         """
-        other_user = User.objects.get(id=other_user_id)
-        
-        # Check if room already exists
-        existing_rooms = ChatRoom.objects.filter(
-            participants=self.user
-        ).filter(
-            participants=other_user
-        ).filter(room_type='direct')
-        
-        if existing_rooms.exists():
-            return existing_rooms.first()
+        room_id = self.room_cache.get(int(other_user_id))
+        if room_id is None:
+            room_id = await run_database_unit(self.direct_room_id, other_user_id)
+        return room_id
+    
+    def direct_room_id(self, other_user_id):
+        other_user_id = int(other_user_id)
+        room_id = self.room_cache.get(other_user_id)
+        if room_id is None:
+            # Foreign keys are checked at commit, which would fail a whole batch
+            if not User.objects.filter(id=other_user_id).exists():
+                raise User.DoesNotExist(f"User {other_user_id} not found")
+            room_id = ChatRoom.get_or_create_direct(self.user_id, other_user_id).id
+            # A batch op's savepoint may still roll the room back, dropping this callback with it
+            transaction.on_commit(lambda: self.room_cache.set(other_user_id, room_id))
+        return room_id
+    
+    # Database operations
+    @database_unit
+    def load_connection_state(self):
+        """
+        Ids of the group rooms this user belongs to, crediting today's streak in the same hop.
         
-        # Create new room
-        room = ChatRoom.objects.create(
-            room_type='direct',
-            created_by=self.user
+        Returns (room_ids, streak_credited).
+        """
+        room_ids = list(
+            ChatRoom.objects.filter(participants=self.user_id, room_type='group').values_list('id', flat=True)
         )
-        room.participants.add(self.user, other_user)
-        return room
+        return room_ids, self.credit_streak_today()
     
-    @database_sync_to_async
-    def create_message(self, room, content, attachments=None):
+    @database_unit
+    def apply_batch(self, ops):
         """
-        Create chat message
+        Apply a batch's operations in one transaction, each in its own savepoint.
+        
+        Returns one outcome per operation:
+        - ('error', reason)
+        - ('message', message, created, group_room_id, to_user_id)
+        - ('read', room_id, seq, participant_ids)
+        - ('typing', room_id, to_user_id, is_typing)
         """
-        message = ChatMessage.objects.create(
-            room=room,
-            sender=self.user,
-            content=content,
-            message_type='message'
-        )
+        outcomes = []
+        with transaction.atomic():
+            for op in ops:
+                try:
+                    error = self.batch_op_error(op)
+                    if error:
+                        outcomes.append(('error', error))
+                        continue
+                    with transaction.atomic():
+                        outcomes.append(self.apply_batch_op(op))
+                except User.DoesNotExist:
+                    outcomes.append(('error', "User not found"))
+                except Exception as e:
+                    logger.error(f"Batch operation failed for user {self.user_id}: {e}")
+                    outcomes.append(('error', "Operation failed"))
+        return outcomes
+    
+    def apply_batch_op(self, op):
+        op_type = op['type']
+        if op_type == 'message':
+            group_room_id = op.get('room_id')
+            room_id = group_room_id or self.direct_room_id(op['to_user'])
+            message, created = self._create_message(
+                room_id, op['content'], op.get('attachments'), op.get('client_msg_id')
+            )
+            return ('message', message, created, group_room_id, op.get('to_user'))
+        if op_type == 'read_receipt':
+            result = self._mark_message_as_read(op['message_id'])
+            return ('read',) + result if result else ('error', "Message not found")
+        if op_type == 'read_up_to':
+            result = self._advance_read_cursor(op['room_id'], op['seq'])
+            return ('read', op['room_id']) + result if result else ('error', "Chat room not found")
+        to_user_id = int(op['to_user'])
+        return ('typing', self.direct_room_id(to_user_id), to_user_id, bool(op.get('is_typing', False)))
+    
+    @database_unit
+    def create_message(self, room_id, content, attachments=None, client_msg_id=None):
+        """
+        Create chat message, returning (message, created)
+        """
+        return self._create_message(room_id, content, attachments, client_msg_id)
+    
+    @database_unit
+    def save_message(self, group_room_id, to_user_id, content, attachments=None, client_msg_id=None):
+        """
+        Create a message in a group room, or in the direct room with to_user_id, returning (message, created)
+        """
+        room_id = group_room_id or self.direct_room_id(to_user_id)
+        return self._create_message(room_id, content, attachments, client_msg_id)
+    
+    def _create_message(self, room_id, content, attachments=None, client_msg_id=None):
+        if client_msg_id:
+            existing = ChatMessage.objects.filter(sender_id=self.user_id, client_msg_id=client_msg_id).first()
+            if existing:
+                return existing, False
+        
+        try:
+            with transaction.atomic():
+                message = ChatMessage.objects.create(
+                    room_id=room_id,
+                    sender_id=self.user_id,
+                    sender_name=self.user.get_full_name(),
+                    content=content,
+                    message_type='message',
+                    client_msg_id=client_msg_id or None
+                )
+        except IntegrityError:
+            if not client_msg_id:
+                raise
+            # Lost a race against the same retried send
+            return ChatMessage.objects.get(sender_id=self.user_id, client_msg_id=client_msg_id), False
         
         # Handle attachments if provided
         if attachments:
@@ -351,55 +866,58 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 # In a real implementation, you'd handle file uploads here
                 pass
         
-        return message
-    
-    @database_sync_to_async
-    def create_meeting_request_message(self, room, datetime_str, topic):
-        """
-        Create meeting request message
-        """
-        from datetime import datetime
-        
-        message = ChatMessage.objects.create(
-            room=room,
-            sender=self.user,
-            content=f"Meeting request: {topic}",
-            message_type='meeting_request',
-            meeting_datetime=datetime.fromisoformat(datetime_str.replace('Z', '+00:00')),
-            meeting_topic=topic,
-            meeting_status='pending'
-        )
-        
-        return message
+        return message, True
     
-    @database_sync_to_async
-    def create_meeting_request(self, room, message, datetime_str, topic):
+    @database_unit
+    def create_meeting_request(self, to_user_id, datetime_str, topic):
         """
-        Create meeting request record
+        Create a meeting request and its message in the direct room; returns (message, meeting_request)
         """
         from datetime import datetime
         
-        recipient = room.participants.exclude(id=self.user_id).first()
+        meeting_datetime = datetime.fromisoformat(datetime_str.replace('Z', '+00:00'))
+        room_id = self.direct_room_id(to_user_id)
+        recipient = User.objects.only('id', 'first_name', 'last_name').get(id=to_user_id)
         
-        meeting_request = MeetingRequest.objects.create(
-            requester=self.user,
-            recipient=recipient,
-            room=room,
-            message=message,
-            datetime=datetime.fromisoformat(datetime_str.replace('Z', '+00:00')),
-            topic=topic,
-            status='pending'
-        )
+        with transaction.atomic():
+            message = ChatMessage.objects.create(
+                room_id=room_id,
+                sender_id=self.user_id,
+                sender_name=self.user.get_full_name(),
+                content=f"Meeting request: {topic}",
+                message_type='meeting_request',
+                meeting_datetime=meeting_datetime,
+                meeting_topic=topic,
+                meeting_status='pending'
+            )
+            meeting_request = MeetingRequest.objects.create(
+                requester_id=self.user_id,
+                recipient=recipient,
+                room_id=room_id,
+                message=message,
+                datetime=meeting_datetime,
+                topic=topic,
+                status='pending'
+            )
         
-        return meeting_request
+        return message, meeting_request
     
-    @database_sync_to_async
-    def update_meeting_request(self, meeting_id, status):
+    @database_unit
+    def respond_to_meeting_request(self, meeting_id, status):
         """
-        Update meeting request status
+        Update a meeting request's status and create the approval/rejection message.
+        
+        Returns (meeting_request, message), or None if there is no such request.
         """
-        try:
-            meeting_request = MeetingRequest.objects.get(id=meeting_id)
+        status_text = "approved" if status == "approved" else "rejected"
+        
+        with transaction.atomic():
+            try:
+                meeting_request = MeetingRequest.objects.select_related(
+                    'requester', 'recipient', 'message'
+                ).get(id=meeting_id)
+            except MeetingRequest.DoesNotExist:
+                return None
             meeting_request.status = status
             meeting_request.save()
             
@@ -407,39 +925,27 @@ class ChatConsumer(AsyncWebsocketConsumer):
             meeting_request.message.meeting_status = status
             meeting_request.message.save()
             
-            return meeting_request
-        except MeetingRequest.DoesNotExist:
-            return None
-    
-    @database_sync_to_async
-    def create_meeting_response_message(self, meeting_request, status):
-        """
-        Create meeting response message
-        """
-        status_text = "approved" if status == "approved" else "rejected"
-        
-        message = ChatMessage.objects.create(
-            room=meeting_request.room,
-            sender=self.user,
-            content=f"Meeting {status_text}: {meeting_request.topic}",
-            message_type=f'meeting_{status_text}',
-            meeting_datetime=meeting_request.datetime,
-            meeting_topic=meeting_request.topic,
-            meeting_status=status
-        )
+            message = ChatMessage.objects.create(
+                room_id=meeting_request.room_id,
+                sender_id=self.user_id,
+                sender_name=self.user.get_full_name(),
+                content=f"Meeting {status_text}: {meeting_request.topic}",
+                message_type=f'meeting_{status_text}',
+                meeting_datetime=meeting_request.datetime,
+                meeting_topic=meeting_request.topic,
+                meeting_status=status
+            )
         
-        return message
+        return meeting_request, message
     
-    @database_sync_to_async
-    def update_typing_indicator(self, to_user_id, is_typing):
+    @database_unit
+    def update_typing_indicator(self, room_id, is_typing):
         """
-        Update typing indicator
+        Persist typing indicator (only when CHAT_TYPING_PERSIST is enabled)
         """
-        room = self.get_or_create_room(to_user_id)
-        
         typing_indicator, created = TypingIndicator.objects.get_or_create(
-            room=room,
-            user=self.user,
+            room_id=room_id,
+            user_id=self.user_id,
             defaults={'is_typing': is_typing}
         )
         
@@ -447,47 +953,98 @@ class ChatConsumer(AsyncWebsocketConsumer):
             typing_indicator.is_typing = is_typing
             typing_indicator.save()
     
-    @database_sync_to_async
-    def mark_message_as_read(self, message_id):
+    @database_unit
+    def load_missed_messages(self, last_seqs):
         """
-        Mark message as read
+        Load and serialize missed messages for handle_sync
         """
-        try:
-            message = ChatMessage.objects.get(id=message_id)
-            MessageReadStatus.objects.get_or_create(
-                message=message,
-                user=self.user
+        limit = getattr(settings, 'CHAT_SYNC_ROOM_LIMIT', 200)
+        return [
+            (
+                room_id,
+                room_last_seq,
+                MessageHistorySerializer(messages, many=True, context={'last_read_seq': read_seq}).data,
+                has_more
             )
-        except ChatMessage.DoesNotExist:
-            pass
+            for room_id, room_last_seq, read_seq, messages, has_more in missed_messages(self.user_id, last_seqs, limit)
+        ]
     
-    @database_sync_to_async
-    def update_user_streak(self):
+    @database_unit
+    def mark_message_as_read(self, message_id):
         """
-        Update user streak for activity
+        Mark a room as read up to the given message; returns (room_id, seq, participant_ids) or None
         """
-        streak, created = UserStreak.objects.get_or_create(user=self.user)
-        streak.update_streak()
-        
-        # Log activity
-        ActivityLog.objects.create(
-            user=self.user,
-            activity_type='login',
-            description='User connected to chat'
+        return self._mark_message_as_read(message_id)
+    
+    def _mark_message_as_read(self, message_id):
+        message = ChatMessage.objects.filter(
+            id=message_id, room__participants=self.user_id
+        ).values('room_id', 'seq').first()
+        if message is None:
+            # A receipt for a message shown from history may name an archived one
+            message = ArchivedMessage.objects.filter(
+                id=message_id, room__participants=self.user_id
+            ).values('room_id', 'seq').first()
+        if message is None:
+            return None
+        result = self._advance_read_cursor(message['room_id'], message['seq'])
+        if result is None:
+            return None
+        return (message['room_id'],) + result
+    
+    @database_unit
+    def mark_room_read(self, room_id, seq):
+        """
+        Mark a room as read up to seq; returns (seq, participant_ids) or None if not a participant
+        """
+        return self._advance_read_cursor(room_id, seq)
+    
+    def _advance_read_cursor(self, room_id, seq):
+        participant_ids = list(
+            ChatRoom.participants.through.objects.filter(chatroom_id=room_id).values_list('user_id', flat=True)
         )
+        if self.user_id not in participant_ids:
+            return None
+        # Never mark messages that do not exist yet as read
+        last_seq = ChatRoom.objects.filter(id=room_id).values_list('last_seq', flat=True).first() or 0
+        seq = min(seq, last_seq)
+        RoomReadCursor.advance(room_id, self.user_id, seq)
+        return seq, participant_ids
+    
+    async def update_user_streak(self):
+        """
+        Update user streak for activity, at most once per user per day in this process
+        """
+        if streak_credits.is_credited(self.user_id, timezone.now().date()):
+            return
+        
+        if await run_database_unit(self.credit_streak_today):
+            self.log_streak_activity()
+    
+    def credit_streak_today(self):
+        """
+        Credit today's streak unless this process already has; returns True if it did
+        """
+        today = timezone.now().date()
+        if streak_credits.is_credited(self.user_id, today):
+            return False
+        credit_streak(self.user_id, today)
+        streak_credits.mark_credited(self.user_id, today)
+        return True
+    
+    def log_streak_activity(self):
+        log_activity(self.user_id, 'login', 'User connected to chat')
     
-    @database_sync_to_async
     def serialize_message(self, message):
         """
-        Serialize message for JSON response
+        Serialize a message sent by this connection's user for JSON response
         """
         return {
             'id': message.id,
-            'sender': {
-                'id': message.sender.id,
-                'name': message.sender.get_full_name(),
-                'email': message.sender.email
-            },
+            'room_id': message.room_id,
+            'seq': message.seq,
+            'client_msg_id': message.client_msg_id,
+            'sender': self.user.as_sender(),
             'content': message.content,
             'message_type': message.message_type,
             'created_at': message.created_at.isoformat(),
@@ -498,21 +1055,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             } if message.message_type.startswith('meeting') else None
         }
     
-    @database_sync_to_async
+    def serialize_participant(self, meeting_request, field):
+        """
+        Serialize a meeting participant, using the cached snapshot for this user
+        """
+        user_id = getattr(meeting_request, f'{field}_id')
+        if user_id == self.user_id:
+            return {'id': self.user_id, 'name': self.user.full_name}
+        user = getattr(meeting_request, field)
+        return {'id': user.id, 'name': user.get_full_name()}
+    
     def serialize_meeting_request(self, meeting_request):
         """
-        Serialize meeting request for JSON response
+        Serialize meeting request for JSON response.
+        
+        The participant other than this user must already be loaded.
         """
         return {
             'id': meeting_request.id,
-            'requester': {
-                'id': meeting_request.requester.id,
-                'name': meeting_request.requester.get_full_name()
-            },
-            'recipient': {
-                'id': meeting_request.recipient.id,
-                'name': meeting_request.recipient.get_full_name()
-            },
+            'requester': self.serialize_participant(meeting_request, 'requester'),
+            'recipient': self.serialize_participant(meeting_request, 'recipient'),
             'datetime': meeting_request.datetime.isoformat(),
             'topic': meeting_request.topic,
             'status': meeting_request.status,
@@ -0,0 +1,37 @@
+import functools
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from alumni_backend.executor import get_executor
+
+
+def get_database_executor():
+    """
+    The chat database thread pool, or None when CHAT_DB_THREADS is 0.
+
+    Each pool thread keeps its own database connection for
+    DB_EXECUTOR_CONN_MAX_AGE seconds, so the pool size is also the number of
+    connections chat holds per process.
+    """
+    return get_executor('chat', getattr(settings, 'CHAT_DB_THREADS', 0))
+
+
+async def run_database_unit(func, *args, **kwargs):
+    """
+    Run sync database code in one thread hop: on the chat pool if configured, else Django's thread-sensitive thread
+    """
+    executor = get_database_executor()
+    if executor is None:
+        return await database_sync_to_async(func)(*args, **kwargs)
+    return await database_sync_to_async(func, thread_sensitive=False, executor=executor)(*args, **kwargs)
+
+
+def database_unit(func):
+    """
+    Decorator for a frame's database work, which should be one unit so a frame costs a single hop
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_database_unit(func, *args, **kwargs)
+    return wrapper
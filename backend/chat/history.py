@@ -0,0 +1,160 @@
+import base64
+import binascii
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ChatRoom, ChatMessage, ArchivedMessage, RoomReadCursor
+
+
+def encode_cursor(message):
+    """
+    Opaque pagination cursor for a message's (created_at, id) position
+    """
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Parse a cursor back into (created_at, id), raising ValueError on bad input
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split('|')
+        created_at = datetime.fromisoformat(created_at)
+        message_id = int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    if timezone.is_naive(created_at):
+        created_at = timezone.make_aware(created_at, dt_timezone.utc)
+    return created_at, message_id
+
+
+def page_limit(value):
+    """
+    Page size from a request parameter, capped at CHAT_HISTORY_MAX_PAGE_SIZE
+    """
+    default = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+    if value in (None, ''):
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid limit") from e
+    if limit < 1:
+        raise ValueError("Invalid limit")
+    return min(limit, maximum)
+
+
+def history_page(room_id, before=None, after=None, limit=50, archived_until=None):
+    """
+    One page of a room's messages in chronological order, keyed on (created_at, id).
+
+    With `after`, returns the messages following that cursor; otherwise the
+    messages preceding `before`, or the newest messages when neither is
+    given. Returns (messages, has_more), where has_more says whether another
+    page exists further in the paging direction.
+
+    `archived_until` is the room's ChatRoom.archived_until. Pages that may
+    reach back to it also read ArchivedMessage and merge the two.
+    """
+    messages = (
+        ChatMessage.objects.filter(room_id=room_id)
+        .select_related('sender')
+        .prefetch_related('attachments')
+    )
+    page = list(_keyset(messages, before, after)[:limit + 1])
+    if archived_until is not None and _may_reach_archive(page, limit, after, archived_until):
+        archived = ArchivedMessage.objects.filter(room_id=room_id).select_related('sender')
+        page += list(_keyset(archived, before, after)[:limit + 1 - _newer_than_archive(page, after, archived_until)])
+        page.sort(key=lambda message: (message.created_at, message.id), reverse=after is None)
+    has_more = len(page) > limit
+    page = page[:limit]
+    if after is None:
+        page.reverse()
+    return page, has_more
+
+
+def _keyset(messages, before, after):
+    # Newest first, except when paging forward from `after`
+    if after is not None:
+        created_at, message_id = decode_cursor(after)
+        return messages.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+        ).order_by('created_at', 'id')
+    if before is not None:
+        created_at, message_id = decode_cursor(before)
+        messages = messages.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+        )
+    return messages.order_by('-created_at', '-id')
+
+
+def _may_reach_archive(page, limit, after, archived_until):
+    # Archived messages are no newer than archived_until, so a full page of
+    # newer live messages, or a forward page starting past it, cannot include any
+    if after is not None:
+        return decode_cursor(after)[0] <= archived_until
+    return len(page) <= limit or page[-1].created_at <= archived_until
+
+
+def _newer_than_archive(page, after, archived_until):
+    # Live messages past archived_until sort ahead of every archived one on a
+    # backward page, so the archive only has to fill the rest of it
+    if after is not None:
+        return 0
+    return sum(1 for message in page if message.created_at > archived_until)
+
+
+def missed_messages(user_id, last_seqs, limit):
+    """
+    Messages a reconnecting client missed, given {room_id: last seen seq}.
+    
+    Rooms the user is not in are ignored. Returns a list of
+    (room_id, room_last_seq, last_read_seq, messages, has_more) in room id
+    order, with at most `limit` messages per room in seq order. Clients
+    that last synced before a room's archived_seq are also sent the
+    archived messages they missed.
+    """
+    rooms = {
+        room_id: (room_last_seq, archived_seq)
+        for room_id, room_last_seq, archived_seq in
+        ChatRoom.objects.filter(id__in=list(last_seqs), participants=user_id)
+        .order_by('id').values_list('id', 'last_seq', 'archived_seq')
+    }
+    read_seqs = dict(
+        RoomReadCursor.objects.filter(room_id__in=list(rooms), user_id=user_id)
+        .values_list('room_id', 'last_read_seq')
+    )
+    results = []
+    for room_id, (room_last_seq, archived_seq) in rooms.items():
+        messages, has_more = [], False
+        # last_seq is an upper bound on handed-out seqs, so nothing newer can exist past it
+        if last_seqs[room_id] < room_last_seq:
+            messages = list(
+                ChatMessage.objects.filter(room_id=room_id, seq__gt=last_seqs[room_id])
+                .select_related('sender')
+                .prefetch_related('attachments')
+                .order_by('seq')[:limit + 1]
+            )
+            if last_seqs[room_id] < archived_seq:
+                messages += list(
+                    ArchivedMessage.objects.filter(room_id=room_id, seq__gt=last_seqs[room_id])
+                    .select_related('sender')
+                    .order_by('seq')[:limit + 1]
+                )
+                messages.sort(key=lambda message: message.seq)
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+        results.append((room_id, room_last_seq, read_seqs.get(room_id, 0), messages, has_more))
+    return results
+
+
+def last_read_seq(room_id, user_id):
+    return RoomReadCursor.objects.filter(
+        room_id=room_id, user_id=user_id
+    ).values_list('last_read_seq', flat=True).first() or 0
@@ -0,0 +1,148 @@
+import bisect
+import hashlib
+import itertools
+
+from channels_redis.core import RedisChannelLayer
+from channels_redis.utils import decode_hosts
+
+
+class HashRing:
+    """
+    Consistent-hash ring with virtual nodes.
+
+    Each shard is placed on the ring `replicas` times, so keys spread evenly
+    and adding a shard to N existing ones moves only about 1/(N+1) of the
+    keys, all of them onto the new shard.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        points = sorted(
+            (self.hash(f"{node}#{replica}"), index)
+            for index, node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+    def get_index(self, value):
+        position = bisect.bisect(self._hashes, self.hash(value)) % len(self._hashes)
+        return self._indexes[position]
+
+
+def shard_name(host, index):
+    """
+    Stable name for a host entry; the ring is built from names, not list positions
+    """
+    if 'address' in host:
+        return host['address']
+    if 'host' in host:
+        return f"{host['host']}:{host.get('port', 6379)}"
+    return f"shard{index}"
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer that places groups and channels on shards by consistent hashing.
+
+    channels_redis already supports several hosts, but picks one by taking a
+    CRC modulo the host count, so adding a host remaps nearly every group.
+    Here the ring is keyed by shard name. When hosts are added or removed,
+    list the old ring in `previous_hosts` for the duration of the change:
+    - group_send first moves a group's members from its old shard to its
+      new owner
+    - group_discard removes from both shards
+    - `manage.py rebalance_channel_layer` moves all remaining groups in one
+      pass, after which `previous_hosts` can be dropped
+
+    Messages already queued for a channel on its old shard are not moved.
+    They expire within `expiry` seconds, and reconnecting clients catch up
+    with the 'sync' frame.
+    """
+
+    def __init__(self, hosts=None, shard_names=None, previous_hosts=None, replicas=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        current = list(self.hosts)
+        names = list(shard_names) if shard_names else [shard_name(host, i) for i, host in enumerate(current)]
+        if len(names) != len(current):
+            raise ValueError("shard_names must name every host")
+
+        previous_names = []
+        if previous_hosts:
+            hosts_by_name = dict(zip(names, current))
+            for i, host in enumerate(decode_hosts(previous_hosts)):
+                name = shard_name(host, i)
+                previous_names.append(name)
+                if name not in hosts_by_name:
+                    # A shard being removed: still reachable while it drains
+                    hosts_by_name[name] = host
+                    names.append(name)
+                    self.hosts.append(host)
+
+        self.shard_names = names
+        self.ring_size = len(self.hosts)
+        self.ring = HashRing(enumerate(names[:len(current)]), replicas)
+        self.previous_ring = None
+        if previous_names:
+            self.previous_ring = HashRing(((names.index(name), name) for name in previous_names), replicas)
+        # General (non-process-local) channels only use shards in the current ring
+        self._receive_index_generator = itertools.cycle(range(len(current)))
+        self._send_index_generator = itertools.cycle(range(len(current)))
+
+    def consistent_hash(self, value):
+        return self.ring.get_index(value)
+
+    def previous_hash(self, value):
+        """
+        Shard index that owned the value before the ring changed, or None outside a rebalance
+        """
+        if self.previous_ring is None:
+            return None
+        return self.previous_ring.get_index(value)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        previous = self.previous_hash(group)
+        if previous is not None and previous != self.consistent_hash(group):
+            await self.connection(previous).zrem(self._group_key(group), channel)
+
+    async def group_send(self, group, message):
+        previous = self.previous_hash(group)
+        if previous is not None and previous != self.consistent_hash(group):
+            await self.move_group(group, previous)
+        await super().group_send(group, message)
+
+    async def move_group(self, group, from_index):
+        """
+        Merge a group's members from one shard into the group's current owner
+        """
+        key = self._group_key(group)
+        source = self.connection(from_index)
+        members = await source.zrange(key, 0, -1, withscores=True)
+        if not members:
+            return 0
+        target = self.connection(self.consistent_hash(group))
+        await target.zadd(key, dict(members))
+        await target.expire(key, self.group_expiry)
+        await source.delete(key)
+        return len(members)
+
+    async def rebalance(self):
+        """
+        Move every group stored on a shard other than its current owner; returns (groups, members) moved
+        """
+        prefix = f"{self.prefix}:group:"
+        groups = members = 0
+        for index in range(self.ring_size):
+            connection = self.connection(index)
+            async for key in connection.scan_iter(match=f"{prefix}*"):
+                group = key.decode('utf8')[len(prefix):]
+                if self.consistent_hash(group) != index:
+                    groups += 1
+                    members += await self.move_group(group, index)
+        return groups, members
@@ -0,0 +1,40 @@
+import logging
+
+from .activity import activity_buffer
+from .writebehind import message_buffer
+
+logger = logging.getLogger(__name__)
+
+
+async def flush_buffers():
+    """
+    Write out the activity logs and write-behind messages still buffered in this process
+    """
+    await activity_buffer.flush()
+    if message_buffer.enabled:
+        await message_buffer.flush()
+
+
+class LifespanApplication:
+    """
+    ASGI lifespan handler that flushes the buffers before the server exits.
+
+    For servers that send lifespan events (uvicorn, hypercorn). Daphne sends
+    none: it cancels every connection instead, and ChatConsumer flushes
+    when it is cancelled.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await flush_buffers()
+                except Exception as e:
+                    logger.error(f"Flushing chat buffers at shutdown failed: {e}")
+                    await send({'type': 'lifespan.shutdown.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
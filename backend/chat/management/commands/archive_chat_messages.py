@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.archive import archivable_messages, archive_batch, archive_cutoff, optimize_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Move chat messages older than CHAT_ARCHIVE_AFTER_DAYS from chat_messages to chat_message_archive. '
+        'Each batch commits on its own, so the command can be stopped and rerun at any time.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help='Archive messages sent more than this many days ago (default: CHAT_ARCHIVE_AFTER_DAYS)')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Messages moved per transaction (default: CHAT_ARCHIVE_BATCH_SIZE)')
+        parser.add_argument('--max-batches', type=int, default=0,
+                            help='Stop after this many batches; 0 runs until nothing is left')
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches, leaving the database to live traffic')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the messages that would be archived')
+
+    def handle(self, *args, **options):
+        days = options['older_than_days']
+        if days is None:
+            days = getattr(settings, 'CHAT_ARCHIVE_AFTER_DAYS', 180)
+        if days < 1:
+            raise CommandError('--older-than-days must be at least 1')
+        batch_size = options['batch_size'] or getattr(settings, 'CHAT_ARCHIVE_BATCH_SIZE', 1000)
+        # Fixed for the whole run, so the run ends even while new messages age past it
+        cutoff = archive_cutoff(days)
+
+        if options['dry_run']:
+            count = archivable_messages(cutoff).count()
+            self.stdout.write(f"{count} messages sent before {cutoff:%Y-%m-%d %H:%M} would be archived")
+            return
+
+        archived = 0
+        batches = 0
+        last_id = 0
+        while True:
+            moved, last_id = archive_batch(cutoff, after_id=last_id, batch_size=batch_size)
+            if not moved:
+                break
+            archived += moved
+            batches += 1
+            self.stdout.write(f"Archived {archived} messages, up to id {last_id}")
+            if options['max_batches'] and batches >= options['max_batches']:
+                break
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if archived:
+            optimize_search_index()
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} messages sent before {cutoff:%Y-%m-%d %H:%M}"
+        ))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from chat.models import ChatRoom, ChatMessage
+
+
+class Command(BaseCommand):
+    help = 'Fill in ChatRoom.last_message snapshots for rooms created before they existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rooms to process per batch')
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute snapshots for every room, not just rooms without one')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        rooms = ChatRoom.objects.order_by('id')
+        if not options['all']:
+            rooms = rooms.filter(last_message__isnull=True)
+
+        updated = 0
+        last_id = 0
+        while True:
+            room_ids = list(rooms.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+            if not room_ids:
+                break
+            for room_id in room_ids:
+                message = (
+                    ChatMessage.objects.filter(room_id=room_id)
+                    .select_related('sender')
+                    .order_by('-seq')
+                    .first()
+                )
+                if message is None:
+                    continue
+                # Not ChatRoom.record_last_message: --all must be able to rewrite an equal seq
+                updated += ChatRoom.objects.filter(
+                    id=room_id, last_message_seq__lte=message.seq
+                ).update(last_message=message.snapshot(), last_message_seq=message.seq)
+            last_id = room_ids[-1]
+            self.stdout.write(f"Processed rooms up to id {last_id}")
+
+        self.stdout.write(self.style.SUCCESS(f"Updated last-message snapshots for {updated} rooms"))
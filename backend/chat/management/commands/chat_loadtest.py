@@ -0,0 +1,579 @@
+import asyncio
+import collections
+import json
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from benchmarks.common import percentile
+from chat.routing import websocket_urlpatterns
+from chat.wire import MSGPACK_SUBPROTOCOL, JsonCodec, MsgpackCodec
+
+User = get_user_model()
+
+FRAME_TYPES = ('message', 'typing', 'read_receipt', 'meeting_request', 'meeting_approval')
+DEFAULT_MIX = 'message=60,typing=25,read_receipt=10,meeting_request=3,meeting_approval=2'
+# Typing changes may be coalesced or expired by the server, so a missing one is not a loss
+CONFIRMED_TYPES = ('message', 'read_receipt', 'meeting_request', 'meeting_approval')
+
+# Synthetic usernames are <prefix><n>: a short prefix could name real accounts
+MIN_PREFIX_LENGTH = 4
+
+WORDS = (
+    "hi thanks meeting tomorrow career advice resume internship alumni batch "
+    "project deadline interview referral campus placement offer congrats"
+).split()
+
+
+def parse_mix(value):
+    """
+    Parse "message=60,typing=25,..." into frame type weights
+    """
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in FRAME_TYPES:
+            raise CommandError(f"Unknown frame type in --mix: {name!r} (choose from {', '.join(FRAME_TYPES)})")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise CommandError(f"Invalid weight for {name} in --mix: {weight!r}")
+    if not any(weight > 0 for weight in mix.values()):
+        raise CommandError("--mix needs at least one frame type with a positive weight")
+    return mix
+
+
+def synthetic_usernames(prefix, count):
+    return [f'{prefix}{i}' for i in range(count)]
+
+
+def summarize_latency(samples):
+    """
+    Latency percentiles in milliseconds
+    """
+    return {
+        'count': len(samples),
+        'mean': statistics.mean(samples) * 1000 if samples else 0.0,
+        'p50': percentile(samples, 50) * 1000,
+        'p95': percentile(samples, 95) * 1000,
+        'p99': percentile(samples, 99) * 1000,
+        'max': max(samples) * 1000 if samples else 0.0,
+    }
+
+
+class InProcessClient:
+    """
+    Connection to ChatConsumer running in this process, through the ASGI test communicator
+    """
+
+    application = URLRouter(websocket_urlpatterns)
+
+    def __init__(self, token, subprotocols):
+        self.communicator = WebsocketCommunicator(
+            self.application, f"/ws/chat/?token={token}", subprotocols=subprotocols
+        )
+
+    async def connect(self, timeout):
+        connected, code = await self.communicator.connect(timeout)
+        if not connected:
+            raise ConnectionError(f"Connection refused ({code})")
+
+    async def send(self, payload):
+        if isinstance(payload, bytes):
+            await self.communicator.send_to(bytes_data=payload)
+        else:
+            await self.communicator.send_to(text_data=payload)
+
+    async def receive(self):
+        # No timeout: on timeout the communicator would cancel the consumer
+        message = await self.communicator.receive_output(timeout=float('inf'))
+        if message['type'] != 'websocket.send':
+            return None
+        return message.get('bytes') if message.get('bytes') is not None else message.get('text')
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteClient:
+    """
+    Connection to a running ASGI server over a real WebSocket
+    """
+
+    def __init__(self, url, token, subprotocols):
+        self.uri = f"{url}{'&' if '?' in url else '?'}token={token}"
+        self.subprotocols = subprotocols
+        self.connection = None
+
+    async def connect(self, timeout):
+        import websockets
+
+        self.connection = await websockets.connect(
+            self.uri, subprotocols=self.subprotocols or None, open_timeout=timeout, max_size=None
+        )
+
+    async def send(self, payload):
+        await self.connection.send(payload)
+
+    async def receive(self):
+        import websockets
+
+        try:
+            return await self.connection.recv()
+        except websockets.ConnectionClosed:
+            return None
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+
+
+class LoadClient:
+    """
+    One simulated browser tab: a connection for a synthetic user and the frames it has sent
+    """
+
+    def __init__(self, index, user_id, connection):
+        self.index = index
+        self.user_id = user_id
+        self.connection = connection
+        self.sent = 0
+        # Keys of this client's unconfirmed frames, by type, to match error frames against
+        self.outstanding = collections.defaultdict(collections.deque)
+
+
+class LoadTest:
+    """
+    Drive a mix of chat frames from many clients and measure delivery to the peer's connections.
+
+    Every frame's key is recorded with its send time; the delivery latency
+    is the time until the frame it causes reaches a connection of the other
+    user. All clients run in this process, so one clock times both ends.
+    """
+
+    def __init__(self, users, options, make_connection, codec):
+        self.users = users
+        self.options = options
+        self.make_connection = make_connection
+        self.codec = codec
+        self.mix = options['mix']
+        self.clients = []
+        self.connect_failures = collections.Counter()
+        self.pending = {}
+        self.latencies = collections.defaultdict(list)
+        self.sent = collections.Counter()
+        self.delivered = collections.Counter()
+        self.refused = collections.Counter()
+        self.errors = collections.Counter()
+        # Shared per user, since a user's tabs share read cursors, typing state and meetings
+        self.unread = collections.defaultdict(lambda: collections.deque(maxlen=100))
+        self.meetings = collections.defaultdict(collections.deque)
+        self.typing = {}
+        self.receivers = []
+        self.duration = 0.0
+
+    async def run(self):
+        await self.connect_all()
+        if not self.clients:
+            return
+        self.receivers = [asyncio.ensure_future(self.receive_loop(client)) for client in self.clients]
+        started = time.perf_counter()
+        deadline = started + self.options['duration']
+        await asyncio.gather(*(self.send_loop(client, deadline) for client in self.clients))
+        self.duration = time.perf_counter() - started
+        # Give frames still in flight a chance to arrive
+        drain_until = time.perf_counter() + self.options['drain']
+        while self.confirmed_pending() and time.perf_counter() < drain_until:
+            await asyncio.sleep(0.05)
+        for receiver in self.receivers:
+            receiver.cancel()
+        await asyncio.gather(*self.receivers, return_exceptions=True)
+        await asyncio.gather(*(client.connection.close() for client in self.clients), return_exceptions=True)
+
+    async def connect_all(self):
+        semaphore = asyncio.Semaphore(self.options['connect_concurrency'])
+
+        async def connect(index):
+            user_id, token = self.users[index % len(self.users)]
+            connection = self.make_connection(token)
+            async with semaphore:
+                try:
+                    await connection.connect(self.options['connect_timeout'])
+                except Exception as e:
+                    self.connect_failures[type(e).__name__] += 1
+                    return None
+            return LoadClient(index, user_id, connection)
+
+        clients = await asyncio.gather(*(connect(index) for index in range(self.options['clients'])))
+        self.clients = [client for client in clients if client is not None]
+        self.connected_users = sorted({client.user_id for client in self.clients})
+
+    def confirmed_pending(self):
+        return sum(1 for frame_type, _ in self.pending.values() if frame_type in CONFIRMED_TYPES)
+
+    async def send_loop(self, client, deadline):
+        rate = self.options['rate']
+        # Stagger the first frames so clients do not all send in lockstep
+        await asyncio.sleep(random.uniform(0, 1 / rate))
+        while time.perf_counter() < deadline:
+            frame = self.next_frame(client)
+            if frame is not None:
+                try:
+                    await client.connection.send(self.codec.encode(frame))
+                except Exception as e:
+                    self.errors[f"send failed: {type(e).__name__}"] += 1
+                    return
+            await asyncio.sleep(random.expovariate(rate))
+
+    def pick_peer(self, client):
+        if len(self.connected_users) < 2:
+            return None
+        while True:
+            peer = random.choice(self.connected_users)
+            if peer != client.user_id:
+                return peer
+
+    def track(self, client, frame_type, key):
+        self.pending[key] = (frame_type, time.perf_counter())
+        client.outstanding[frame_type].append(key)
+        self.sent[frame_type] += 1
+        client.sent += 1
+
+    def next_frame(self, client):
+        """
+        Build the client's next frame; types without anything to act on fall back to a message
+        """
+        frame_type = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        peer = self.pick_peer(client)
+        if peer is None:
+            return None
+        n = client.sent
+        if frame_type == 'read_receipt' and self.unread[client.user_id]:
+            message_id, room_id, seq = self.unread[client.user_id].popleft()
+            self.track(client, frame_type, ('read_receipt', room_id, client.user_id, seq))
+            return {'type': 'read_receipt', 'message_id': message_id}
+        if frame_type == 'meeting_approval' and self.meetings[client.user_id]:
+            meeting_id = self.meetings[client.user_id].popleft()
+            self.track(client, frame_type, ('meeting_approval', meeting_id))
+            return {
+                'type': 'meeting_approval',
+                'meeting_id': meeting_id,
+                'status': random.choice(('approved', 'rejected'))
+            }
+        if frame_type == 'meeting_request':
+            topic = f"Load test {client.index}-{n}"
+            self.track(client, frame_type, ('meeting_request', topic))
+            return {
+                'type': 'meeting_request',
+                'to_user': peer,
+                'datetime': (timezone.now() + timedelta(days=7)).isoformat(),
+                'topic': topic
+            }
+        if frame_type == 'typing':
+            is_typing = not self.typing.get((client.user_id, peer), False)
+            self.typing[(client.user_id, peer)] = is_typing
+            self.track(client, frame_type, ('typing', client.user_id, peer, is_typing))
+            return {'type': 'typing', 'to_user': peer, 'is_typing': is_typing}
+        client_msg_id = f"lt{client.index}-{n}"
+        self.track(client, 'message', ('message', client_msg_id))
+        return {
+            'type': 'message',
+            'to_user': peer,
+            'content': ' '.join(random.choice(WORDS) for _ in range(random.randint(3, 20))),
+            'client_msg_id': client_msg_id
+        }
+
+    def resolve(self, key):
+        """
+        Record the first delivery of a tracked frame; returns False for later copies and untracked frames
+        """
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return False
+        frame_type, sent_at = entry
+        self.latencies[frame_type].append(time.perf_counter() - sent_at)
+        self.delivered[frame_type] += 1
+        return True
+
+    async def receive_loop(self, client):
+        while True:
+            try:
+                payload = await client.connection.receive()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors[f"receive failed: {type(e).__name__}"] += 1
+                return
+            if payload is None:
+                self.errors['connection closed'] += 1
+                return
+            try:
+                if isinstance(payload, bytes):
+                    frame = self.codec.decode(bytes_data=payload)
+                else:
+                    frame = self.codec.decode(text_data=payload)
+            except ValueError:
+                self.errors['undecodable frame'] += 1
+                continue
+            self.on_frame(client, frame)
+
+    def on_frame(self, client, frame):
+        frame_type = frame.get('type')
+        data = frame.get('data') or {}
+        if frame_type == 'message':
+            # Only the first of the user's tabs to receive a message queues it to be read
+            if data.get('sender', {}).get('id') != client.user_id and self.resolve(('message', data.get('client_msg_id'))):
+                self.unread[client.user_id].append((data['id'], data['room_id'], data['seq']))
+        elif frame_type == 'typing':
+            self.resolve(('typing', data.get('user_id'), client.user_id, data.get('is_typing')))
+        elif frame_type == 'read_up_to':
+            if data.get('user_id') != client.user_id:
+                self.resolve(('read_receipt', data.get('room_id'), data.get('user_id'), data.get('seq')))
+        elif frame_type == 'meeting_request':
+            meeting = data.get('meeting_request', {})
+            if meeting.get('requester', {}).get('id') != client.user_id and self.resolve(('meeting_request', meeting.get('topic'))):
+                self.meetings[client.user_id].append(meeting['id'])
+        elif frame_type == 'meeting_response':
+            meeting = data.get('meeting_request', {})
+            if meeting.get('requester', {}).get('id') == client.user_id:
+                self.resolve(('meeting_approval', meeting.get('id')))
+        elif frame_type == 'error':
+            self.on_error(client, frame)
+
+    def on_error(self, client, frame):
+        code = frame.get('code')
+        self.errors[code or frame.get('message') or 'error'] += 1
+        failed_type = frame.get('frame_type')
+        if failed_type not in FRAME_TYPES:
+            return
+        # Errors come back in the order the frames were handled: the oldest unconfirmed frame failed
+        outstanding = client.outstanding[failed_type]
+        while outstanding:
+            key = outstanding.popleft()
+            if key in self.pending:
+                del self.pending[key]
+                self.refused[failed_type] += 1
+                return
+
+    def report(self):
+        frames = {}
+        for frame_type in FRAME_TYPES:
+            if not self.sent[frame_type]:
+                continue
+            lost = sum(1 for pending_type, _ in self.pending.values() if pending_type == frame_type)
+            frames[frame_type] = {
+                'sent': self.sent[frame_type],
+                'delivered': self.delivered[frame_type],
+                'refused': self.refused[frame_type],
+                'undelivered': lost if frame_type in CONFIRMED_TYPES else 0,
+                'latency_ms': summarize_latency(self.latencies[frame_type]),
+            }
+        sent = sum(self.sent.values())
+        delivered = sum(self.delivered.values())
+        failed = sum(frame['refused'] + frame['undelivered'] for frame in frames.values())
+        duration = self.duration or 1.0
+        return {
+            'config': {
+                'mode': self.options['mode'],
+                'users': len(self.users),
+                'clients': self.options['clients'],
+                'duration': self.options['duration'],
+                'rate': self.options['rate'],
+                'mix': self.mix,
+                'encoding': self.codec.name,
+            },
+            'connections': {
+                'attempted': self.options['clients'],
+                'connected': len(self.clients),
+                'failed': dict(self.connect_failures),
+            },
+            'duration': self.duration,
+            'totals': {
+                'sent': sent,
+                'delivered': delivered,
+                'sent_per_second': sent / duration,
+                'delivered_per_second': delivered / duration,
+                'error_rate': failed / sent if sent else 0.0,
+                'latency_ms': summarize_latency([
+                    sample for samples in self.latencies.values() for sample in samples
+                ]),
+            },
+            'frames': frames,
+            'errors': dict(self.errors),
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test the chat WebSocket: connect many clients for synthetic users, drive a mix '
+        'of frames and report delivery latency, throughput and errors'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20,
+                            help='Number of synthetic users (created if missing)')
+        parser.add_argument('--clients', type=int, default=50,
+                            help='Number of concurrent connections, spread round-robin over the users')
+        parser.add_argument('--duration', type=float, default=30.0,
+                            help='Seconds to send frames for')
+        parser.add_argument('--rate', type=float, default=2.0,
+                            help='Mean frames per second sent by each client')
+        parser.add_argument('--mix', default=DEFAULT_MIX,
+                            help=f'Relative weights of frame types (default: {DEFAULT_MIX})')
+        parser.add_argument('--url',
+                            help='WebSocket URL of a running server, e.g. ws://localhost:8000/ws/chat/ '
+                                 '(needs the websockets package); without it the consumer runs in this process')
+        parser.add_argument('--channel-layer', choices=('memory', 'settings'), default='memory',
+                            help='In-process runs only: the in-memory layer, or CHANNEL_LAYERS (e.g. a local Redis)')
+        parser.add_argument('--no-rate-limits', action='store_true',
+                            help='In-process runs only: disable CHAT_RATE_LIMITS')
+        parser.add_argument('--msgpack', action='store_true',
+                            help='Negotiate the MessagePack subprotocol instead of JSON')
+        parser.add_argument('--drain', type=float, default=5.0,
+                            help='Seconds to wait for frames still in flight after sending stops')
+        parser.add_argument('--connect-timeout', type=float, default=10.0)
+        parser.add_argument('--connect-concurrency', type=int, default=50,
+                            help='Connections opened at once while ramping up')
+        parser.add_argument('--prefix', default='loadtest',
+                            help='Username prefix of the synthetic users')
+        parser.add_argument('--seed', type=int, help='Random seed, for repeatable frame sequences')
+        parser.add_argument('--json', dest='json_path',
+                            help="Write the report as JSON to this file ('-' for stdout)")
+        parser.add_argument('--cleanup', action='store_true',
+                            help='Delete the synthetic users and their chats afterwards')
+
+    def handle(self, *args, **options):
+        for name in ('users', 'clients', 'duration', 'rate', 'connect_concurrency'):
+            if options[name] <= 0:
+                raise CommandError(f"--{name.replace('_', '-')} must be positive")
+        if options['users'] < 2:
+            raise CommandError("--users must be at least 2, so clients have someone to talk to")
+        if len(options['prefix']) < MIN_PREFIX_LENGTH:
+            raise CommandError(f"--prefix must be at least {MIN_PREFIX_LENGTH} characters, so it names no real users")
+        options['mix'] = parse_mix(options['mix'])
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+
+        codec = MsgpackCodec() if options['msgpack'] else JsonCodec()
+        subprotocols = [MSGPACK_SUBPROTOCOL] if options['msgpack'] else []
+        if options['url']:
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError("--url needs the websockets package: pip install websockets")
+            options['mode'] = 'remote'
+            make_connection = lambda token: RemoteClient(options['url'], token, subprotocols)
+        else:
+            options['mode'] = 'in-process'
+            make_connection = lambda token: InProcessClient(token, subprotocols)
+
+        users = self.get_users(options['users'], options['prefix'])
+        self.stderr.write(
+            f"{options['clients']} clients for {len(users)} users, {options['mode']}, "
+            f"{options['duration']:g}s at {options['rate']:g} frames/s each"
+        )
+        load_test = LoadTest(users, options, make_connection, codec)
+        try:
+            if options['mode'] == 'in-process':
+                self.run_in_process(load_test, options)
+            else:
+                async_to_sync(load_test.run)()
+        finally:
+            if options['cleanup']:
+                usernames = synthetic_usernames(options['prefix'], options['users'])
+                deleted, _ = User.objects.filter(username__in=usernames).delete()
+                self.stderr.write(f"Deleted {deleted} synthetic users and related rows")
+
+        report = load_test.report()
+        report['started_at'] = timezone.now().isoformat()
+        if options['json_path'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_summary(report)
+            if options['json_path']:
+                with open(options['json_path'], 'w') as f:
+                    json.dump(report, f, indent=2)
+                self.stdout.write(f"Report written to {options['json_path']}")
+        if not load_test.clients:
+            raise CommandError("No client could connect")
+
+    def run_in_process(self, load_test, options):
+        """
+        Run with the consumer in this process, swapping in the channel layer and rate limit settings asked for
+        """
+        previous_layer = None
+        if options['channel_layer'] == 'memory':
+            previous_layer = channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer())
+        rate_limits = getattr(settings, 'CHAT_RATE_LIMIT_ENABLED', True)
+        if options['no_rate_limits']:
+            settings.CHAT_RATE_LIMIT_ENABLED = False
+        try:
+            async_to_sync(load_test.run)()
+        finally:
+            settings.CHAT_RATE_LIMIT_ENABLED = rate_limits
+            if options['channel_layer'] == 'memory':
+                if previous_layer is None:
+                    channel_layers.backends.pop(DEFAULT_CHANNEL_LAYER, None)
+                else:
+                    channel_layers.set(DEFAULT_CHANNEL_LAYER, previous_layer)
+
+    def get_users(self, count, prefix):
+        """
+        Get or create the synthetic users, returning (user id, fresh access token) pairs
+        """
+        users = []
+        for i, username in enumerate(synthetic_usernames(prefix, count)):
+            user = User.objects.filter(username=username).first()
+            if user is None:
+                user = User.objects.create_user(
+                    username=username,
+                    email=f'{username}@example.com',
+                    password=None,
+                    first_name=f'{prefix.title()}{i}',
+                    last_name='User',
+                    user_type='student'
+                )
+            users.append((user.id, str(RefreshToken.for_user(user).access_token)))
+        return users
+
+    def write_summary(self, report):
+        totals = report['totals']
+        connections = report['connections']
+        self.stdout.write(
+            f"Connected {connections['connected']}/{connections['attempted']} clients"
+            + (f" (failed: {connections['failed']})" if connections['failed'] else '')
+        )
+        self.stdout.write(
+            f"Sent {totals['sent']} frames in {report['duration']:.1f}s "
+            f"({totals['sent_per_second']:.1f}/s), delivered {totals['delivered']} "
+            f"({totals['delivered_per_second']:.1f}/s), error rate {totals['error_rate']:.2%}"
+        )
+        self.stdout.write('')
+        self.stdout.write(
+            f"{'frame':<18}{'sent':>8}{'deliv':>8}{'refused':>9}{'lost':>7}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+        )
+        rows = list(report['frames'].items()) + [('all', dict(totals, refused='', undelivered=''))]
+        for name, frame in rows:
+            latency = frame['latency_ms']
+            self.stdout.write(
+                f"{name:<18}{frame['sent']:>8}{frame['delivered']:>8}{frame['refused']:>9}{frame['undelivered']:>7}"
+                f"{latency['p50']:>9.1f}{latency['p95']:>9.1f}{latency['p99']:>9.1f}{latency['max']:>9.1f}"
+            )
+        if report['errors']:
+            self.stdout.write('')
+            self.stdout.write('Errors: ' + ', '.join(
+                f"{name} x{count}" for name, count in sorted(report['errors'].items(), key=lambda item: -item[1])
+            ))
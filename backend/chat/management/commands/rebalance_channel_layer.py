@@ -0,0 +1,26 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.layers import ShardedRedisChannelLayer
+
+
+class Command(BaseCommand):
+    help = 'Move channel groups onto their owning shard after CHANNEL_REDIS_SHARDS changed'
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        if not isinstance(layer, ShardedRedisChannelLayer):
+            raise CommandError("The default channel layer is not a ShardedRedisChannelLayer")
+
+        groups, members = asyncio.run(self.rebalance(layer))
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {groups} groups ({members} memberships); CHANNEL_REDIS_PREVIOUS_SHARDS can now be removed"
+        ))
+
+    async def rebalance(self, layer):
+        try:
+            return await layer.rebalance()
+        finally:
+            await layer.close_pools()
@@ -0,0 +1,124 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+)
+from prometheus_client import multiprocess
+
+# Frame types get their own label value; anything a client makes up is 'unknown'
+FRAME_TYPES = {
+    'message', 'typing', 'meeting_request', 'meeting_approval', 'read_receipt',
+    'read_up_to', 'presence', 'sync', 'batch'
+}
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+CONNECTIONS = Gauge(
+    'chat_ws_connections', 'Open chat WebSocket connections', multiprocess_mode='livesum'
+)
+CONNECTS = Counter('chat_ws_connects', 'Accepted chat WebSocket connections')
+DISCONNECTS = Counter('chat_ws_disconnects', 'Closed chat WebSocket connections')
+AUTH_FAILURES = Counter('chat_ws_auth_failures', 'Rejected chat WebSocket connections', ['reason'])
+FRAME_SECONDS = Histogram(
+    'chat_ws_frame_seconds', 'Time to handle a client frame', ['frame_type'], buckets=LATENCY_BUCKETS
+)
+FRAME_QUERIES = Histogram(
+    'chat_ws_frame_db_queries', 'Database round trips made while handling a client frame',
+    ['frame_type'], buckets=QUERY_BUCKETS
+)
+RATE_LIMITED = Counter('chat_ws_rate_limited_frames', 'Client frames refused by rate limits', ['frame_type'])
+GROUP_SEND_SECONDS = Histogram(
+    'chat_group_send_seconds', 'Channel layer group_send latency', ['target'], buckets=LATENCY_BUCKETS
+)
+OUTBOUND_QUEUED = Gauge(
+    'chat_ws_outbound_queued_frames', 'Frames waiting in outbound queues', multiprocess_mode='livesum'
+)
+OUTBOUND_QUEUED_BYTES = Gauge(
+    'chat_ws_outbound_queued_bytes', 'Bytes waiting in outbound queues', multiprocess_mode='livesum'
+)
+OUTBOUND_OVER_CAP = Gauge(
+    'chat_ws_outbound_over_cap', 'Connections whose outbound queue is over its cap', multiprocess_mode='livesum'
+)
+OUTBOUND_EVENTS = Counter(
+    'chat_ws_outbound_events', 'Outbound frames dropped or coalesced, and slow consumers closed', ['event']
+)
+
+# Labelled children are looked up once; .labels() on every frame would dominate the cost
+_frame_children = {
+    label: (FRAME_SECONDS.labels(label), FRAME_QUERIES.labels(label))
+    for label in FRAME_TYPES | {'unknown'}
+}
+_group_send_children = {target: GROUP_SEND_SECONDS.labels(target) for target in ('user', 'room')}
+
+# Queries counted for the frame being handled; a list so sync threads can add to it
+_frame_queries = contextvars.ContextVar('chat_frame_queries', default=None)
+
+
+def frame_label(frame_type):
+    return frame_type if isinstance(frame_type, str) and frame_type in FRAME_TYPES else 'unknown'
+
+
+@contextmanager
+def observe_frame(frame_type):
+    """
+    Time a frame's handler and count the database queries it makes, including in database_sync_to_async threads
+    """
+    queries = [0]
+    token = _frame_queries.set(queries)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds, query_count = _frame_children[frame_label(frame_type)]
+        seconds.observe(time.perf_counter() - started)
+        query_count.observe(queries[0])
+        _frame_queries.reset(token)
+
+
+def count_query(execute, sql, params, many, context):
+    # The counter list is shared with the copied context asgiref runs sync code in
+    queries = _frame_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    connection_created receiver adding the query counter to every new database connection
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+@contextmanager
+def observe_group_send(target):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _group_send_children[target].observe(time.perf_counter() - started)
+
+
+def multiprocess_enabled():
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def mark_process_dead():
+    multiprocess.mark_process_dead(os.getpid())
+
+
+def render_metrics():
+    """
+    Metrics in Prometheus text format, aggregated over all workers in multiprocess mode; returns (body, content type)
+    """
+    if multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
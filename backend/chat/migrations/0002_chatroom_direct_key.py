@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-17 06:03
+
+from django.db import migrations, models
+
+
+def backfill_direct_keys(apps, schema_editor):
+    """
+    Key existing direct rooms; duplicates of an already keyed pair stay unkeyed
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    seen = set()
+    for room in ChatRoom.objects.filter(room_type='direct').order_by('id').iterator():
+        participant_ids = sorted(room.participants.values_list('id', flat=True))
+        if len(participant_ids) != 2:
+            continue
+        key = f"{participant_ids[0]}:{participant_ids[1]}"
+        if key in seen:
+            continue
+        seen.add(key)
+        ChatRoom.objects.filter(id=room.id).update(direct_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='direct_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_direct_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 4.2.7 on 2026-10-17 06:09
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_sequences(apps, schema_editor):
+    """
+    Number existing messages per room in (created_at, id) order
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    for room_id in ChatRoom.objects.values_list('id', flat=True).iterator():
+        seq = 0
+        batch = []
+        messages = ChatMessage.objects.filter(room_id=room_id).order_by('created_at', 'id').only('id')
+        for message in messages.iterator():
+            seq += 1
+            message.seq = seq
+            batch.append(message)
+            if len(batch) >= 1000:
+                ChatMessage.objects.bulk_update(batch, ['seq'])
+                batch = []
+        if batch:
+            ChatMessage.objects.bulk_update(batch, ['seq'])
+        ChatRoom.objects.filter(id=room_id).update(last_seq=seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatroom_direct_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='client_msg_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_sequences, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='unique_chat_message_room_seq'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(condition=models.Q(('client_msg_id__isnull', False)), fields=('sender', 'client_msg_id'), name='unique_chat_message_client_msg_id'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-17 06:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seed_read_cursors(apps, schema_editor):
+    """
+    Give every participant a cursor at the highest message they have read
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    MessageReadStatus = apps.get_model('chat', 'MessageReadStatus')
+    RoomReadCursor = apps.get_model('chat', 'RoomReadCursor')
+
+    read_up_to = {
+        (row['message__room_id'], row['user_id']): row['max_seq']
+        for row in MessageReadStatus.objects.values('message__room_id', 'user_id').annotate(
+            max_seq=models.Max('message__seq')
+        )
+    }
+    cursors = []
+    for room in ChatRoom.objects.prefetch_related('participants'):
+        for participant in room.participants.all():
+            cursors.append(RoomReadCursor(
+                room_id=room.id,
+                user_id=participant.id,
+                last_read_seq=read_up_to.get((room.id, participant.id)) or 0
+            ))
+    RoomReadCursor.objects.bulk_create(cursors, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0003_chatmessage_seq_client_msg_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_seq', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Room Read Cursor',
+                'verbose_name_plural': 'Room Read Cursors',
+                'db_table': 'room_read_cursors',
+                'unique_together': {('room', 'user')},
+            },
+        ),
+        migrations.RunPython(seed_read_cursors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.7 on 2026-10-17 06:24
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_roomreadcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,77 @@
+from django.db import migrations
+
+# SQLite: an FTS5 index over chat_messages.content, kept in step by triggers,
+# so rows written by bulk_create (the write-behind buffer) are indexed too.
+# room_id is indexed as a second column so a search can be scoped to the
+# caller's rooms inside FTS5; the view supplies it as the external content.
+# Django rebuilds a SQLite table to alter it, which drops its triggers: a
+# later migration that alters chat_messages must run SQLITE_INSTALL again.
+SQLITE_INSTALL = [
+    "CREATE VIEW IF NOT EXISTS chat_messages_fts_source AS SELECT id, content, room_id FROM chat_messages",
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+        content, room_id, content='chat_messages_fts_source', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF content, room_id ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+        INSERT INTO chat_messages_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    # Index the messages that already exist
+    "INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')",
+]
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS chat_messages_fts_update",
+    "DROP TRIGGER IF EXISTS chat_messages_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_messages_fts_insert",
+    "DROP TABLE IF EXISTS chat_messages_fts",
+    "DROP VIEW IF EXISTS chat_messages_fts_source",
+]
+
+# PostgreSQL: a GIN index on the same expression chat.search queries with,
+# so it needs no extra column or trigger. On a large table, create it by
+# hand with CREATE INDEX CONCURRENTLY first; IF NOT EXISTS then skips it.
+POSTGRES_INSTALL = [
+    """
+    CREATE INDEX IF NOT EXISTS chat_msg_content_search_idx ON chat_messages
+    USING gin (to_tsvector('english'::regconfig, COALESCE(content, '')))
+    """,
+]
+POSTGRES_UNINSTALL = [
+    "DROP INDEX IF EXISTS chat_msg_content_search_idx",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatmessage_history_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_INSTALL, 'postgresql': POSTGRES_INSTALL}),
+            run_for_vendor({'sqlite': SQLITE_UNINSTALL, 'postgresql': POSTGRES_UNINSTALL}),
+        ),
+    ]
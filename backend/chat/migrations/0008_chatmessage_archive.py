@@ -0,0 +1,113 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:58
+
+from django.conf import settings
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+# SQLite: extend the FTS5 index from 0007 over the archive. Its content view
+# becomes a UNION ALL of both tables (ids are shared, since archived rows keep
+# theirs), and archive triggers index what the mover inserts, after the
+# chat_messages delete trigger has unindexed it.
+SQLITE_INSTALL = [
+    "DROP VIEW IF EXISTS chat_messages_fts_source",
+    """
+    CREATE VIEW chat_messages_fts_source AS
+    SELECT id, content, room_id FROM chat_messages
+    UNION ALL
+    SELECT id, content, room_id FROM chat_message_archive
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_archive_fts_insert AFTER INSERT ON chat_message_archive BEGIN
+        INSERT INTO chat_messages_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_archive_fts_delete AFTER DELETE ON chat_message_archive BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_message_archive_fts_update AFTER UPDATE OF content, room_id ON chat_message_archive BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+        INSERT INTO chat_messages_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+]
+SQLITE_UNINSTALL = [
+    "DROP TRIGGER IF EXISTS chat_message_archive_fts_update",
+    "DROP TRIGGER IF EXISTS chat_message_archive_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_archive_fts_insert",
+    "DROP VIEW IF EXISTS chat_messages_fts_source",
+    "CREATE VIEW chat_messages_fts_source AS SELECT id, content, room_id FROM chat_messages",
+]
+
+# PostgreSQL: the archive gets the same expression index as chat_messages
+POSTGRES_INSTALL = [
+    """
+    CREATE INDEX IF NOT EXISTS chat_archive_content_search_idx ON chat_message_archive
+    USING gin (to_tsvector('english'::regconfig, COALESCE(content, '')))
+    """,
+]
+POSTGRES_UNINSTALL = [
+    "DROP INDEX IF EXISTS chat_archive_content_search_idx",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0007_chatmessage_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='archived_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='archived_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('message_type', models.CharField(choices=[('message', 'Regular Message'), ('meeting_request', 'Meeting Request'), ('meeting_approved', 'Meeting Approved'), ('meeting_rejected', 'Meeting Rejected'), ('system', 'System Message')], default='message', max_length=20)),
+                ('reply_to_id', models.BigIntegerField(blank=True, null=True)),
+                ('seq', models.PositiveBigIntegerField()),
+                ('created_at', models.DateTimeField()),
+                ('extra', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('room', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='chat.chatroom')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Archived Message',
+                'verbose_name_plural': 'Archived Messages',
+                'db_table': 'chat_message_archive',
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['room', 'created_at', 'id'], name='chat_archive_room_created_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='archivedmessage',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='unique_chat_archive_room_seq'),
+        ),
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_INSTALL, 'postgresql': POSTGRES_INSTALL}),
+            run_for_vendor({'sqlite': SQLITE_UNINSTALL, 'postgresql': POSTGRES_UNINSTALL}),
+        ),
+    ]
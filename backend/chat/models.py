@@ -1,6 +1,13 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import FileExtensionValidator
+from blobstore.variants import image_variants
 
 User = get_user_model()
 
@@ -17,6 +24,16 @@ class ChatRoom(models.Model):
     name = models.CharField(max_length=200, blank=True, null=True)
     room_type = models.CharField(max_length=20, choices=ROOM_TYPE_CHOICES, default='direct')
     participants = models.ManyToManyField(User, related_name='chat_rooms')
+    # Canonical "<min user id>:<max user id>" key, set only for direct rooms
+    direct_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # Highest message sequence number handed out in this room
+    last_seq = models.PositiveBigIntegerField(default=0)
+    # Snapshot of the newest message (see ChatMessage.snapshot) so room lists need no message queries
+    last_message = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    last_message_seq = models.PositiveBigIntegerField(default=0)
+    # Newest seq and send time moved to ArchivedMessage, so readers skip the archive for newer ranges
+    archived_seq = models.PositiveBigIntegerField(default=0)
+    archived_until = models.DateTimeField(null=True, blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_rooms')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -33,6 +50,106 @@ class ChatRoom(models.Model):
             if len(participants) == 2:
                 return f"DM: {participants[0].get_full_name()} & {participants[1].get_full_name()}"
         return self.name or f"Room {self.id}"
+    
+    @staticmethod
+    def make_direct_key(user_id, other_user_id):
+        """
+        Build the canonical key for a direct room between two users
+        """
+        low, high = sorted((int(user_id), int(other_user_id)))
+        return f"{low}:{high}"
+    
+    @classmethod
+    def allocate_seq(cls, room_id, count=1):
+        """
+        Reserve the next `count` message sequence numbers for a room.
+        
+        Returns the last reserved number; the reserved range is
+        (result - count, result].
+        """
+        with transaction.atomic():
+            cls.objects.filter(id=room_id).update(last_seq=F('last_seq') + count)
+            return cls.objects.values_list('last_seq', flat=True).get(id=room_id)
+    
+    @classmethod
+    def record_last_message(cls, message):
+        """
+        Store a message as the room's last-message snapshot unless a newer one is already recorded
+        """
+        return cls.objects.filter(
+            id=message.room_id, last_message_seq__lt=message.seq
+        ).update(
+            last_message=message.snapshot(),
+            last_message_seq=message.seq,
+            updated_at=timezone.now()
+        )
+    
+    @classmethod
+    def with_unread_counts(cls, queryset, user_id):
+        """
+        Annotate rooms with `unread_message_count` for a user.
+        
+        Counts only messages past the user's read cursor, which is an index
+        range scan on (room, seq) rather than a scan of the room's history.
+        The archive is only counted when the cursor is behind archived_seq.
+        """
+        last_read_seq = RoomReadCursor.objects.filter(
+            room=OuterRef('pk'), user_id=user_id
+        ).values('last_read_seq')[:1]
+        unread = ChatMessage.objects.filter(
+            room=OuterRef('pk'), seq__gt=OuterRef('last_read_seq')
+        ).order_by().values('room').annotate(count=Count('pk')).values('count')
+        archived_unread = ArchivedMessage.objects.filter(
+            room=OuterRef('pk'), seq__gt=OuterRef('last_read_seq')
+        ).order_by().values('room').annotate(count=Count('pk')).values('count')
+        return queryset.annotate(
+            last_read_seq=Coalesce(Subquery(last_read_seq), 0)
+        ).annotate(
+            unread_message_count=Coalesce(Subquery(unread), 0) + Case(
+                When(archived_seq__gt=F('last_read_seq'), then=Coalesce(Subquery(archived_unread), 0)),
+                default=0
+            )
+        )
+    
+    @classmethod
+    def get_or_create_direct(cls, user_id, other_user_id):
+        """
+        Get or create the direct room between two users.
+        
+        Safe against both users opening the room at the same time: the unique
+        direct_key makes the losing insert fail, and it then reads the winner.
+        """
+        key = cls.make_direct_key(user_id, other_user_id)
+        room = cls.objects.filter(direct_key=key).first()
+        if room:
+            return room
+        
+        if not User.objects.filter(id=other_user_id).exists():
+            raise User.DoesNotExist(f"User {other_user_id} does not exist")
+        
+        # Adopt a direct room created without a key (e.g. through the admin)
+        legacy_room = cls.objects.filter(
+            room_type='direct', direct_key__isnull=True, participants=user_id
+        ).filter(participants=other_user_id).first()
+        if legacy_room:
+            cls.objects.filter(id=legacy_room.id, direct_key__isnull=True).update(direct_key=key)
+            return cls.objects.get(direct_key=key)
+        
+        try:
+            with transaction.atomic():
+                room = cls.objects.create(
+                    room_type='direct',
+                    direct_key=key,
+                    created_by_id=user_id
+                )
+                room.participants.add(user_id, other_user_id)
+                RoomReadCursor.objects.bulk_create([
+                    RoomReadCursor(room=room, user_id=user_id),
+                    RoomReadCursor(room=room, user_id=other_user_id),
+                ])
+        except IntegrityError:
+            room = cls.objects.get(direct_key=key)
+        return room
 
 
 class ChatMessage(models.Model):
@@ -52,7 +169,12 @@ class ChatMessage(models.Model):
     content = models.TextField()
     message_type = models.CharField(max_length=20, choices=MESSAGE_TYPE_CHOICES, default='message')
     reply_to = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='replies')
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Per-room sequence number, increasing within a room
+    seq = models.PositiveBigIntegerField(editable=False)
+    # Client-generated id used to deduplicate retried sends
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
+    # Set explicitly (not auto_now_add) so write-behind batches keep the send time
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     updated_at = models.DateTimeField(auto_now=True)
     
     # Meeting-specific fields
@@ -65,9 +187,63 @@ class ChatMessage(models.Model):
         ordering = ['created_at']
         verbose_name = 'Chat Message'
         verbose_name_plural = 'Chat Messages'
+        indexes = [
+            # Keyset pagination of room history on (created_at, id)
+            models.Index(fields=['room', 'created_at', 'id'], name='chat_msg_room_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='unique_chat_message_room_seq'),
+            models.UniqueConstraint(
+                fields=['sender', 'client_msg_id'],
+                condition=Q(client_msg_id__isnull=False),
+                name='unique_chat_message_client_msg_id'
+            ),
+        ]
+    
+    # Length of the content preview kept in ChatRoom.last_message
+    PREVIEW_LENGTH = 200
+    
+    _sender_name = None
     
     def __str__(self):
         return f"Message from {self.sender.get_full_name()} in {self.room}"
+    
+    def save(self, *args, **kwargs):
+        if self.seq is None:
+            with transaction.atomic():
+                self.seq = ChatRoom.allocate_seq(self.room_id)
+                super().save(*args, **kwargs)
+                ChatRoom.record_last_message(self)
+                # Sending a message implies having read the room up to it
+                RoomReadCursor.advance(self.room_id, self.sender_id, self.seq)
+            return
+        super().save(*args, **kwargs)
+    
+    @property
+    def sender_name(self):
+        """
+        Sender's full name; callers that already know it can pass sender_name= to spare a user query
+        """
+        if self._sender_name is None:
+            self._sender_name = self.sender.get_full_name()
+        return self._sender_name
+    
+    @sender_name.setter
+    def sender_name(self, value):
+        self._sender_name = value
+    
+    def snapshot(self):
+        """
+        Compact summary of the message for ChatRoom.last_message
+        """
+        return {
+            'id': self.id,
+            'content': self.content[:self.PREVIEW_LENGTH],
+            'sender_id': self.sender_id,
+            'sender': self.sender_name,
+            'message_type': self.message_type,
+            'created_at': self.created_at
+        }
 
 
 class MessageAttachment(models.Model):
@@ -93,9 +269,155 @@ class MessageAttachment(models.Model):
         return f"Attachment: {self.file_name}"
 
 
+class ArchivedMessage(models.Model):
+    """
+    A chat message moved out of chat_messages by the archive_chat_messages command.
+    
+    Keeps the original id, room, seq and created_at, so history cursors and
+    sync seqs stay valid. Meeting fields and attachment metadata are folded
+    into `extra`; edit time and client ids are dropped.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    # Indexed through the (room, ...) indexes below
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='archived_messages', db_index=False)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_messages')
+    content = models.TextField()
+    message_type = models.CharField(max_length=20, choices=ChatMessage.MESSAGE_TYPE_CHOICES, default='message')
+    reply_to_id = models.BigIntegerField(null=True, blank=True)
+    seq = models.PositiveBigIntegerField()
+    created_at = models.DateTimeField()
+    # {'meeting': {...}, 'attachments': [...]}, only for messages that had them
+    extra = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    
+    class Meta:
+        db_table = 'chat_message_archive'
+        ordering = ['created_at']
+        verbose_name = 'Archived Message'
+        verbose_name_plural = 'Archived Messages'
+        indexes = [
+            models.Index(fields=['room', 'created_at', 'id'], name='chat_archive_room_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='unique_chat_archive_room_seq'),
+        ]
+    
+    # Dropped on archival; kept as attributes so archived and live messages serialize alike
+    client_msg_id = None
+    
+    def __str__(self):
+        return f"Archived message {self.id} in room {self.room_id}"
+    
+    @classmethod
+    def from_message(cls, message):
+        """
+        Archive row for a message; expects its attachments to be prefetched
+        """
+        extra = {}
+        if message.message_type.startswith('meeting'):
+            extra['meeting'] = {
+                'datetime': message.meeting_datetime,
+                'topic': message.meeting_topic,
+                'status': message.meeting_status
+            }
+        attachments = [
+            {
+                'id': attachment.id,
+                'file': attachment.file.name,
+                'file_name': attachment.file_name,
+                'file_type': attachment.file_type,
+                'file_size': attachment.file_size
+            }
+            for attachment in message.attachments.all()
+        ]
+        if attachments:
+            extra['attachments'] = attachments
+        return cls(
+            id=message.id,
+            room_id=message.room_id,
+            sender_id=message.sender_id,
+            content=message.content,
+            message_type=message.message_type,
+            reply_to_id=message.reply_to_id,
+            seq=message.seq,
+            created_at=message.created_at,
+            extra=extra or None
+        )
+    
+    @property
+    def meeting(self):
+        return (self.extra or {}).get('meeting') or {}
+    
+    @property
+    def meeting_datetime(self):
+        value = self.meeting.get('datetime')
+        return parse_datetime(value) if value else None
+    
+    @property
+    def meeting_topic(self):
+        return self.meeting.get('topic')
+    
+    @property
+    def meeting_status(self):
+        return self.meeting.get('status', '')
+    
+    def attachment_data(self):
+        """
+        Attachment metadata in MessageHistorySerializer's shape; the files themselves stay in storage
+        """
+        return [
+            {
+                'id': attachment['id'],
+                'file_name': attachment['file_name'],
+                'file_url': default_storage.url(attachment['file']),
+                'file_type': attachment['file_type'],
+                'file_size': attachment['file_size'],
+                'variants': image_variants(attachment['file'])
+            }
+            for attachment in (self.extra or {}).get('attachments', [])
+        ]
+
+
+class RoomReadCursor(models.Model):
+    """
+    Per-room read watermark: the user has read every message up to last_read_seq
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_cursors')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_read_cursors')
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'room_read_cursors'
+        unique_together = ['room', 'user']
+        verbose_name = 'Room Read Cursor'
+        verbose_name_plural = 'Room Read Cursors'
+    
+    def __str__(self):
+        return f"{self.user.get_full_name()} read {self.room} up to {self.last_read_seq}"
+    
+    @classmethod
+    def advance(cls, room_id, user_id, seq):
+        """
+        Move a user's watermark forward to seq; never moves it back
+        """
+        updated = cls.objects.filter(
+            room_id=room_id, user_id=user_id, last_read_seq__lt=seq
+        ).update(last_read_seq=seq, updated_at=timezone.now())
+        if not updated:
+            cursor, created = cls.objects.get_or_create(
+                room_id=room_id, user_id=user_id, defaults={'last_read_seq': seq}
+            )
+            if not created and cursor.last_read_seq < seq:
+                cls.objects.filter(id=cursor.id, last_read_seq__lt=seq).update(
+                    last_read_seq=seq, updated_at=timezone.now()
+                )
+
+
 class MessageReadStatus(models.Model):
     """
-    Model for tracking message read status
+    Model for tracking message read status.
+    
+    Superseded by RoomReadCursor and no longer written; kept for existing data.
     """
     message = models.ForeignKey(ChatMessage, on_delete=models.CASCADE, related_name='read_status')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='message_reads')
@@ -113,7 +435,10 @@ class MessageReadStatus(models.Model):
 
 class TypingIndicator(models.Model):
     """
-    Model for typing indicators
+    Model for typing indicators.
+    
+    Live typing state is kept in chat.typing; rows are only written when
+    CHAT_TYPING_PERSIST is enabled.
     """
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='typing_indicators')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='typing_indicators')
@@ -0,0 +1,229 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+from .metrics import OUTBOUND_EVENTS, OUTBOUND_OVER_CAP, OUTBOUND_QUEUED, OUTBOUND_QUEUED_BYTES
+
+logger = logging.getLogger(__name__)
+
+HIGH = 'high'
+LOW = 'low'
+
+# Close code for connections that stay over their outbound cap
+CLOSE_SLOW_CONSUMER = 4008
+
+# Frames that may be coalesced or dropped under pressure; everything else is high priority
+LOW_PRIORITY_FRAMES = {'typing', 'presence'}
+
+
+def frame_priority(frame_type):
+    return LOW if frame_type in LOW_PRIORITY_FRAMES else HIGH
+
+
+class OutboundStats:
+    """
+    Process-wide counters and a registry of live queues for queue-depth metrics
+    """
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = 0
+        self._lock = threading.Lock()
+
+    def increment(self, name, count=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + count)
+        OUTBOUND_EVENTS.labels(name).inc(count)
+
+    def snapshot(self):
+        queues = list(self.queues)
+        depths = [queue.depth for queue in queues]
+        return {
+            'connections': len(queues),
+            'queued_messages': sum(depths),
+            'queued_bytes': sum(queue.bytes for queue in queues),
+            'max_depth': max(depths, default=0),
+            'over_cap': sum(1 for queue in queues if queue.over_cap_since is not None),
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'closed_slow': self.closed,
+        }
+
+
+outbound_stats = OutboundStats()
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection send queue drained by a single writer task.
+
+    High-priority frames (chat messages, meeting events, read markers) are
+    always queued and sent first. Any frame with a coalesce key replaces an
+    older queued frame with the same key, so a read marker keeps only its
+    newest value. Low-priority frames (typing, presence) are also evicted
+    or dropped when the queue is over CHAT_OUTBOUND_MAX_MESSAGES or
+    CHAT_OUTBOUND_MAX_BYTES. A connection whose backlog stays over the cap
+    for CHAT_OUTBOUND_OVERFLOW_GRACE seconds, checked on a timer as well as
+    on every put, or reaches twice the cap, is handed to `on_overflow` to
+    be closed.
+    """
+
+    def __init__(self, send, on_overflow, max_messages=None, max_bytes=None, overflow_grace=None):
+        self._send = send
+        self._on_overflow = on_overflow
+        self.max_messages = max_messages or getattr(settings, 'CHAT_OUTBOUND_MAX_MESSAGES', 200)
+        self.max_bytes = max_bytes or getattr(settings, 'CHAT_OUTBOUND_MAX_BYTES', 1024 * 1024)
+        self.overflow_grace = (
+            overflow_grace if overflow_grace is not None
+            else getattr(settings, 'CHAT_OUTBOUND_OVERFLOW_GRACE', 10.0)
+        )
+        self._high = collections.deque()
+        self._low = collections.deque()
+        self._coalesce = {}
+        self._ready = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._task = None
+        self._grace_timer = None
+        self.depth = 0
+        self.bytes = 0
+        self.over_cap_since = None
+        self.overflowed = False
+        outbound_stats.queues.add(self)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._high.clear()
+        self._low.clear()
+        self._coalesce.clear()
+        self._account(-self.depth, -self.bytes)
+        self._set_over_cap(False)
+        self._writable.set()
+        outbound_stats.queues.discard(self)
+
+    def _account(self, frames, size):
+        self.depth += frames
+        self.bytes += size
+        OUTBOUND_QUEUED.inc(frames)
+        OUTBOUND_QUEUED_BYTES.inc(size)
+
+    def _set_over_cap(self, over_cap):
+        if over_cap and self.over_cap_since is None:
+            self.over_cap_since = time.monotonic()
+            OUTBOUND_OVER_CAP.inc()
+        elif not over_cap and self.over_cap_since is not None:
+            self.over_cap_since = None
+            OUTBOUND_OVER_CAP.dec()
+            if self._grace_timer is not None:
+                self._grace_timer.cancel()
+                self._grace_timer = None
+
+    def _over_cap(self, extra_bytes=0):
+        return self.depth + 1 > self.max_messages or self.bytes + extra_bytes > self.max_bytes
+
+    def _below_low_watermark(self):
+        return self.depth < self.max_messages // 2 and self.bytes < self.max_bytes // 2
+
+    async def wait_writable(self):
+        """
+        Wait until the queue is under half its cap, for producers of large bursts such as sync
+        """
+        while not self.overflowed and self._task is not None and not self._below_low_watermark():
+            self._writable.clear()
+            await self._writable.wait()
+
+    def put(self, text, priority=HIGH, coalesce_key=None):
+        """
+        Queue a frame (str or bytes); returns False if it was dropped
+        """
+        if self.overflowed:
+            return False
+        size = len(text)
+
+        entry = self._coalesce.get(coalesce_key) if coalesce_key else None
+        if entry is not None:
+            self._account(0, size - len(entry[0]))
+            entry[0] = text
+            outbound_stats.increment('coalesced')
+            self._check_overflow()
+            return True
+        entry = [text, coalesce_key]
+        if priority == LOW:
+            if self._over_cap(size):
+                outbound_stats.increment('dropped')
+                return False
+            self._low.append(entry)
+        else:
+            # Make room by evicting droppable frames first
+            while self._low and self._over_cap(size):
+                self._discard_low(self._low.popleft())
+                outbound_stats.increment('dropped')
+            self._high.append(entry)
+        if coalesce_key:
+            self._coalesce[coalesce_key] = entry
+
+        self._account(1, size)
+        self._check_overflow()
+        self._ready.set()
+        return True
+
+    def _discard_low(self, entry):
+        text, coalesce_key = entry
+        if coalesce_key:
+            self._coalesce.pop(coalesce_key, None)
+        self._account(-1, -len(text))
+
+    def _check_overflow(self):
+        if self.overflowed:
+            return
+        if self.depth <= self.max_messages and self.bytes <= self.max_bytes:
+            self._set_over_cap(False)
+            return
+        self._set_over_cap(True)
+        now = time.monotonic()
+        hard_limit = self.depth > 2 * self.max_messages or self.bytes > 2 * self.max_bytes
+        remaining = self.over_cap_since + self.overflow_grace - now
+        if hard_limit or remaining <= 0:
+            self.overflowed = True
+            self._writable.set()
+            outbound_stats.increment('closed')
+            asyncio.ensure_future(self._on_overflow())
+        elif self._grace_timer is None:
+            # A client that stops reading may get no further frames to trigger the check
+            self._grace_timer = asyncio.get_running_loop().call_later(remaining, self._on_grace_timer)
+
+    def _on_grace_timer(self):
+        self._grace_timer = None
+        self._check_overflow()
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._high or self._low:
+                text, coalesce_key = (self._high or self._low).popleft()
+                if coalesce_key:
+                    self._coalesce.pop(coalesce_key, None)
+                self._account(-1, -len(text))
+                if self.over_cap_since is not None and not self._over_cap():
+                    self._set_over_cap(False)
+                if self._below_low_watermark():
+                    self._writable.set()
+                try:
+                    await self._send(text)
+                except Exception as e:
+                    logger.error(f"Outbound send failed: {e}")
+                    self.stop()
+                    return
+            self._ready.clear()
@@ -0,0 +1,143 @@
+import threading
+import time
+
+from django.conf import settings
+
+
+class LocalPresenceBackend:
+    """
+    In-process presence for single-node deployments.
+
+    Each user maps to their open connections (channel names) with an expiry
+    that heartbeats push forward, so multiple tabs count separately and a
+    connection that was never cleanly closed drops out after the TTL.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    async def add(self, user_id, channel_name, ttl):
+        with self._lock:
+            self._connections.setdefault(user_id, {})[channel_name] = time.time() + ttl
+
+    async def remove(self, user_id, channel_name):
+        with self._lock:
+            connections = self._connections.get(user_id)
+            if connections is not None:
+                connections.pop(channel_name, None)
+                if not connections:
+                    del self._connections[user_id]
+
+    def online(self, user_ids):
+        now = time.time()
+        with self._lock:
+            return {
+                user_id for user_id in user_ids
+                if any(expires_at > now for expires_at in self._connections.get(user_id, {}).values())
+            }
+
+    async def aonline(self, user_ids):
+        return self.online(user_ids)
+
+    def connection_count(self, user_id):
+        now = time.time()
+        with self._lock:
+            return sum(1 for expires_at in self._connections.get(user_id, {}).values() if expires_at > now)
+
+
+class RedisPresenceBackend:
+    """
+    Shared presence for multi-node deployments.
+
+    Each user has a sorted set of channel names scored by expiry time. A node
+    that dies stops heartbeating, so its connections fall out of the count by
+    score and the key itself expires after the TTL.
+    """
+
+    key_prefix = 'chat:presence:'
+
+    def __init__(self, url=None, client=None, async_client=None):
+        if client is None or async_client is None:
+            import redis
+            import redis.asyncio
+            client = client or redis.Redis.from_url(url)
+            async_client = async_client or redis.asyncio.Redis.from_url(url)
+        self.client = client
+        self.async_client = async_client
+
+    def key(self, user_id):
+        return f"{self.key_prefix}{user_id}"
+
+    async def add(self, user_id, channel_name, ttl):
+        now = time.time()
+        key = self.key(user_id)
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            pipe.zadd(key, {channel_name: now + ttl})
+            pipe.expire(key, int(ttl) + 1)
+            await pipe.execute()
+
+    async def remove(self, user_id, channel_name):
+        await self.async_client.zrem(self.key(user_id), channel_name)
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), now, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    async def aonline(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self.key(user_id), now, '+inf')
+            counts = await pipe.execute()
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+    def connection_count(self, user_id):
+        return self.client.zcount(self.key(user_id), time.time(), '+inf')
+
+
+_backend = None
+
+
+def get_presence_backend():
+    """
+    Return the configured presence backend: Redis when CHAT_PRESENCE_REDIS_URL is set, in-process otherwise
+    """
+    global _backend
+    if _backend is None:
+        url = getattr(settings, 'CHAT_PRESENCE_REDIS_URL', '')
+        _backend = RedisPresenceBackend(url) if url else LocalPresenceBackend()
+    return _backend
+
+
+def presence_ttl():
+    return getattr(settings, 'CHAT_PRESENCE_TTL', 90)
+
+
+def presence_heartbeat():
+    return getattr(settings, 'CHAT_PRESENCE_HEARTBEAT', 30)
+
+
+def parse_user_ids(values):
+    """
+    Parse and cap a list of user ids from a request, raising ValueError on bad input
+    """
+    if isinstance(values, str):
+        values = [value for value in values.split(',') if value.strip()]
+    user_ids = list(dict.fromkeys(int(value) for value in values))
+    if len(user_ids) > getattr(settings, 'CHAT_PRESENCE_MAX_QUERY', 1000):
+        raise ValueError("Too many user ids")
+    return user_ids
+
+
+def online_user_ids(user_ids):
+    """
+    Bulk lookup of which of the given users are online
+    """
+    return get_presence_backend().online(user_ids)
@@ -0,0 +1,255 @@
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Refill the bucket, then take `cost` tokens if there are enough. Uses the
+# server clock so nodes with skewed clocks share one notion of time.
+# Returns the seconds to wait before the request would be allowed, or 0.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+# Give back tokens taken for a frame that another bucket then refused.
+# A bucket that has expired is full already.
+REFUND_SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + tonumber(ARGV[2]))))
+end
+return 0
+"""
+
+
+class LocalRateLimitBackend:
+    """
+    In-process token buckets, used per connection and as the per-user store on single-node deployments
+    """
+
+    sweep_every = 1024
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._takes = 0
+
+    def take_now(self, key, capacity, rate, cost=1, now=None):
+        """
+        Take `cost` tokens from a bucket, returning 0 if allowed or the seconds until it would be
+        """
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            self._takes += 1
+            if self._takes % self.sweep_every == 0:
+                self._sweep(now)
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            retry_after = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            return retry_after
+
+    async def take(self, key, capacity, rate, cost=1):
+        return self.take_now(key, capacity, rate, cost)
+
+    async def refund(self, key, capacity, cost=1):
+        self.refund_now(key, capacity, cost)
+
+    def refund_now(self, key, capacity, cost=1):
+        """
+        Give back `cost` tokens taken from a bucket, up to its capacity
+        """
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated, full_at = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + cost), updated, full_at)
+
+    def _sweep(self, now):
+        # A bucket that has refilled completely is the same as a missing one
+        for key in [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]:
+            del self._buckets[key]
+
+
+class RedisRateLimitBackend:
+    """
+    Per-user token buckets shared by every node through Redis.
+
+    Each bucket is a hash of its token count and last refill time, updated
+    atomically by a Lua script and expiring once it would be full again. If
+    Redis is unreachable, limits fall back to this node's own buckets.
+    """
+
+    key_prefix = 'chat:ratelimit:'
+    # Seconds between warnings while Redis stays unreachable
+    warn_every = 60
+
+    def __init__(self, url=None, async_client=None):
+        if async_client is None:
+            import redis.asyncio
+            async_client = redis.asyncio.Redis.from_url(url)
+        self.async_client = async_client
+        self.script = async_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.refund_script = async_client.register_script(REFUND_SCRIPT)
+        self.fallback = LocalRateLimitBackend()
+        self._warned_at = None
+        self._failures = 0
+
+    async def take(self, key, capacity, rate, cost=1):
+        try:
+            retry_after = await self.script(keys=[f"{self.key_prefix}{key}"], args=[capacity, rate, cost])
+        except Exception as e:
+            self._unavailable(e)
+            return self.fallback.take_now(key, capacity, rate, cost)
+        return float(retry_after)
+
+    async def refund(self, key, capacity, cost=1):
+        try:
+            await self.refund_script(keys=[f"{self.key_prefix}{key}"], args=[capacity, cost])
+        except Exception as e:
+            self._unavailable(e)
+            self.fallback.refund_now(key, capacity, cost)
+
+    def _unavailable(self, error):
+        # Every frame fails during an outage: warn once per warn_every seconds
+        now = time.monotonic()
+        self._failures += 1
+        if self._warned_at is not None and now - self._warned_at < self.warn_every:
+            return
+        suppressed = self._failures - 1
+        self._warned_at, self._failures = now, 0
+        repeats = f" ({suppressed} more failures since the last warning)" if suppressed else ""
+        logger.warning(f"Rate limit store unavailable, using local buckets: {error}{repeats}")
+
+
+_backend = None
+
+
+def get_rate_limit_backend():
+    """
+    Return the per-user bucket store: Redis when CHAT_RATE_LIMIT_REDIS_URL is set, in-process otherwise
+    """
+    global _backend
+    if _backend is None:
+        url = getattr(settings, 'CHAT_RATE_LIMIT_REDIS_URL', '')
+        _backend = RedisRateLimitBackend(url) if url else LocalRateLimitBackend()
+    return _backend
+
+
+def frame_costs(frame_type, data):
+    """
+    Tokens a client frame costs, by limit name; a batch also pays for each operation it carries
+    """
+    costs = collections.Counter({frame_type if isinstance(frame_type, str) else '*': 1})
+    if frame_type == 'batch' and isinstance(data.get('ops'), list):
+        for op in data['ops']:
+            op_type = op.get('type') if isinstance(op, dict) else None
+            costs[op_type if isinstance(op_type, str) else '*'] += 1
+    return costs
+
+
+class BurstExceeded(Exception):
+    """
+    A batch carries more operations of one type than its bucket can ever hold
+    """
+
+    def __init__(self, name, burst):
+        super().__init__(f"{name} operations are limited to {burst} per frame")
+        self.name = name
+        self.burst = burst
+
+
+class RateLimiter:
+    """
+    Token buckets for one connection.
+
+    CHAT_RATE_LIMITS maps a frame type ('*' for any other type) to a
+    (burst, refill per second) pair for 'connection' and/or 'user'.
+    Connection buckets live on the consumer. User buckets live in the
+    shared backend, so a user's limit holds across tabs and nodes.
+    """
+
+    def __init__(self, user_id, backend=None):
+        self.user_id = user_id
+        self.connection_buckets = LocalRateLimitBackend()
+        self.user_buckets = backend or get_rate_limit_backend()
+
+    async def check(self, frame_type, data):
+        """
+        Charge a client frame against its buckets; returns 0 if allowed, else seconds to wait.
+
+        Raises BurstExceeded for a batch that could never be allowed, however long the client waits.
+        """
+        if not getattr(settings, 'CHAT_RATE_LIMIT_ENABLED', True):
+            return 0.0
+        limits = getattr(settings, 'CHAT_RATE_LIMITS', {})
+        charges = collections.Counter()
+        for name, cost in frame_costs(frame_type, data).items():
+            charges[name if name in limits else '*'] += cost
+        for name, cost in charges.items():
+            self.check_burst(name, limits.get(name) or {}, cost)
+
+        # A refused frame costs nothing: give back what earlier buckets took for it
+        charged = []
+        for name, cost in charges.items():
+            charged.append((name, cost))
+            retry_after = await self.take(name, limits.get(name) or {}, cost)
+            if retry_after:
+                for taken_name, taken_cost in charged[:-1]:
+                    await self.refund(taken_name, limits.get(taken_name) or {}, taken_cost)
+                return retry_after
+        return 0.0
+
+    def check_burst(self, name, limits, cost):
+        burst = min(limit[0] for limit in (limits.get('connection'), limits.get('user'), (cost,)) if limit)
+        if cost > burst:
+            raise BurstExceeded(name, burst)
+
+    async def take(self, name, limits, cost):
+        """
+        Take `cost` tokens from both of `name`'s buckets, or from neither; returns 0 or the seconds to wait
+        """
+        connection_limit = limits.get('connection')
+        user_limit = limits.get('user')
+        if connection_limit:
+            retry_after = self.connection_buckets.take_now(name, *connection_limit, cost)
+            if retry_after:
+                return retry_after
+        if user_limit:
+            retry_after = await self.user_buckets.take(f"{self.user_id}:{name}", *user_limit, cost)
+            if retry_after:
+                if connection_limit:
+                    self.connection_buckets.refund_now(name, connection_limit[0], cost)
+                return retry_after
+        return 0.0
+
+    async def refund(self, name, limits, cost):
+        connection_limit = limits.get('connection')
+        user_limit = limits.get('user')
+        if connection_limit:
+            self.connection_buckets.refund_now(name, connection_limit[0], cost)
+        if user_limit:
+            await self.user_buckets.refund(f"{self.user_id}:{name}", user_limit[0], cost)
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+def user_group_name(user_id):
+    return f"user_{user_id}"
+
+
+def room_group_name(room_id):
+    return f"room_{room_id}"
+
+
+def notify_membership(room_id, user_ids, joined):
+    """
+    Tell the users' open connections to join or leave a group room's channel group
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    event = {'type': 'room.membership', 'room_id': room_id, 'joined': joined}
+    for user_id in user_ids:
+        async_to_sync(channel_layer.group_send)(user_group_name(user_id), event)
+
+
+class PeerRoomCache:
+    """
+    Small per-connection LRU mapping a peer user id to its direct room id
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, peer_id):
+        room_id = self._entries.get(peer_id)
+        if room_id is not None:
+            self._entries.move_to_end(peer_id)
+        return room_id
+
+    def set(self, peer_id, room_id):
+        self._entries[peer_id] = room_id
+        self._entries.move_to_end(peer_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
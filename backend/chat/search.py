@@ -0,0 +1,179 @@
+import base64
+import binascii
+import html
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q
+from django.db.models.functions import Cast
+
+from .models import ChatRoom, ChatMessage, ArchivedMessage
+
+# Both must match the indexes created in migrations 0007 and 0008
+SQLITE_FTS_TABLE = 'chat_messages_fts'
+POSTGRES_SEARCH_CONFIG = 'english'
+
+# Control characters cannot occur in stored text, so they mark matches
+# until the snippet has been HTML-escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+SNIPPET_WORDS = 16
+# Above this many rooms a SQLite search ranks every match and joins to the
+# caller's rooms instead of listing the rooms in the FTS5 query
+SQLITE_SCOPE_ROOMS = 200
+
+TERM_RE = re.compile(r'\w+')
+
+
+def encode_search_cursor(message):
+    """
+    Opaque cursor for a result's (score, id) position in ranked order
+    """
+    raw = f"{message.score!r}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_search_cursor(cursor):
+    """
+    Parse a cursor back into (score, id), raising ValueError on bad input
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        score, message_id = raw.split('|')
+        return float(score), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def render_highlight(snippet):
+    """
+    HTML-escape a snippet and turn the match markers into <mark> tags
+    """
+    return html.escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def search_messages(user_id, text, room_id=None, after=None, limit=20):
+    """
+    Ranked full-text search over messages in the rooms a user participates in.
+
+    Uses the FTS5 index on SQLite and the tsvector GIN index on PostgreSQL,
+    over both live and archived messages. Results are best match first, ties broken by newest id; each message
+    gets `score` and an HTML `highlight` snippet. `after` is the cursor of
+    the last result of the previous page. Returns (messages, has_more).
+    Scores move as the index grows, so a cursor pages reliably only while
+    the result set is being read, not across long gaps.
+    """
+    terms = TERM_RE.findall(text)
+    if not terms:
+        raise ValueError("Search query must contain a word")
+    position = decode_search_cursor(after) if after else None
+
+    if connection.vendor == 'sqlite':
+        # One FTS5 index covers both tables
+        ranked = _sqlite_search(user_id, terms, room_id, position, limit + 1)
+    else:
+        search = _postgres_search if connection.vendor == 'postgresql' else _substring_search
+        ranked = sorted(
+            search(ChatMessage, user_id, text, room_id, position, limit + 1)
+            + search(ArchivedMessage, user_id, text, room_id, position, limit + 1),
+            key=lambda result: (result[1], result[0]), reverse=True
+        )
+
+    has_more = len(ranked) > limit
+    ranked = ranked[:limit]
+    ids = [message_id for message_id, _, _ in ranked]
+    messages = ChatMessage.objects.select_related('sender').in_bulk(ids)
+    if len(messages) < len(ids):
+        messages.update(ArchivedMessage.objects.select_related('sender').in_bulk(set(ids) - set(messages)))
+    results = []
+    for message_id, score, snippet in ranked:
+        message = messages.get(message_id)
+        if message is None:
+            # Deleted (or archived) between the index lookup and the fetch
+            continue
+        message.score = score
+        message.highlight = render_highlight(snippet)
+        results.append(message)
+    return results, has_more
+
+
+def _sqlite_search(user_id, terms, room_id, position, limit):
+    # Quoted terms are matched literally, so user input cannot inject FTS5 syntax;
+    # the last term is a prefix, for search-as-you-type
+    match = 'content : (' + ' '.join(f'"{term}"' for term in terms) + '*)'
+    rooms = ChatRoom.objects.filter(participants=user_id)
+    if room_id is not None:
+        rooms = rooms.filter(id=room_id)
+    room_ids = list(rooms.values_list('id', flat=True)[:SQLITE_SCOPE_ROOMS + 1])
+    if not room_ids:
+        return []
+
+    # bm25() is lower for better matches; the room_id column carries no weight
+    score = f"-bm25({SQLITE_FTS_TABLE}, 1.0, 0.0)"
+    sql = [f"SELECT {SQLITE_FTS_TABLE}.rowid, {score}, snippet({SQLITE_FTS_TABLE}, 0, %s, %s, '…', %s)",
+           f"FROM {SQLITE_FTS_TABLE}"]
+    params = [MATCH_START, MATCH_END, SNIPPET_WORDS]
+    if len(room_ids) <= SQLITE_SCOPE_ROOMS:
+        # Intersect with the rooms' postings inside FTS5, so only the caller's
+        # matches are ranked
+        match += ' AND room_id : (' + ' OR '.join(str(room) for room in room_ids) + ')'
+    else:
+        # Too many rooms for one query: rank every match and join to keep the caller's
+        participants = ChatRoom.participants.through._meta.db_table
+        sql += [
+            f"LEFT JOIN {ChatMessage._meta.db_table} m ON m.id = {SQLITE_FTS_TABLE}.rowid",
+            f"LEFT JOIN {ArchivedMessage._meta.db_table} a ON a.id = {SQLITE_FTS_TABLE}.rowid",
+            f"JOIN {participants} p ON p.chatroom_id = COALESCE(m.room_id, a.room_id) AND p.user_id = %s",
+        ]
+        params.append(user_id)
+    sql.append(f"WHERE {SQLITE_FTS_TABLE} MATCH %s")
+    params.append(match)
+    if position is not None:
+        sql.append(f"AND ({score} < %s OR ({score} = %s AND {SQLITE_FTS_TABLE}.rowid < %s))")
+        params.extend([position[0], position[0], position[1]])
+    sql.append(f"ORDER BY {score} DESC, {SQLITE_FTS_TABLE}.rowid DESC LIMIT %s")
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        return cursor.fetchall()
+
+
+def _postgres_search(model, user_id, text, room_id, position, limit):
+    from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVector
+
+    # Must stay identical to the indexed expression for the GIN index to be used
+    vector = SearchVector('content', config=POSTGRES_SEARCH_CONFIG)
+    query = SearchQuery(text, config=POSTGRES_SEARCH_CONFIG, search_type='websearch')
+    messages = (
+        model.objects.filter(room__participants=user_id)
+        .annotate(search=vector)
+        .filter(search=query)
+        .annotate(
+            score=Cast(SearchRank(vector, query), FloatField()),
+            snippet=SearchHeadline(
+                'content', query, config=POSTGRES_SEARCH_CONFIG,
+                start_sel=MATCH_START, stop_sel=MATCH_END, max_words=SNIPPET_WORDS, min_words=SNIPPET_WORDS // 2
+            )
+        )
+    )
+    if room_id is not None:
+        messages = messages.filter(room_id=room_id)
+    if position is not None:
+        score, message_id = position
+        messages = messages.filter(Q(score__lt=score) | Q(score=score, id__lt=message_id))
+    return list(messages.order_by('-score', '-id').values_list('id', 'score', 'snippet')[:limit])
+
+
+def _substring_search(model, user_id, text, room_id, position, limit):
+    # Unindexed fallback for other databases: every term must appear, newest first
+    messages = model.objects.filter(room__participants=user_id)
+    for term in TERM_RE.findall(text):
+        messages = messages.filter(content__icontains=term)
+    if room_id is not None:
+        messages = messages.filter(room_id=room_id)
+    if position is not None:
+        messages = messages.filter(id__lt=position[1])
+    return [
+        (message_id, 0.0, content[:200])
+        for message_id, content in messages.order_by('-id').values_list('id', 'content')[:limit]
+    ]
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import ChatRoom, ChatMessage, MeetingRequest, UserStreak, ActivityLog
+from blobstore.variants import image_variants
+from .models import ChatRoom, ChatMessage, ArchivedMessage, RoomReadCursor, MeetingRequest, UserStreak, ActivityLog
 
 User = get_user_model()
 
@@ -9,12 +10,30 @@ class UserSerializer(serializers.ModelSerializer):
     """
     Simple user serializer for chat
     """
+    is_online = serializers.SerializerMethodField()
+    avatar = serializers.SerializerMethodField()
+    
     class Meta:
         model = User
-        fields = ['id', 'first_name', 'last_name', 'email', 'user_type']
+        fields = ['id', 'first_name', 'last_name', 'email', 'user_type', 'is_online', 'avatar']
     
     def get_full_name(self, obj):
         return f"{obj.first_name} {obj.last_name}".strip()
+    
+    def get_is_online(self, obj):
+        """
+        Online status from the bulk presence lookup passed in the context, if any
+        """
+        online_user_ids = self.context.get('online_user_ids')
+        if online_user_ids is None:
+            return None
+        return obj.id in online_user_ids
+    
+    def get_avatar(self, obj):
+        """
+        Thumbnail URLs of the profile picture, by format
+        """
+        return image_variants(obj.profile_picture, presets=['thumb'])
 
 
 class ChatRoomSerializer(serializers.ModelSerializer):
@@ -31,28 +50,26 @@ class ChatRoomSerializer(serializers.ModelSerializer):
     
     def get_last_message(self, obj):
         """
-        Get the last message in the room
+        Get the last message in the room from the room's snapshot
         """
-        last_message = obj.messages.last()
-        if last_message:
-            return {
-                'id': last_message.id,
-                'content': last_message.content,
-                'sender': last_message.sender.get_full_name(),
-                'message_type': last_message.message_type,
-                'created_at': last_message.created_at
-            }
-        return None
+        return obj.last_message
     
     def get_unread_count(self, obj):
         """
-        Get unread message count for the current user
+        Get unread message count for the current user.
+        
+        Uses the `unread_message_count` annotation from ChatRoom.with_unread_counts
+        when present, otherwise runs the same count for this room, so every
+        endpoint counts live and archived messages alike. Seqs have gaps (write-behind
+        reserves them in blocks), so they are counted as rows, not subtracted.
         """
+        if hasattr(obj, 'unread_message_count'):
+            return obj.unread_message_count
         request = self.context.get('request')
         if request and request.user:
-            return obj.messages.exclude(
-                read_status__user=request.user
-            ).count()
+            return ChatRoom.with_unread_counts(
+                ChatRoom.objects.filter(pk=obj.pk), request.user.id
+            ).values_list('unread_message_count', flat=True).first() or 0
         return 0
 
 
@@ -84,21 +101,106 @@ class ChatMessageSerializer(serializers.ModelSerializer):
                 'file_name': attachment.file_name,
                 'file_url': attachment.file.url,
                 'file_type': attachment.file_type,
-                'file_size': attachment.file_size
+                'file_size': attachment.file_size,
+                'variants': image_variants(attachment.file)
             }
             for attachment in obj.attachments.all()
         ]
     
     def get_is_read(self, obj):
         """
-        Check if message is read by current user
+        Check if message is read by current user, i.e. at or below their read cursor for the room
         """
         request = self.context.get('request')
         if request and request.user:
-            return obj.read_status.filter(user=request.user).exists()
+            # One cursor lookup per room for the whole serialized page
+            read_cursors = self.context.setdefault('read_cursors', {})
+            if obj.room_id not in read_cursors:
+                read_cursors[obj.room_id] = RoomReadCursor.objects.filter(
+                    room_id=obj.room_id, user=request.user
+                ).values_list('last_read_seq', flat=True).first() or 0
+            return obj.seq <= read_cursors[obj.room_id]
         return False
 
 
+class MessageHistorySerializer(serializers.ModelSerializer):
+    """
+    Lean message shape for paginated history: no nested room, compact sender.
+    
+    Expects sender and attachments to be loaded with the page and the
+    reader's `last_read_seq` for the room in the context. Also serializes
+    ArchivedMessage rows, which carry the same attributes.
+    """
+    sender = serializers.SerializerMethodField()
+    attachments = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
+    meeting_data = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = ChatMessage
+        fields = [
+            'id', 'room_id', 'seq', 'client_msg_id', 'sender', 'content', 'message_type',
+            'reply_to_id', 'created_at', 'attachments', 'is_read', 'meeting_data'
+        ]
+        read_only_fields = fields
+    
+    def get_sender(self, obj):
+        return {
+            'id': obj.sender_id,
+            'name': obj.sender.get_full_name(),
+            'email': obj.sender.email
+        }
+    
+    def get_attachments(self, obj):
+        if isinstance(obj, ArchivedMessage):
+            return obj.attachment_data()
+        return [
+            {
+                'id': attachment.id,
+                'file_name': attachment.file_name,
+                'file_url': attachment.file.url,
+                'file_type': attachment.file_type,
+                'file_size': attachment.file_size,
+                'variants': image_variants(attachment.file)
+            }
+            for attachment in obj.attachments.all()
+        ]
+    
+    def get_is_read(self, obj):
+        return obj.seq <= self.context.get('last_read_seq', 0)
+    
+    def get_meeting_data(self, obj):
+        if not obj.message_type.startswith('meeting'):
+            return None
+        return {
+            'datetime': obj.meeting_datetime.isoformat() if obj.meeting_datetime else None,
+            'topic': obj.meeting_topic,
+            'status': obj.meeting_status
+        }
+
+
+class MessageSearchResultSerializer(serializers.ModelSerializer):
+    """
+    Search hit: the message with its relevance score and an HTML snippet with <mark>ed matches
+    """
+    sender = serializers.SerializerMethodField()
+    score = serializers.FloatField(read_only=True)
+    highlight = serializers.CharField(read_only=True)
+    
+    class Meta:
+        model = ChatMessage
+        fields = [
+            'id', 'room_id', 'seq', 'sender', 'content', 'message_type', 'created_at', 'score', 'highlight'
+        ]
+        read_only_fields = fields
+    
+    def get_sender(self, obj):
+        return {
+            'id': obj.sender_id,
+            'name': obj.sender.get_full_name()
+        }
+
+
 class MeetingRequestSerializer(serializers.ModelSerializer):
     """
     Serializer for meeting requests
@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from blobstore.models import Blob
+
+from .archive import archived_attachment_files
+from .models import ChatRoom, ArchivedMessage
+from .rooms import notify_membership
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def group_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep connected members' room channel groups in step with group room membership
+    """
+    if action == 'pre_clear':
+        # pk_set is not provided for clears; remember who is about to be removed
+        if reverse:
+            instance._cleared_chat_rooms = list(instance.chat_rooms.filter(room_type='group').values_list('id', flat=True))
+        elif instance.room_type == 'group':
+            instance._cleared_participants = list(instance.participants.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    
+    joined = action == 'post_add'
+    if reverse:
+        # user.chat_rooms.add(...): instance is the user, pk_set the rooms
+        if action == 'post_clear':
+            room_ids = getattr(instance, '_cleared_chat_rooms', [])
+        else:
+            room_ids = ChatRoom.objects.filter(id__in=pk_set, room_type='group').values_list('id', flat=True)
+        changes = [(room_id, [instance.pk]) for room_id in room_ids]
+    elif instance.room_type == 'group':
+        user_ids = getattr(instance, '_cleared_participants', []) if action == 'post_clear' else list(pk_set)
+        changes = [(instance.pk, user_ids)]
+    else:
+        return
+    
+    for room_id, user_ids in changes:
+        if user_ids:
+            transaction.on_commit(
+                lambda room_id=room_id, user_ids=user_ids: notify_membership(room_id, user_ids, joined)
+            )
+
+
+@receiver(post_delete, sender=ArchivedMessage)
+def archived_message_deleted(sender, instance, **kwargs):
+    """
+    Release the attachment files an archived message kept referenced
+    """
+    Blob.objects.release(archived_attachment_files([instance]))
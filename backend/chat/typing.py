@@ -0,0 +1,77 @@
+import threading
+import time
+
+from django.conf import settings
+
+
+class TypingEntry:
+    __slots__ = ('expires_at', 'last_broadcast')
+
+    def __init__(self, expires_at, last_broadcast):
+        self.expires_at = expires_at
+        self.last_broadcast = last_broadcast
+
+
+class TypingStore:
+    """
+    Ephemeral per-process typing state keyed by (room id, user id).
+
+    "Is typing" expires CHAT_TYPING_TTL seconds after the last keystroke
+    event, and repeated keystroke events are coalesced to at most one
+    broadcast per CHAT_TYPING_INTERVAL seconds. Other nodes never read this
+    store: they learn about typing from the broadcast frames, which carry
+    the TTL so receivers can expire the indicator on their own. Each entry
+    is discarded by its consumer's expiry timer, by a "stopped typing"
+    event or on disconnect, so the store holds only users typing now.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CHAT_TYPING_TTL', 6.0)
+
+    @property
+    def interval(self):
+        return getattr(settings, 'CHAT_TYPING_INTERVAL', 2.0)
+
+    def update(self, room_id, user_id, is_typing, now=None):
+        """
+        Record a typing event, returning True if it should be broadcast
+        """
+        now = now if now is not None else time.monotonic()
+        key = (room_id, user_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            active = entry is not None and entry.expires_at > now
+            if not is_typing:
+                self._entries.pop(key, None)
+                return active
+            if active and now - entry.last_broadcast < self.interval:
+                entry.expires_at = now + self.ttl
+                return False
+            self._entries[key] = TypingEntry(now + self.ttl, now)
+            return True
+
+    def remaining(self, room_id, user_id, now=None):
+        """
+        Seconds until the typing state expires, or None if the user is not typing
+        """
+        now = now if now is not None else time.monotonic()
+        entry = self._entries.get((room_id, user_id))
+        if entry is None:
+            return None
+        return max(0.0, entry.expires_at - now)
+
+    def discard(self, room_id, user_id):
+        """
+        Forget a user's typing state, returning True if it was still active
+        """
+        with self._lock:
+            entry = self._entries.pop((room_id, user_id), None)
+        return entry is not None and entry.expires_at > time.monotonic()
+
+
+typing_store = TypingStore()
@@ -4,10 +4,14 @@ from . import views
 urlpatterns = [
     path('rooms/', views.chat_room_list, name='chat_room_list'),
     path('rooms/<int:room_id>/messages/', views.message_list, name='message_list'),
-    path('rooms/<int:room_id>/messages/', views.create_message, name='create_message'),
+    path('rooms/<int:room_id>/history/', views.message_history, name='message_history'),
+    path('search/', views.message_search, name='message_search'),
     path('meeting-requests/', views.meeting_request_list, name='meeting_request_list'),
     path('meeting-requests/<int:request_id>/approve/', views.approve_meeting_request, name='approve_meeting_request'),
     path('meeting-requests/<int:request_id>/reject/', views.reject_meeting_request, name='reject_meeting_request'),
     path('streaks/', views.user_streak, name='user_streak'),
     path('activity/', views.activity_log, name='activity_log'),
+    path('presence/', views.presence, name='chat_presence'),
+    path('metrics/', views.prometheus_metrics, name='prometheus_metrics'),
+    path('metrics/outbound/', views.outbound_metrics, name='outbound_metrics'),
 ]
@@ -1,9 +1,21 @@
+import hmac
 from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.db import models
 from .models import ChatRoom, ChatMessage, MeetingRequest, UserStreak, ActivityLog
-from .serializers import ChatRoomSerializer, ChatMessageSerializer, MeetingRequestSerializer, UserStreakSerializer, ActivityLogSerializer
+from .serializers import (
+    ChatRoomSerializer, ChatMessageSerializer, MessageHistorySerializer, MessageSearchResultSerializer,
+    MeetingRequestSerializer, UserStreakSerializer, ActivityLogSerializer
+)
+from .history import encode_cursor, history_page, last_read_seq, page_limit
+from .metrics import render_metrics
+from .outbound import outbound_stats
+from .presence import online_user_ids, parse_user_ids
+from .search import encode_search_cursor, search_messages
 
 User = get_user_model()
 
@@ -14,17 +26,33 @@ def chat_room_list(request):
     """
     Get list of user's chat rooms
     """
-    rooms = ChatRoom.objects.filter(participants=request.user).order_by('-updated_at')
-    serializer = ChatRoomSerializer(rooms, many=True, context={'request': request})
+    rooms = list(
+        ChatRoom.with_unread_counts(
+            ChatRoom.objects.filter(participants=request.user), request.user.id
+        )
+        .prefetch_related('participants')
+        .order_by('-updated_at')
+    )
+    participant_ids = {participant.id for room in rooms for participant in room.participants.all()}
+    serializer = ChatRoomSerializer(rooms, many=True, context={
+        'request': request,
+        'online_user_ids': online_user_ids(participant_ids)
+    })
     return Response(serializer.data)
 
 
-@api_view(['GET'])
+@api_view(['GET', 'POST'])
 @permission_classes([permissions.IsAuthenticated])
 def message_list(request, room_id):
     """
-    Get messages for a specific chat room
+    Get messages for a specific chat room, or create one on POST
+    
+    GET returns the whole live history; clients should page with message_history
+    instead, which also reads archived messages.
     """
+    if request.method == 'POST':
+        return create_message(request, room_id)
+    
     try:
         room = ChatRoom.objects.get(id=room_id, participants=request.user)
         messages = ChatMessage.objects.filter(room=room).order_by('created_at')
@@ -34,8 +62,81 @@ def message_list(request, room_id):
         return Response({'error': 'Chat room not found'}, status=status.HTTP_404_NOT_FOUND)
 
 
-@api_view(['POST'])
+@api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
+def message_history(request, room_id):
+    """
+    Get one page of a room's messages (?before=<cursor>, ?after=<cursor>, ?limit=)
+    
+    Without a cursor the newest page is returned. `before` and `after` in the
+    response are cursors for the adjacent older and newer pages, or null
+    when there are none.
+    """
+    room = ChatRoom.objects.filter(id=room_id, participants=request.user).only('id', 'archived_until').first()
+    if room is None:
+        return Response({'error': 'Chat room not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    before = request.query_params.get('before')
+    after = request.query_params.get('after')
+    if before and after:
+        return Response({'error': 'Pass either before or after, not both'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        limit = page_limit(request.query_params.get('limit'))
+        messages, has_more = history_page(
+            room_id, before=before or None, after=after or None, limit=limit, archived_until=room.archived_until
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    serializer = MessageHistorySerializer(messages, many=True, context={
+        'request': request,
+        'last_read_seq': last_read_seq(room_id, request.user.id)
+    })
+    if after:
+        has_older, has_newer = bool(messages), has_more
+    else:
+        has_older, has_newer = has_more, bool(before and messages)
+    return Response({
+        'results': serializer.data,
+        'before': encode_cursor(messages[0]) if has_older else None,
+        'after': encode_cursor(messages[-1]) if has_newer else None
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def message_search(request):
+    """
+    Full-text search over the user's rooms (?q=, ?room=<id>, ?after=<cursor>, ?limit=)
+    
+    Results are ranked best match first, each with an HTML `highlight`
+    snippet. `after` in the response is the cursor for the next page, or
+    null when there are no more results.
+    """
+    room = request.query_params.get('room')
+    if room and not room.isdigit():
+        return Response({'error': 'Invalid room'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        limit = page_limit(request.query_params.get('limit'))
+        messages, has_more = search_messages(
+            request.user.id,
+            request.query_params.get('q', ''),
+            room_id=int(room) if room else None,
+            after=request.query_params.get('after') or None,
+            limit=limit
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    serializer = MessageSearchResultSerializer(messages, many=True, context={'request': request})
+    return Response({
+        'results': serializer.data,
+        'after': encode_search_cursor(messages[-1]) if has_more and messages else None
+    })
+
+
 def create_message(request, room_id):
     """
     Create a new message in a chat room
@@ -142,3 +243,40 @@ def activity_log(request):
     activities = ActivityLog.objects.filter(user=request.user).order_by('-created_at')[:50]
     serializer = ActivityLogSerializer(activities, many=True, context={'request': request})
     return Response(serializer.data)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def presence(request):
+    """
+    Get which of the given users are online (?user_ids=1,2,3)
+    """
+    try:
+        user_ids = parse_user_ids(request.query_params.get('user_ids', ''))
+    except ValueError:
+        return Response({'error': 'Invalid user_ids'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    online = online_user_ids(user_ids)
+    return Response({'online': [user_id for user_id in user_ids if user_id in online]})
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def outbound_metrics(request):
+    """
+    Outbound queue depth and drop counters for this server process's WebSocket connections
+    """
+    return Response(outbound_stats.snapshot())
+
+
+def prometheus_metrics(request):
+    """
+    Chat metrics in Prometheus text format for scrapers sending `Authorization: Bearer <CHAT_METRICS_TOKEN>`
+    """
+    token = getattr(settings, 'CHAT_METRICS_TOKEN', '')
+    if not token:
+        return HttpResponse(status=404)
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401)
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
@@ -0,0 +1,151 @@
+import json
+
+import msgpack
+from django.conf import settings
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+JSON_SUBPROTOCOL = 'chat.json.v1'
+
+# Short keys for the msgpack encoding. Append only: changing or reusing a
+# code breaks deployed clients and needs a new subprotocol version.
+# Keys not listed here are sent as-is.
+SHORT_KEYS = {
+    'type': 't',
+    'data': 'd',
+    'message': 'm',
+    'messages': 'ms',
+    'room_id': 'r',
+    'seq': 'q',
+    'client_msg_id': 'cm',
+    'sender': 's',
+    'name': 'n',
+    'email': 'e',
+    'content': 'c',
+    'message_type': 'mt',
+    'reply_to_id': 'rt',
+    'created_at': 'ca',
+    'attachments': 'a',
+    'is_read': 'ir',
+    'meeting_data': 'md',
+    'meeting_request': 'mr',
+    'datetime': 'dt',
+    'topic': 'tp',
+    'status': 'st',
+    'requester': 'rq',
+    'recipient': 'rc',
+    'user_id': 'u',
+    'user_name': 'un',
+    'user_ids': 'us',
+    'to_user': 'to',
+    'is_typing': 'it',
+    'expires_in': 'ex',
+    'online': 'on',
+    'rooms': 'rs',
+    'last_seq': 'ls',
+    'last_read_seq': 'lr',
+    'has_more': 'hm',
+    'joined': 'j',
+    'message_id': 'mi',
+    'meeting_id': 'mg',
+    'file_name': 'fn',
+    'file_url': 'fu',
+    'file_type': 'ft',
+    'file_size': 'fs',
+    'ops': 'o',
+    'results': 'rl',
+    'index': 'x',
+    'ok': 'k',
+    'error': 'er',
+    'created': 'cr',
+    'code': 'co',
+    'frame_type': 'fy',
+    'retry_after': 'ra',
+    'limit': 'li',
+    'variants': 'vr',
+    'avatar': 'av',
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+
+def rename_keys(value, table):
+    if isinstance(value, dict):
+        return {table.get(key, key): rename_keys(item, table) for key, item in value.items()}
+    if isinstance(value, list):
+        return [rename_keys(item, table) for item in value]
+    return value
+
+
+class JsonCodec:
+    """
+    Default encoding: JSON text frames, for clients that negotiate no subprotocol
+    """
+
+    name = 'json'
+    label = 'JSON'
+
+    def __init__(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    def encode(self, frame):
+        return json.dumps(frame)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise ValueError("Expected a text frame")
+        return json.loads(text_data)
+
+    def from_event(self, event):
+        return event['text']
+
+
+class MsgpackCodec:
+    """
+    Compact encoding: MessagePack binary frames with the SHORT_KEYS table applied
+    """
+
+    name = 'msgpack'
+    label = 'MessagePack'
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, frame):
+        return msgpack.packb(rename_keys(frame, SHORT_KEYS))
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError("Expected a binary frame")
+        try:
+            return rename_keys(msgpack.unpackb(bytes_data, strict_map_key=False), LONG_KEYS)
+        except (msgpack.UnpackException, ValueError) as e:
+            raise ValueError("Invalid MessagePack frame") from e
+
+    def from_event(self, event):
+        if 'packed' in event:
+            return event['packed']
+        # Event from a node that only sends the JSON encoding
+        return self.encode(json.loads(event['text']))
+
+
+def msgpack_enabled():
+    return getattr(settings, 'CHAT_WIRE_MSGPACK', False)
+
+
+def negotiate_codec(subprotocols):
+    """
+    Pick the codec for the subprotocols a client offered, in the client's order of preference
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol == MSGPACK_SUBPROTOCOL and msgpack_enabled():
+            return MsgpackCodec()
+        if subprotocol == JSON_SUBPROTOCOL:
+            return JsonCodec(JSON_SUBPROTOCOL)
+    return JsonCodec()
+
+
+def encode_event(frame):
+    """
+    Channel layer payload for a frame, encoded once per wire format
+    """
+    payload = {'text': json.dumps(frame)}
+    if msgpack_enabled():
+        payload['packed'] = msgpack.packb(rename_keys(frame, SHORT_KEYS))
+    return payload
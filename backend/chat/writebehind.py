@@ -0,0 +1,236 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .batching import BatchWriter
+from .models import ChatRoom, ChatMessage, RoomReadCursor
+
+logger = logging.getLogger(__name__)
+
+# Custom epoch for generated message ids (2024-01-01T00:00:00Z, in ms)
+ID_EPOCH_MS = 1704067200000
+
+
+class MessageIdGenerator:
+    """
+    Time-ordered 63-bit message ids: 41 bits of milliseconds since ID_EPOCH_MS,
+    10 bits of worker id and a 12-bit per-millisecond counter.
+    """
+
+    def __init__(self, worker_id=None):
+        if worker_id is None:
+            worker_id = getattr(settings, 'CHAT_WORKER_ID', None)
+        if worker_id is None:
+            worker_id = os.getpid()
+        self.worker_id = int(worker_id) & 0x3FF
+        self._last_ms = 0
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+            if now_ms <= self._last_ms:
+                now_ms = self._last_ms
+                self._counter = (self._counter + 1) & 0xFFF
+                if self._counter == 0:
+                    # Counter exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self._counter = 0
+            self._last_ms = now_ms
+            return (now_ms << 22) | (self.worker_id << 12) | self._counter
+
+
+class MessageWriteBuffer:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    Messages get an id and a per-room sequence number up front so they can be
+    broadcast immediately; they are persisted with bulk_create once
+    CHAT_WRITE_BEHIND_BATCH_SIZE messages are pending or
+    CHAT_WRITE_BEHIND_INTERVAL seconds have passed. Sequence numbers are
+    reserved from ChatRoom.last_seq in blocks, so they are unique and
+    increasing per room but may have gaps.
+
+    A message with a client_msg_id is the exception: the database's unique
+    constraint on it is what catches a retry that reached another worker,
+    so it is released for broadcast only once its batch shows it inserted.
+    """
+
+    def __init__(self):
+        self.id_generator = MessageIdGenerator()
+        self.writer = BatchWriter(
+            write_messages,
+            'CHAT_WRITE_BEHIND_BATCH_SIZE', 'CHAT_WRITE_BEHIND_INTERVAL',
+            default_batch_size=200, default_interval=0.05
+        )
+        self._seq_blocks = {}
+        self._recent = OrderedDict()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'CHAT_WRITE_BEHIND', False)
+
+    @property
+    def seq_block(self):
+        return getattr(settings, 'CHAT_WRITE_BEHIND_SEQ_BLOCK', 100)
+
+    @property
+    def dedupe_window(self):
+        return getattr(settings, 'CHAT_WRITE_BEHIND_DEDUPE_WINDOW', 10000)
+
+    @property
+    def pending_count(self):
+        return self.writer.pending_count
+
+    async def next_seq(self, room_id):
+        """
+        Hand out the next sequence number for a room, reserving a new block when needed
+        """
+        block = self._seq_blocks.get(room_id)
+        while block is None or block[0] > block[1]:
+            end = await database_sync_to_async(ChatRoom.allocate_seq)(room_id, self.seq_block)
+            block = self._seq_blocks.get(room_id)
+            if block is None or block[0] > block[1]:
+                block = self._seq_blocks[room_id] = [end - self.seq_block + 1, end]
+        seq = block[0]
+        block[0] += 1
+        return seq
+
+    def lookup(self, sender_id, client_msg_id):
+        """
+        Return a recently saved message for a retried client_msg_id
+        """
+        if not client_msg_id:
+            return None
+        return self._recent.get((sender_id, client_msg_id))
+
+    def remember(self, message):
+        self._recent[(message.sender_id, message.client_msg_id)] = message
+        while len(self._recent) > self.dedupe_window:
+            self._recent.popitem(last=False)
+
+    async def add(self, room_id, sender_id, content, client_msg_id=None, message_type='message', sender_name=None):
+        """
+        Accept a message for write-behind persistence.
+
+        Returns (message, created). Without a client_msg_id the message is
+        returned at once, before it is written. With one, it is returned
+        once written; created is False, with the stored message, when that
+        client_msg_id was already saved, whether by this process, another
+        worker or before a restart.
+        """
+        if client_msg_id:
+            existing = self.lookup(sender_id, client_msg_id)
+            if existing is None:
+                existing = await database_sync_to_async(find_sent_message)(sender_id, client_msg_id)
+            if existing is not None:
+                self.remember(existing)
+                return existing, False
+
+        seq = await self.next_seq(room_id)
+        now = timezone.now()
+        message = ChatMessage(
+            id=self.id_generator.next_id(),
+            room_id=room_id,
+            sender_id=sender_id,
+            sender_name=sender_name,
+            content=content,
+            message_type=message_type,
+            seq=seq,
+            client_msg_id=client_msg_id or None,
+            created_at=now,
+            updated_at=now
+        )
+
+        if not client_msg_id:
+            self.writer.add(message)
+            return message, True
+
+        inserted = await self.writer.write(message)
+        created = message.id in inserted
+        if not created:
+            # The same client_msg_id was written first, e.g. by a retry racing on another worker
+            message = await database_sync_to_async(find_sent_message)(sender_id, client_msg_id)
+            if message is None:
+                raise ChatMessage.DoesNotExist(f"Chat message {client_msg_id!r} of user {sender_id} was not saved")
+        self.remember(message)
+        return message, created
+
+    async def flush(self):
+        """
+        Persist every pending message
+        """
+        return await self.writer.flush()
+
+
+def find_sent_message(sender_id, client_msg_id):
+    return ChatMessage.objects.filter(sender_id=sender_id, client_msg_id=client_msg_id).first()
+
+
+def write_messages(messages):
+    """
+    Insert a batch of messages, falling back to row-by-row inserts if the batch fails.
+
+    Returns the ids actually inserted: rows a unique constraint skipped, or
+    that failed on their own, are left out, and only inserted rows move read
+    cursors and last-message snapshots.
+    """
+    try:
+        ChatMessage.objects.bulk_create(messages, ignore_conflicts=True)
+    except Exception as e:
+        logger.error(f"Chat message batch insert failed, retrying individually: {e}")
+        for message in messages:
+            try:
+                ChatMessage.objects.bulk_create([message], ignore_conflicts=True)
+            except Exception as e:
+                logger.error(f"Dropping chat message {message.id} in room {message.room_id}: {e}")
+
+    # ignore_conflicts reports nothing about skipped rows, so ask
+    inserted = set(ChatMessage.objects.filter(id__in=[message.id for message in messages]).values_list('id', flat=True))
+    if len(inserted) < len(messages):
+        logger.warning(f"{len(messages) - len(inserted)} of {len(messages)} buffered chat messages were not inserted")
+    saved = [message for message in messages if message.id in inserted]
+    advance_sender_cursors(saved)
+    record_last_messages(saved)
+    return inserted
+
+
+def advance_sender_cursors(messages):
+    """
+    Move each sender's read cursor to their latest message in the batch
+    """
+    latest = {}
+    for message in messages:
+        key = (message.room_id, message.sender_id)
+        latest[key] = max(latest.get(key, 0), message.seq)
+    for (room_id, sender_id), seq in latest.items():
+        try:
+            RoomReadCursor.advance(room_id, sender_id, seq)
+        except Exception as e:
+            logger.error(f"Failed to advance read cursor for user {sender_id} in room {room_id}: {e}")
+
+
+def record_last_messages(messages):
+    """
+    Update the last-message snapshot of each room with its newest message in the batch
+    """
+    latest = {}
+    for message in messages:
+        if message.room_id not in latest or message.seq > latest[message.room_id].seq:
+            latest[message.room_id] = message
+    for message in latest.values():
+        try:
+            ChatRoom.record_last_message(message)
+        except Exception as e:
+            logger.error(f"Failed to record last message for room {message.room_id}: {e}")
+
+
+message_buffer = MessageWriteBuffer()
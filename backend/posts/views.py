@@ -2,6 +2,7 @@ from rest_framework import status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
+from blobstore.variants import image_variants
 from .models import Post, Comment, Like
 
 User = get_user_model()
@@ -13,7 +14,7 @@ def post_list(request):
     """
     Get list of posts
     """
-    posts = Post.objects.all().order_by('-created_at')
+    posts = Post.objects.select_related('author').order_by('-created_at')
     data = []
     for post in posts:
         data.append({
@@ -21,10 +22,13 @@ def post_list(request):
             'title': post.title,
             'content': post.content,
             'post_type': post.post_type,
+            'image_url': post.image.url if post.image else None,
+            'image_variants': image_variants(post.image),
             'author': {
                 'id': post.author.id,
                 'name': post.author.get_full_name(),
-                'user_type': post.author.user_type
+                'user_type': post.author.user_type,
+                'avatar': image_variants(post.author.profile_picture, presets=['thumb'])
             },
             'likes_count': post.likes.count(),
             'comments_count': post.comments.count(),
@@ -1,19 +1,56 @@
 import pytest
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from django.conf import settings
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APITestCase
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from unittest.mock import patch, MagicMock
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator
+from prometheus_client import REGISTRY
 import json
+from datetime import timedelta
+from io import BytesIO, StringIO
+from PIL import Image
 
 from accounts.models import User, Interest, UserInterest, AlumniProfile, StudentProfile
 from posts.models import Post, Comment, Like
 from events.models import Event, EventRegistration
 from mentorship.models import MentorshipProgram, MentorshipRequest
 from crowdfunding.models import CrowdfundingCampaign, Donation
-from chat.models import ChatRoom, ChatMessage, MeetingRequest, UserStreak, ActivityLog
+from chat.models import (
+    ChatRoom, ChatMessage, ArchivedMessage, MessageAttachment, MeetingRequest, RoomReadCursor, UserStreak, ActivityLog
+)
+from alumni_backend.executor import DatabaseExecutor, ExecutorASGIHandler
+from blobstore.models import Blob
+from blobstore.imaging import render_variants
+from blobstore.storage import ContentAddressedStorage
+from blobstore.variants import (
+    all_specs, ensure_variant, get_variant_pool, image_variants, schedule_variants, variant_name, variant_storage
+)
+from chat.archive import archive_batch, archive_cutoff
+from chat.history import missed_messages
+from chat.presence import get_presence_backend
+from chat.serializers import ChatRoomSerializer, UserSerializer as ChatUserSerializer
 
 User = get_user_model()
 
@@ -390,6 +427,909 @@ class ChatAPITests(APITestCase):
         self.assertEqual(response.data['topic'], 'Career Discussion')
 
 
+class ChatPresenceAPITests(APITestCase):
+    """Test cases for bulk online-status lookups"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username='presenceapi1',
+            email='presenceapi1@example.com',
+            password='user1pass123',
+            first_name='User',
+            last_name='One',
+            user_type='student'
+        )
+        self.user2 = User.objects.create_user(
+            username='presenceapi2',
+            email='presenceapi2@example.com',
+            password='user2pass123',
+            first_name='User',
+            last_name='Two',
+            user_type='alumni'
+        )
+        refresh = RefreshToken.for_user(self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        
+        ChatRoom.get_or_create_direct(self.user1.id, self.user2.id)
+        self.presence = get_presence_backend()
+        async_to_sync(self.presence.add)(self.user2.id, 'test.channel', 60)
+    
+    def tearDown(self):
+        async_to_sync(self.presence.remove)(self.user2.id, 'test.channel')
+    
+    def test_presence_endpoint(self):
+        """Test bulk presence lookup over REST"""
+        response = self.client.get(f'/api/chat/presence/?user_ids={self.user1.id},{self.user2.id}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['online'], [self.user2.id])
+    
+    def test_presence_endpoint_rejects_bad_ids(self):
+        """Test that malformed ids are rejected"""
+        response = self.client.get('/api/chat/presence/?user_ids=1,abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_room_list_shows_online_participants(self):
+        """Test that the room list marks online participants"""
+        response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        participants = {p['id']: p['is_online'] for p in response.data[0]['participants']}
+        self.assertEqual(participants, {self.user1.id: False, self.user2.id: True})
+
+
+class ChatUnreadCountAPITests(APITestCase):
+    """Test cases for watermark-based unread counts"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username='unreadapi1',
+            email='unreadapi1@example.com',
+            password='user1pass123',
+            first_name='User',
+            last_name='One',
+            user_type='student'
+        )
+        self.user2 = User.objects.create_user(
+            username='unreadapi2',
+            email='unreadapi2@example.com',
+            password='user2pass123',
+            first_name='User',
+            last_name='Two',
+            user_type='alumni'
+        )
+        refresh = RefreshToken.for_user(self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        
+        self.room = ChatRoom.get_or_create_direct(self.user1.id, self.user2.id)
+        for i in range(3):
+            ChatMessage.objects.create(room=self.room, sender=self.user2, content=f'Message {i}')
+    
+    def test_room_list_unread_count(self):
+        """Test that unread counts follow the read cursor"""
+        response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data[0]['unread_count'], 3)
+        
+        RoomReadCursor.advance(self.room.id, self.user1.id, 2)
+        response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.data[0]['unread_count'], 1)
+        
+        # Replying marks everything before the reply as read
+        ChatMessage.objects.create(room=self.room, sender=self.user1, content='Reply')
+        response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.data[0]['unread_count'], 0)
+
+
+class ChatRoomListAPITests(APITestCase):
+    """Test cases for the room list's last-message snapshots"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='roomlistapi',
+            email='roomlistapi@example.com',
+            password='userpass123',
+            first_name='Room',
+            last_name='Lister',
+            user_type='student'
+        )
+        self.peers = [
+            User.objects.create_user(
+                username=f'roomlistpeer{i}',
+                email=f'roomlistpeer{i}@example.com',
+                password='peerpass123',
+                first_name='Peer',
+                last_name=str(i),
+                user_type='alumni'
+            )
+            for i in range(3)
+        ]
+        refresh = RefreshToken.for_user(self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+    
+    def add_room(self, peer):
+        room = ChatRoom.get_or_create_direct(self.user.id, peer.id)
+        ChatMessage.objects.create(room=room, sender=peer, content=f'Hello from {peer.last_name}')
+        return room
+    
+    def count_room_list_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries), response
+    
+    def test_room_list_query_count_is_constant(self):
+        """Test that the room list does not query per room"""
+        self.add_room(self.peers[0])
+        one_room_queries, response = self.count_room_list_queries()
+        self.assertEqual(response.data[0]['last_message']['content'], 'Hello from 0')
+        self.assertEqual(response.data[0]['last_message']['sender'], 'Peer 0')
+        
+        for peer in self.peers[1:]:
+            self.add_room(peer)
+        three_room_queries, response = self.count_room_list_queries()
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(three_room_queries, one_room_queries)
+    
+    def test_create_message_updates_snapshot(self):
+        """Test that messages posted over REST update the room snapshot"""
+        room = self.add_room(self.peers[0])
+        response = self.client.post(f'/api/chat/rooms/{room.id}/messages/', {'content': 'Reply'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        room.refresh_from_db()
+        self.assertEqual(room.last_message['id'], response.data['id'])
+        self.assertEqual(room.last_message['sender'], 'Room Lister')
+    
+    def test_backfill_last_message_command(self):
+        """Test backfilling snapshots for rooms that predate them"""
+        room = self.add_room(self.peers[0])
+        ChatRoom.objects.filter(id=room.id).update(last_message=None, last_message_seq=0)
+        
+        call_command('backfill_last_message', stdout=StringIO())
+        
+        room.refresh_from_db()
+        self.assertEqual(room.last_message['content'], 'Hello from 0')
+        self.assertEqual(room.last_message_seq, 1)
+
+
+class ChatHistoryAPITests(APITestCase):
+    """Test cases for keyset-paginated message history"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username='historyapi1',
+            email='historyapi1@example.com',
+            password='user1pass123',
+            first_name='User',
+            last_name='One',
+            user_type='student'
+        )
+        self.user2 = User.objects.create_user(
+            username='historyapi2',
+            email='historyapi2@example.com',
+            password='user2pass123',
+            first_name='User',
+            last_name='Two',
+            user_type='alumni'
+        )
+        refresh = RefreshToken.for_user(self.user1)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        
+        self.room = ChatRoom.get_or_create_direct(self.user1.id, self.user2.id)
+        self.messages = [
+            ChatMessage.objects.create(room=self.room, sender=self.user2, content=f'Message {i}')
+            for i in range(7)
+        ]
+        self.url = f'/api/chat/rooms/{self.room.id}/history/'
+    
+    def contents(self, response):
+        return [message['content'] for message in response.data['results']]
+    
+    def test_pages_backwards_and_forwards(self):
+        """Test walking history with before and after cursors"""
+        newest = self.client.get(self.url, {'limit': 3})
+        self.assertEqual(newest.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.contents(newest), ['Message 4', 'Message 5', 'Message 6'])
+        self.assertIsNone(newest.data['after'])
+        self.assertNotIn('room', newest.data['results'][0])
+        self.assertEqual(newest.data['results'][0]['sender']['id'], self.user2.id)
+        
+        older = self.client.get(self.url, {'limit': 3, 'before': newest.data['before']})
+        self.assertEqual(self.contents(older), ['Message 1', 'Message 2', 'Message 3'])
+        
+        oldest = self.client.get(self.url, {'limit': 3, 'before': older.data['before']})
+        self.assertEqual(self.contents(oldest), ['Message 0'])
+        self.assertIsNone(oldest.data['before'])
+        
+        newer = self.client.get(self.url, {'limit': 3, 'after': oldest.data['after']})
+        self.assertEqual(self.contents(newer), ['Message 1', 'Message 2', 'Message 3'])
+    
+    def test_page_query_count_is_constant(self):
+        """Test that attachments and read state are loaded per page, not per message"""
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url, {'limit': 2})
+        with CaptureQueriesContext(connection) as large:
+            self.client.get(self.url, {'limit': 7})
+        self.assertEqual(len(small), len(large))
+    
+    def test_read_state_follows_cursor(self):
+        """Test that is_read reflects the reader's cursor"""
+        RoomReadCursor.advance(self.room.id, self.user1.id, self.messages[1].seq)
+        response = self.client.get(self.url)
+        self.assertEqual([message['is_read'] for message in response.data['results']], [True, True] + [False] * 5)
+    
+    def test_rejects_bad_cursor(self):
+        """Test that malformed cursors are rejected"""
+        response = self.client.get(self.url, {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ChatSearchAPITests(APITestCase):
+    """Test cases for full-text search over chat history"""
+    
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                username=f'searchapi{i}',
+                email=f'searchapi{i}@example.com',
+                password='searchpass123',
+                first_name='Search',
+                last_name=f'User{i}',
+                user_type='student'
+            )
+            for i in range(3)
+        ]
+        refresh = RefreshToken.for_user(self.users[0])
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+        
+        self.room = ChatRoom.get_or_create_direct(self.users[0].id, self.users[1].id)
+        self.other_room = ChatRoom.get_or_create_direct(self.users[1].id, self.users[2].id)
+        ChatMessage.objects.create(room=self.room, sender=self.users[1], content='Any internship openings this summer?')
+        ChatMessage.objects.create(room=self.room, sender=self.users[0], content='Lunch tomorrow?')
+        ChatMessage.objects.create(room=self.other_room, sender=self.users[2], content='Internship referral please')
+        self.url = '/api/chat/search/'
+    
+    def contents(self, response):
+        return [message['content'] for message in response.data['results']]
+    
+    def test_search_is_limited_to_callers_rooms(self):
+        """Test that matches in rooms the caller is not in are not returned"""
+        response = self.client.get(self.url, {'q': 'internship'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.contents(response), ['Any internship openings this summer?'])
+        self.assertIsNone(response.data['after'])
+        
+        response = self.client.get(self.url, {'q': 'internship', 'room': self.other_room.id})
+        self.assertEqual(response.data['results'], [])
+
+        # Room ids are indexed alongside content but never match query words
+        self.assertEqual(self.client.get(self.url, {'q': str(self.room.id)}).data['results'], [])
+
+    def test_scope_falls_back_to_join_for_many_rooms(self):
+        """Test that callers in more rooms than fit in one FTS query get the same scoping"""
+        with patch('chat.search.SQLITE_SCOPE_ROOMS', 0):
+            response = self.client.get(self.url, {'q': 'internship'})
+        self.assertEqual(self.contents(response), ['Any internship openings this summer?'])
+
+    def test_results_are_ranked_and_highlighted(self):
+        """Test ranking, stemming and escaped highlight snippets"""
+        ChatMessage.objects.create(
+            room=self.room, sender=self.users[1], content='<b>Internships</b>: internship fair, internship list'
+        )
+        response = self.client.get(self.url, {'q': 'internships'})
+        results = response.data['results']
+        self.assertEqual(len(results), 2)
+        self.assertGreaterEqual(results[0]['score'], results[1]['score'])
+        self.assertEqual(results[0]['content'], '<b>Internships</b>: internship fair, internship list')
+        self.assertIn('&lt;b&gt;<mark>Internships</mark>&lt;/b&gt;', results[0]['highlight'])
+        self.assertNotIn('<b>', results[0]['highlight'])
+    
+    def test_pages_with_cursor(self):
+        """Test that following cursors returns every match exactly once"""
+        for i in range(5):
+            ChatMessage.objects.create(room=self.room, sender=self.users[1], content=f'Alumni meetup number {i}')
+        
+        seen = []
+        params = {'q': 'meetup', 'limit': 2}
+        while True:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            seen.extend(message['id'] for message in response.data['results'])
+            if not response.data['after']:
+                break
+            params['after'] = response.data['after']
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+    
+    def test_index_follows_bulk_inserts_edits_and_deletes(self):
+        """Test that write-behind bulk inserts, edits and deletes are reflected in results"""
+        ChatMessage.objects.bulk_create([ChatMessage(
+            room=self.room, sender=self.users[1], content='Buffered placement update', seq=ChatRoom.allocate_seq(self.room.id)
+        )])
+        self.assertEqual(self.contents(self.client.get(self.url, {'q': 'placement'})), ['Buffered placement update'])
+        
+        message = ChatMessage.objects.get(content='Lunch tomorrow?')
+        message.content = 'Dinner tomorrow?'
+        message.save()
+        self.assertEqual(self.contents(self.client.get(self.url, {'q': 'lunch'})), [])
+        self.assertEqual(self.contents(self.client.get(self.url, {'q': 'dinner'})), ['Dinner tomorrow?'])
+        
+        message.delete()
+        self.assertEqual(self.contents(self.client.get(self.url, {'q': 'dinner'})), [])
+    
+    def test_rejects_empty_query_and_bad_cursor(self):
+        """Test that queries without words and malformed cursors are rejected"""
+        self.assertEqual(self.client.get(self.url, {'q': ' "*" '}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.get(self.url, {'q': 'internship', 'after': 'not-a-cursor'}).status_code,
+            status.HTTP_400_BAD_REQUEST
+        )
+
+
+class ChatArchiveTests(APITestCase):
+    """Test cases for the cold-message archive and the reads that go through it"""
+    
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                username=f'archiveuser{i}',
+                email=f'archiveuser{i}@example.com',
+                password='archivepass123',
+                first_name='Archive',
+                last_name=f'User{i}',
+                user_type='student'
+            )
+            for i in range(2)
+        ]
+        refresh = RefreshToken.for_user(self.users[0])
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {refresh.access_token}')
+    
+        self.room = ChatRoom.get_or_create_direct(self.users[0].id, self.users[1].id)
+        old = timezone.now() - timedelta(days=400)
+        for i in range(5):
+            ChatMessage.objects.create(
+                room=self.room, sender=self.users[1], content=f'Old campus note {i}', created_at=old + timedelta(minutes=i)
+            )
+        for i in range(3):
+            ChatMessage.objects.create(room=self.room, sender=self.users[1], content=f'Recent note {i}')
+    
+    def archive(self, *args):
+        out = StringIO()
+        call_command('archive_chat_messages', '--older-than-days', '365', *args, stdout=out)
+        return out.getvalue()
+    
+    def test_command_moves_old_messages_in_batches(self):
+        """Test that old messages move to the archive and the room records how far"""
+        self.assertIn('5 messages', self.archive('--dry-run'))
+        self.assertEqual(ArchivedMessage.objects.count(), 0)
+    
+        self.archive('--batch-size', '2', '--max-batches', '1')
+        self.assertEqual(ArchivedMessage.objects.count(), 2)
+        # A rerun carries on with what is left
+        output = self.archive('--batch-size', '2')
+        self.assertIn('Archived 3 messages', output)
+    
+        self.assertEqual(ChatMessage.objects.filter(room=self.room).count(), 3)
+        self.assertEqual(
+            sorted(ArchivedMessage.objects.values_list('seq', flat=True)), [1, 2, 3, 4, 5]
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.archived_seq, 5)
+        self.assertEqual(self.room.archived_until, ArchivedMessage.objects.get(seq=5).created_at)
+    
+        with self.assertRaises(CommandError):
+            call_command('archive_chat_messages', '--older-than-days', '0', stdout=StringIO())
+    
+    def test_referenced_messages_stay_live(self):
+        """Test that meeting requests and replied-to messages are not archived, attachments are kept"""
+        old = timezone.now() - timedelta(days=400)
+        meeting = ChatMessage.objects.create(
+            room=self.room, sender=self.users[0], content='Meeting request', message_type='meeting_request',
+            meeting_topic='Career chat', created_at=old
+        )
+        MeetingRequest.objects.create(
+            requester=self.users[0], recipient=self.users[1], room=self.room, message=meeting,
+            datetime=old, topic='Career chat'
+        )
+        parent = ChatMessage.objects.filter(content='Old campus note 0').get()
+        ChatMessage.objects.create(room=self.room, sender=self.users[0], content='Still relevant', reply_to=parent)
+        MessageAttachment.objects.create(
+            message=ChatMessage.objects.get(content='Old campus note 1'),
+            file='chat/attachments/notes.pdf', file_name='notes.pdf', file_size=10, file_type='application/pdf'
+        )
+    
+        self.archive()
+        self.assertTrue(ChatMessage.objects.filter(id=meeting.id).exists())
+        self.assertTrue(ChatMessage.objects.filter(id=parent.id).exists())
+        archived = ArchivedMessage.objects.get(content='Old campus note 1')
+        self.assertEqual(archived.attachment_data()[0]['file_name'], 'notes.pdf')
+        self.assertFalse(MessageAttachment.objects.exists())
+    
+    def test_history_reads_through_to_archive(self):
+        """Test that history pages merge live and archived messages in order"""
+        self.archive()
+        url = f'/api/chat/rooms/{self.room.id}/history/'
+        response = self.client.get(url, {'limit': 4})
+        self.assertEqual(
+            [message['content'] for message in response.data['results']],
+            ['Old campus note 4', 'Recent note 0', 'Recent note 1', 'Recent note 2']
+        )
+    
+        response = self.client.get(url, {'limit': 4, 'before': response.data['before']})
+        self.assertEqual(
+            [message['seq'] for message in response.data['results']], [1, 2, 3, 4]
+        )
+        self.assertIsNone(response.data['before'])
+    
+        response = self.client.get(url, {'limit': 10, 'after': response.data['after']})
+        self.assertEqual([message['seq'] for message in response.data['results']], [5, 6, 7, 8])
+    
+    def test_unread_counts_sync_and_search_include_archive(self):
+        """Test that unread counts, reconnect sync and search see archived messages"""
+        self.archive()
+        response = self.client.get('/api/chat/rooms/')
+        self.assertEqual(response.data[0]['unread_count'], 8)
+    
+        [(room_id, _, _, messages, has_more)] = missed_messages(self.users[0].id, {self.room.id: 2}, 10)
+        self.assertEqual([message.seq for message in messages], [3, 4, 5, 6, 7, 8])
+        self.assertFalse(has_more)
+    
+        response = self.client.get('/api/chat/search/', {'q': 'campus'})
+        self.assertEqual(len(response.data['results']), 5)
+        self.assertIn('<mark>campus</mark>', response.data['results'][0]['highlight'])
+    
+    def test_unread_count_without_annotation_includes_archive(self):
+        """Test that a room serialized without the unread annotation counts archived messages like the room list"""
+        self.archive()
+        RoomReadCursor.objects.filter(room=self.room, user=self.users[0]).update(last_read_seq=2)
+        # Seqs reserved in a block and never used
+        ChatRoom.allocate_seq(self.room.id, 100)
+        self.room.refresh_from_db()
+        
+        data = ChatRoomSerializer(self.room, context={'request': MagicMock(user=self.users[0])}).data
+        self.assertEqual(data['unread_count'], 6)
+        self.assertEqual(self.client.get('/api/chat/rooms/').data[0]['unread_count'], 6)
+    
+    def test_newest_page_mixes_live_messages_older_than_the_archive(self):
+        """Test that the newest page is exact when a live message is older than archived ones"""
+        pinned = ChatMessage.objects.create(
+            room=self.room, sender=self.users[0], content='Meeting request', message_type='meeting_request',
+            meeting_topic='Career chat', created_at=timezone.now() - timedelta(days=500)
+        )
+        MeetingRequest.objects.create(
+            requester=self.users[0], recipient=self.users[1], room=self.room, message=pinned,
+            datetime=pinned.created_at, topic='Career chat'
+        )
+        self.archive()
+        
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/history/', {'limit': 6})
+        self.assertEqual(
+            [message['content'] for message in response.data['results']],
+            ['Old campus note 2', 'Old campus note 3', 'Old campus note 4', 'Recent note 0', 'Recent note 1', 'Recent note 2']
+        )
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/history/', {'limit': 6, 'before': response.data['before']})
+        self.assertEqual(
+            [message['content'] for message in response.data['results']],
+            ['Meeting request', 'Old campus note 0', 'Old campus note 1']
+        )
+
+
+class MediaBlobStoreTests(TestCase):
+    """Test cases for the content-addressed, reference-counted media storage"""
+    
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        
+        self.user = User.objects.create_user(
+            username='blobuser',
+            email='blobuser@example.com',
+            password='blobpass123',
+            first_name='Blob',
+            last_name='User',
+            user_type='student'
+        )
+        other = User.objects.create_user(
+            username='blobpeer',
+            email='blobpeer@example.com',
+            password='blobpass123',
+            first_name='Blob',
+            last_name='Peer',
+            user_type='alumni'
+        )
+        self.room = ChatRoom.get_or_create_direct(self.user.id, other.id)
+    
+    def attach(self, content, name='notes.pdf', **message_fields):
+        message = ChatMessage.objects.create(room=self.room, sender=self.user, content='See attached', **message_fields)
+        return MessageAttachment.objects.create(
+            message=message, file=SimpleUploadedFile(name, content), file_name=name,
+            file_size=len(content), file_type='application/pdf'
+        )
+    
+    def stored_files(self):
+        return [os.path.join(root, name) for root, _, names in os.walk(self.media_root) for name in names]
+    
+    def test_identical_uploads_share_one_blob(self):
+        """Test that the same bytes uploaded under different names are stored once, under their digest"""
+        content = b'%PDF-1.4 forwarded syllabus' * 1000
+        first = self.attach(content, name='syllabus.pdf')
+        second = self.attach(content, name='Syllabus (1).PDF')
+        
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual(first.file.name, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}.pdf')
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(len(self.stored_files()), 1)
+        self.assertEqual(Blob.objects.get(key=first.file.name).ref_count, 2)
+        with second.file.open('rb') as stored:
+            self.assertEqual(stored.read(), content)
+    
+    def test_large_upload_is_hashed_in_chunks(self):
+        """Test that a multi-chunk upload, seekable or streamed once, is stored under the digest of all its bytes"""
+        storage = ContentAddressedStorage(backend=FileSystemStorage(location=self.media_root))
+        content = os.urandom(3 * ContentFile.DEFAULT_CHUNK_SIZE + 5)
+        digest = hashlib.sha256(content).hexdigest()
+        
+        name = storage.save('video.mp4', ContentFile(content))
+        self.assertEqual(name, f'blobs/{digest[:2]}/{digest[2:4]}/{digest}.mp4')
+        with storage.open(name) as stored:
+            self.assertEqual(stored.read(), content)
+        
+        stream = ContentFile(content)
+        stream.seekable = lambda: False
+        self.assertEqual(storage.save('copy.mp4', stream), name)
+        self.assertEqual(Blob.objects.get(key=name).size, len(content))
+    
+    def test_references_follow_saves_and_deletes(self):
+        """Test that replacing or deleting a file field moves the blob references with it"""
+        self.user.profile_picture = SimpleUploadedFile('me.png', b'first picture')
+        self.user.save()
+        first = self.user.profile_picture.name
+        self.assertEqual(Blob.objects.get(key=first).ref_count, 1)
+        
+        self.user.profile_picture = SimpleUploadedFile('me.png', b'second picture')
+        self.user.save()
+        second = self.user.profile_picture.name
+        self.assertEqual(Blob.objects.get(key=first).ref_count, 0)
+        self.assertEqual(Blob.objects.get(key=second).ref_count, 1)
+        
+        # A name copied from another row is a reference too
+        attachment = self.attach(b'shared notes')
+        copy = MessageAttachment.objects.create(
+            message=attachment.message, file=attachment.file.name, file_name='copy.pdf',
+            file_size=12, file_type='application/pdf'
+        )
+        self.assertEqual(Blob.objects.get(key=copy.file.name).ref_count, 2)
+        # Cascades from the message, loaded with the file deferred or not
+        ChatMessage.objects.only('id').get(id=attachment.message_id).delete()
+        self.assertEqual(Blob.objects.get(key=copy.file.name).ref_count, 0)
+        User.objects.only('id').get(id=self.user.id).delete()
+        self.assertEqual(Blob.objects.get(key=second).ref_count, 0)
+    
+    def test_collect_deletes_unreferenced_blobs_after_grace(self):
+        """Test that collect_media_blobs deletes only blobs unreferenced past the grace period, and stray files"""
+        kept = self.attach(b'still referenced')
+        dropped = self.attach(b'no longer referenced')
+        dropped_name = dropped.file.name
+        dropped.delete()
+        stray = os.path.join(self.media_root, 'blobs', 'ab', 'cd', 'abcd' + '0' * 60)
+        os.makedirs(os.path.dirname(stray))
+        with open(stray, 'wb') as f:
+            f.write(b'left by a failed upload')
+        
+        out = StringIO()
+        call_command('collect_media_blobs', stdout=out)
+        self.assertIn('Deleted 0 unreferenced blobs', out.getvalue())
+        self.assertTrue(Blob.objects.filter(key=dropped_name).exists())
+        
+        call_command('collect_media_blobs', '--grace-hours', '0', '--scan-storage', stdout=out)
+        self.assertFalse(Blob.objects.filter(key=dropped_name).exists())
+        self.assertEqual(self.stored_files(), [os.path.join(self.media_root, *kept.file.name.split('/'))])
+        self.assertEqual(Blob.objects.get(key=kept.file.name).ref_count, 1)
+    
+    def test_archived_attachments_stay_referenced(self):
+        """Test that archiving keeps an attachment's blob referenced until the archived message goes"""
+        attachment = self.attach(b'old notes', created_at=timezone.now() - timedelta(days=400))
+        name = attachment.file.name
+        
+        archive_batch(archive_cutoff(365))
+        self.assertFalse(MessageAttachment.objects.exists())
+        self.assertEqual(Blob.objects.get(key=name).ref_count, 1)
+        
+        self.room.delete()
+        self.assertEqual(Blob.objects.get(key=name).ref_count, 0)
+
+
+
+def image_bytes(size, mode='RGB', fmt='PNG'):
+    out = BytesIO()
+    Image.new(mode, size, (200, 40, 40, 128) if mode == 'RGBA' else (200, 40, 40)).save(out, fmt)
+    return out.getvalue()
+
+
+@override_settings(IMAGE_VARIANT_WORKERS=0)
+class ImageVariantTests(APITestCase):
+    """Test cases for the derived image sizes rendered from uploads"""
+    
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        cache.clear()
+        
+        self.user = User.objects.create_user(
+            username='pictureuser',
+            email='pictureuser@example.com',
+            password='picturepass123',
+            first_name='Picture',
+            last_name='User',
+            user_type='alumni'
+        )
+    
+    def set_picture(self, content, name='me.png'):
+        # TestCase never commits, so nothing is rendered ahead of the request
+        self.user.profile_picture = SimpleUploadedFile(name, content)
+        self.user.save()
+    
+    def test_render_variants_crop_and_fit(self):
+        """Test that cropped sizes fill their box, fitted sizes keep the aspect ratio, and nothing is enlarged"""
+        rendered = render_variants(image_bytes((800, 400), mode='RGBA'), [
+            (96, 96, True, 'webp'), (96, 96, True, 'jpeg'), (320, 320, False, 'webp'), (960, 960, False, 'jpeg'),
+        ])
+        self.assertEqual([size for _, _, size in rendered], [(96, 96), (96, 96), (320, 160), (800, 400)])
+        for (width, height, crop, fmt), content, size in rendered:
+            with Image.open(BytesIO(content)) as image:
+                self.assertEqual(image.format, fmt.upper())
+                self.assertEqual(image.size, size)
+    
+    def test_payloads_carry_variant_urls(self):
+        """Test that image payloads list a URL per preset and format, and other files list none"""
+        self.set_picture(image_bytes((500, 500)))
+        avatar = ChatUserSerializer(self.user).data['avatar']
+        
+        token_names = {'webp': '96x96c.webp', 'jpeg': '96x96c.jpeg'}
+        self.assertEqual(set(avatar), {'thumb'})
+        for fmt, url in avatar['thumb'].items():
+            self.assertEqual(url, reverse('image_variant', args=[token_names[fmt], self.user.profile_picture.name]))
+        self.assertEqual(set(image_variants(self.user.profile_picture)), {'thumb', 'small', 'medium'})
+        self.assertIsNone(image_variants('blobs/ab/cd/abcd.pdf'))
+        self.assertIsNone(image_variants(None))
+    
+    def test_upload_renders_every_variant(self):
+        """Test that saving an image field renders all configured variants once the transaction commits"""
+        futures = []
+        with patch('blobstore.signals.schedule_variants', side_effect=lambda names: futures.extend(schedule_variants(names))):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.profile_picture = SimpleUploadedFile('me.png', image_bytes((1200, 900)))
+                self.user.save()
+        for future in futures:
+            future.result(timeout=30)
+        
+        source = self.user.profile_picture.name
+        for spec in all_specs():
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, *variant_name(source, spec).split('/'))))
+    
+    def test_variant_url_renders_lazily_and_redirects(self):
+        """Test that a variant URL renders a missing size once, then redirects straight to the stored file"""
+        self.set_picture(image_bytes((640, 480)))
+        source = self.user.profile_picture.name
+        url = image_variants(self.user.profile_picture)['small']['webp']
+        
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        name = variant_name(source, (320, 320, False, 'webp'))
+        self.assertEqual(response['Location'], f'/media/{name}')
+        with Image.open(os.path.join(self.media_root, *name.split('/'))) as image:
+            self.assertEqual(image.size, (320, 240))
+        
+        with patch('blobstore.variants.render_variants') as render:
+            self.assertEqual(self.client.get(url)['Location'], f'/media/{name}')
+        render.assert_not_called()
+        
+        # A size configured later is rendered on its first request
+        with override_settings(IMAGE_VARIANTS={'large': (2000, 2000, False)}):
+            url = image_variants(self.user.profile_picture)['large']['jpeg']
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_302_FOUND)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        
+        self.assertEqual(
+            self.client.get(reverse('image_variant', args=['95x95c.webp', source])).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+        self.assertEqual(
+            self.client.get(reverse('image_variant', args=['96x96c.webp', 'blobs/missing.png'])).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+    
+    def test_variant_url_only_renders_stored_blobs(self):
+        """Test that variants of variants and of files without a Blob row are refused without rendering"""
+        self.set_picture(image_bytes((640, 480)))
+        variant = ensure_variant(self.user.profile_picture.name, (320, 320, False, 'webp'))
+        unreferenced = variant_storage().save('blobs/ff/ff/ffff.png', ContentFile(image_bytes((640, 480))))
+        
+        with patch('blobstore.variants.render_variants') as render:
+            for source in (variant, unreferenced, 'avatars/me.png'):
+                response = self.client.get(reverse('image_variant', args=['96x96c.webp', source]))
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        render.assert_not_called()
+        self.assertIsNone(image_variants(variant))
+    
+    def test_collect_deletes_variants(self):
+        """Test that collecting an image blob deletes its variants with it"""
+        self.set_picture(image_bytes((300, 300)))
+        source = self.user.profile_picture.name
+        name = ensure_variant(source, (96, 96, True, 'webp'))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, *name.split('/'))))
+        
+        self.user.profile_picture = None
+        self.user.save()
+        call_command('collect_media_blobs', '--grace-hours', '0', stdout=StringIO())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, *name.split('/'))))
+        self.assertFalse(Blob.objects.filter(key=source).exists())
+    
+    def test_process_pool_renders(self):
+        """Test that variants render in the spawned worker processes"""
+        with override_settings(IMAGE_VARIANT_WORKERS=1):
+            pool = get_variant_pool()
+        rendered = pool.submit(render_variants, image_bytes((200, 100)), [(96, 96, True, 'webp')]).result(timeout=60)
+        self.assertEqual(rendered[0][2], (96, 96))
+
+class ChatOutboundMetricsAPITests(APITestCase):
+    """Test cases for the outbound queue metrics endpoint"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='metricsuser',
+            email='metricsuser@example.com',
+            password='metricspass123',
+            first_name='Metrics',
+            last_name='User',
+            user_type='student'
+        )
+    
+    def test_metrics_require_staff(self):
+        """Test that queue metrics are only visible to staff"""
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get('/api/chat/metrics/outbound/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/chat/metrics/outbound/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('queued_messages', response.data)
+        self.assertIn('dropped', response.data)
+
+
+class ChatPrometheusMetricsAPITests(APITestCase):
+    """Test cases for the Prometheus scrape endpoint"""
+    
+    def test_scrape_requires_configured_token(self):
+        """Test that the endpoint is off without a token and checks it when set"""
+        self.assertEqual(self.client.get('/api/chat/metrics/').status_code, status.HTTP_404_NOT_FOUND)
+        
+        with override_settings(CHAT_METRICS_TOKEN='scrape-secret'):
+            response = self.client.get('/api/chat/metrics/', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+            
+            response = self.client.get('/api/chat/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response['Content-Type'].startswith('text/plain'))
+            self.assertIn(b'chat_ws_connections', response.content)
+
+
+class ChatLoadTestCommandTests(TestCase):
+    """Test cases for the chat_loadtest management command"""
+    
+    def test_in_process_run_reports_delivery(self):
+        """Test that a short run delivers frames between synthetic users and writes a JSON report"""
+        stdout = StringIO()
+        call_command(
+            'chat_loadtest', '--users', '3', '--clients', '4', '--duration', '0.5', '--rate', '10',
+            '--mix', 'message=3,typing=1', '--no-rate-limits', '--seed', '1', '--json', '-',
+            stdout=stdout, stderr=StringIO()
+        )
+        report = json.loads(stdout.getvalue())
+        
+        self.assertEqual(User.objects.filter(username__startswith='loadtest').count(), 3)
+        self.assertEqual(report['connections']['connected'], 4)
+        self.assertGreater(report['frames']['message']['sent'], 0)
+        self.assertEqual(report['frames']['message']['delivered'], report['frames']['message']['sent'])
+        self.assertEqual(report['totals']['error_rate'], 0.0)
+        self.assertGreater(report['totals']['latency_ms']['p99'], 0)
+        self.assertEqual(
+            ChatMessage.objects.filter(sender__username__startswith='loadtest').count(),
+            report['frames']['message']['sent']
+        )
+    
+    def test_cleanup_deletes_only_the_synthetic_users(self):
+        """Test that --cleanup deletes the run's own usernames, not every user sharing the prefix"""
+        User.objects.create_user(username='loadtester', email='loadtester@example.com', password='realpass123')
+        call_command(
+            'chat_loadtest', '--users', '2', '--clients', '2', '--duration', '0.2', '--cleanup',
+            stdout=StringIO(), stderr=StringIO()
+        )
+        
+        self.assertEqual(list(User.objects.filter(username__startswith='loadtest').values_list('username', flat=True)),
+                         ['loadtester'])
+    
+    def test_rejects_short_prefix(self):
+        """Test that a prefix short enough to match real usernames is refused"""
+        for prefix in ('', 'a'):
+            with self.assertRaises(CommandError):
+                call_command('chat_loadtest', '--prefix', prefix, '--cleanup', stdout=StringIO())
+    
+    def test_rejects_unknown_frame_type_in_mix(self):
+        """Test that --mix only accepts frame types the generator can send"""
+        with self.assertRaises(CommandError):
+            call_command('chat_loadtest', '--mix', 'message=1,sync=1', stdout=StringIO())
+
+
+class DatabaseExecutorTests(TestCase):
+    """Test cases for the executor that runs sync database work under ASGI"""
+    
+    def test_threads_keep_health_checked_connections(self):
+        """Test that an executor thread reuses its connection across units, with its own lifetime settings"""
+        executor = DatabaseExecutor('test-connections', 1, 300)
+        self.addCleanup(executor.shutdown)
+        
+        def connection_state():
+            connection.ensure_connection()
+            return id(connection.connection), connection.health_check_enabled, connection.settings_dict['CONN_MAX_AGE']
+        
+        first = executor.submit(connection_state).result()
+        second = executor.submit(connection_state).result()
+        
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(second[1:], (True, 300))
+        self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], 0)
+    
+    def test_queue_wait_is_recorded(self):
+        """Test that units waiting for a busy thread are counted and their wait observed"""
+        executor = DatabaseExecutor('test-wait', 1, 0)
+        self.addCleanup(executor.shutdown)
+        labels = {'executor': 'test-wait'}
+        release = threading.Event()
+        
+        executor.submit(release.wait)
+        waiting = executor.submit(lambda: None)
+        time.sleep(0.05)
+        self.assertEqual(REGISTRY.get_sample_value('db_executor_queued_units', labels), 1)
+        release.set()
+        waiting.result()
+        
+        self.assertEqual(REGISTRY.get_sample_value('db_executor_queued_units', labels), 0)
+        self.assertEqual(REGISTRY.get_sample_value('db_executor_queue_wait_seconds_count', labels), 2)
+        self.assertGreaterEqual(REGISTRY.get_sample_value('db_executor_queue_wait_seconds_sum', labels), 0.05)
+    
+    def test_asgi_handler_runs_requests_on_the_executor(self):
+        """Test that the ASGI handler serves a request's middleware and view as one executor unit"""
+        executor = DatabaseExecutor('test-http', 2, 0)
+        self.addCleanup(executor.shutdown)
+        communicator = HttpCommunicator(
+            ExecutorASGIHandler(executor), 'GET', '/api/chat/rooms/', headers=[(b'host', b'localhost')]
+        )
+        
+        response = async_to_sync(communicator.get_response)()
+        
+        self.assertEqual(response['status'], status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(
+            REGISTRY.get_sample_value('db_executor_queue_wait_seconds_count', {'executor': 'test-http'}), 1
+        )
+    
+    def test_asgi_module_imports_in_a_fresh_process(self):
+        """Test that the ASGI entry point sets Django up before importing the websocket routes"""
+        env = {key: value for key, value in os.environ.items() if key != 'DJANGO_SETTINGS_MODULE'}
+        result = subprocess.run(
+            [sys.executable, '-c', 'import alumni_backend.asgi'],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
 class UserStreakTests(TestCase):
     """Test cases for user streak functionality"""
     
@@ -1,12 +1,50 @@
+import asyncio
 import pytest
-from django.test import TestCase
+import threading
+import time
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import AsyncMock, MagicMock, patch
+from django.db import IntegrityError, transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django.contrib.auth import get_user_model
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from asgiref.testing import ApplicationCommunicator
 from channels.testing import WebsocketCommunicator
 from channels.db import database_sync_to_async
 import json
+import msgpack
+from prometheus_client import REGISTRY
 
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    # fakeredis needs lupa to run the Lua scripts channels_redis uses
+    import lupa
+except ImportError:
+    lupa = None
+
+from chat.activity import activity_buffer, streak_credits
+from chat.auth import ConnectionAuthCache, UserSnapshot, auth_cache
 from chat.consumers import ChatConsumer
-from chat.models import ChatRoom, ChatMessage, MeetingRequest
+from chat.db import run_database_unit
+from chat.lifespan import LifespanApplication
+from chat.layers import HashRing, ShardedRedisChannelLayer
+from chat.outbound import CLOSE_SLOW_CONSUMER, HIGH, LOW, OutboundQueue, frame_priority, outbound_stats
+from chat.ratelimit import LocalRateLimitBackend, RateLimiter, RedisRateLimitBackend
+from chat.presence import LocalPresenceBackend, RedisPresenceBackend, get_presence_backend, online_user_ids
+from chat.rooms import PeerRoomCache, user_group_name
+from chat.typing import TypingStore
+from chat.wire import (
+    LONG_KEYS, MSGPACK_SUBPROTOCOL, JsonCodec, MsgpackCodec, encode_event, negotiate_codec, rename_keys
+)
+from chat.batching import BatchWriter
+from chat.writebehind import message_buffer
+from chat.models import ChatRoom, ChatMessage, MeetingRequest, RoomReadCursor, TypingIndicator, UserStreak, ActivityLog
 from accounts.models import User
 
 User = get_user_model()
@@ -489,6 +527,7 @@ class WebSocketPerformanceTests(TestCase):
         disconnect_tasks = [comm.disconnect() for comm in communicators]
         await asyncio.gather(*disconnect_tasks)
     
+    @override_settings(CHAT_RATE_LIMIT_ENABLED=False)
     async def test_message_throughput(self):
         """Test message throughput performance"""
         import time
@@ -552,3 +591,1415 @@ class WebSocketPerformanceTests(TestCase):
         
         await communicator1.disconnect()
         await communicator2.disconnect()
+
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatAuthCacheTests(TestCase):
+    """Test cases for the WebSocket connection auth cache"""
+    
+    def setUp(self):
+        auth_cache.clear()
+        self.user = User.objects.create_user(
+            username='cacheuser',
+            email='cacheuser@example.com',
+            password='cacheuserpass123',
+            first_name='Cache',
+            last_name='User',
+            user_type='student'
+        )
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.access_token = RefreshToken.for_user(self.user).access_token
+    
+    async def test_reconnect_uses_cached_snapshot(self):
+        """Test that a reconnect with the same token skips the user query"""
+        token = str(self.access_token)
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={token}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+        
+        snapshot = auth_cache.get(self.access_token['jti'])
+        self.assertEqual(snapshot.id, self.user.id)
+        self.assertEqual(snapshot.full_name, 'Cache User')
+        self.assertEqual(snapshot.user_type, 'student')
+        
+        with patch('chat.consumers.load_user_snapshot') as load_user_snapshot:
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={token}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+        load_user_snapshot.assert_not_called()
+    
+    def test_entry_ttl_capped_by_token_exp(self):
+        """Test that cache entries never outlive the token"""
+        cache = ConnectionAuthCache(ttl=3600, max_entries=10)
+        snapshot = UserSnapshot.from_user(self.user)
+        
+        cache.set('expired', snapshot, time.time() - 1)
+        self.assertIsNone(cache.get('expired'))
+        
+        cache.set('valid', snapshot, time.time() + 60)
+        self.assertEqual(cache.get('valid'), snapshot)
+    
+    def test_cache_evicts_least_recently_used(self):
+        """Test that the cache stays bounded"""
+        cache = ConnectionAuthCache(ttl=60, max_entries=2)
+        snapshot = UserSnapshot.from_user(self.user)
+        exp = time.time() + 60
+        
+        cache.set('a', snapshot, exp)
+        cache.set('b', snapshot, exp)
+        cache.get('a')
+        cache.set('c', snapshot, exp)
+        
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+
+
+class DirectRoomTests(TestCase):
+    """Test cases for canonical direct room lookup"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(
+            username='directone',
+            email='directone@example.com',
+            password='directonepass123',
+            first_name='Direct',
+            last_name='One',
+            user_type='student'
+        )
+        self.user2 = User.objects.create_user(
+            username='directtwo',
+            email='directtwo@example.com',
+            password='directtwopass123',
+            first_name='Direct',
+            last_name='Two',
+            user_type='alumni'
+        )
+    
+    def test_direct_room_is_shared_by_both_users(self):
+        """Test that both directions resolve the same room"""
+        room = ChatRoom.get_or_create_direct(self.user1.id, self.user2.id)
+        
+        self.assertEqual(room.direct_key, ChatRoom.make_direct_key(self.user2.id, self.user1.id))
+        self.assertEqual(ChatRoom.get_or_create_direct(self.user2.id, self.user1.id).id, room.id)
+        self.assertEqual(room.participants.count(), 2)
+        self.assertEqual(ChatRoom.objects.count(), 1)
+    
+    def test_legacy_room_is_adopted(self):
+        """Test that an unkeyed direct room is reused instead of duplicated"""
+        legacy_room = ChatRoom.objects.create(room_type='direct', created_by=self.user1)
+        legacy_room.participants.add(self.user1, self.user2)
+        
+        room = ChatRoom.get_or_create_direct(self.user2.id, self.user1.id)
+        
+        self.assertEqual(room.id, legacy_room.id)
+        self.assertIsNotNone(room.direct_key)
+    
+    def test_peer_room_cache_is_bounded(self):
+        """Test the per-connection peer room LRU"""
+        cache = PeerRoomCache(max_entries=2)
+        cache.set(1, 10)
+        cache.set(2, 20)
+        cache.get(1)
+        cache.set(3, 30)
+        
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), 10)
+    
+    def test_peer_room_is_cached_once_committed(self):
+        """Test that a direct room created in a rolled-back savepoint never reaches the peer room cache"""
+        consumer = ChatConsumer()
+        consumer.user_id = self.user1.id
+        consumer.room_cache = PeerRoomCache()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError):
+                with transaction.atomic():
+                    consumer.direct_room_id(self.user2.id)
+                    raise IntegrityError("later step of the batch op failed")
+        self.assertIsNone(consumer.room_cache.get(self.user2.id))
+        self.assertFalse(ChatRoom.objects.exists())
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            room_id = consumer.direct_room_id(self.user2.id)
+        self.assertEqual(consumer.room_cache.get(self.user2.id), room_id)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ChatBroadcastTests(TestCase):
+    """Test cases for the encode-once broadcast path"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.requester = User.objects.create_user(
+            username='broadcastrequester',
+            email='broadcastrequester@example.com',
+            password='requesterpass123',
+            first_name='Requester',
+            last_name='User',
+            user_type='student'
+        )
+        self.recipient = User.objects.create_user(
+            username='broadcastrecipient',
+            email='broadcastrecipient@example.com',
+            password='recipientpass123',
+            first_name='Recipient',
+            last_name='User',
+            user_type='alumni'
+        )
+        self.requester_token = str(RefreshToken.for_user(self.requester).access_token)
+        self.recipient_token = str(RefreshToken.for_user(self.recipient).access_token)
+    
+    async def test_meeting_approval_reaches_both_users(self):
+        """Test that a meeting response is delivered identically to both users"""
+        communicator_req = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.requester_token}")
+        communicator_rec = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.recipient_token}")
+        await communicator_req.connect()
+        await communicator_rec.connect()
+        
+        await communicator_req.send_json_to({
+            'type': 'meeting_request',
+            'to_user': self.recipient.id,
+            'datetime': '2024-12-25T14:00:00Z',
+            'topic': 'Career Discussion'
+        })
+        request_frame = await communicator_rec.receive_json_from()
+        await communicator_req.receive_json_from()
+        meeting_id = request_frame['data']['meeting_request']['id']
+        self.assertEqual(request_frame['data']['meeting_request']['recipient']['name'], 'Recipient User')
+        
+        await communicator_rec.send_json_to({
+            'type': 'meeting_approval',
+            'meeting_id': meeting_id,
+            'status': 'approved'
+        })
+        requester_frame = await communicator_req.receive_from()
+        recipient_frame = await communicator_rec.receive_from()
+        
+        self.assertEqual(requester_frame, recipient_frame)
+        response = json.loads(requester_frame)
+        self.assertEqual(response['type'], 'meeting_response')
+        self.assertEqual(response['data']['meeting_request']['status'], 'approved')
+        self.assertEqual(response['data']['meeting_request']['requester']['name'], 'Requester User')
+        self.assertEqual(response['data']['message']['sender']['id'], self.recipient.id)
+        
+        await communicator_req.disconnect()
+        await communicator_rec.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MessagePersistenceTests(TestCase):
+    """Test cases for message sequencing, client ids and write-behind persistence"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.sender = User.objects.create_user(
+            username='persistsender',
+            email='persistsender@example.com',
+            password='senderpass123',
+            first_name='Persist',
+            last_name='Sender',
+            user_type='student'
+        )
+        self.receiver = User.objects.create_user(
+            username='persistreceiver',
+            email='persistreceiver@example.com',
+            password='receiverpass123',
+            first_name='Persist',
+            last_name='Receiver',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.sender).access_token)
+        message_buffer.writer.clear()
+        message_buffer._recent.clear()
+    
+    def test_messages_get_increasing_room_sequence(self):
+        """Test that saved messages are numbered per room"""
+        room = ChatRoom.get_or_create_direct(self.sender.id, self.receiver.id)
+        first = ChatMessage.objects.create(room=room, sender=self.sender, content='one')
+        second = ChatMessage.objects.create(room=room, sender=self.sender, content='two')
+        
+        self.assertEqual((first.seq, second.seq), (1, 2))
+        room.refresh_from_db()
+        self.assertEqual(room.last_seq, 2)
+    
+    async def send_messages(self, frames):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        responses = []
+        for frame in frames:
+            await communicator.send_json_to(frame)
+            responses.append(await communicator.receive_json_from())
+        await communicator.disconnect()
+        return responses
+    
+    async def test_retried_client_msg_id_is_not_inserted_twice(self):
+        """Test that a retried send returns the original message"""
+        frame = {'type': 'message', 'to_user': self.receiver.id, 'content': 'Hello', 'client_msg_id': 'abc-1'}
+        first, retry = await self.send_messages([frame, frame])
+        
+        self.assertEqual(first['data']['id'], retry['data']['id'])
+        count = await database_sync_to_async(ChatMessage.objects.filter(client_msg_id='abc-1').count)()
+        self.assertEqual(count, 1)
+    
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=100, CHAT_WRITE_BEHIND_INTERVAL=60)
+    async def test_write_behind_broadcasts_before_insert(self):
+        """Test that write-behind messages are broadcast first and flushed in one batch"""
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        responses = []
+        for content in ('first', 'second'):
+            await communicator.send_json_to({'type': 'message', 'to_user': self.receiver.id, 'content': content})
+            responses.append(await communicator.receive_json_from())
+        
+        self.assertLess(responses[0]['data']['seq'], responses[1]['data']['seq'])
+        self.assertEqual(message_buffer.pending_count, 2)
+        count = await database_sync_to_async(ChatMessage.objects.count)()
+        self.assertEqual(count, 0)
+        
+        self.assertEqual(await message_buffer.flush(), 2)
+        await communicator.disconnect()
+        
+        messages = await database_sync_to_async(list)(ChatMessage.objects.order_by('seq').values_list('id', 'content'))
+        self.assertEqual(messages, [(responses[0]['data']['id'], 'first'), (responses[1]['data']['id'], 'second')])
+        
+        room = await database_sync_to_async(ChatRoom.objects.get)()
+        self.assertEqual(room.last_message['id'], responses[1]['data']['id'])
+        self.assertEqual(room.last_message['sender'], 'Persist Sender')
+    
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=100, CHAT_WRITE_BEHIND_INTERVAL=60)
+    async def test_write_behind_is_flushed_when_the_server_cancels_connections(self):
+        """Test that acked write-behind messages are saved when shutdown cancels the app without a disconnect"""
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'message', 'to_user': self.receiver.id, 'content': 'acked'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(message_buffer.pending_count, 1)
+        
+        communicator.future.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await communicator.future
+        
+        messages = await database_sync_to_async(list)(ChatMessage.objects.values_list('id', 'content'))
+        self.assertEqual(messages, [(response['data']['id'], 'acked')])
+    
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=100, CHAT_WRITE_BEHIND_INTERVAL=60)
+    async def test_lifespan_shutdown_flushes_write_behind(self):
+        """Test that the ASGI lifespan shutdown event writes out buffered messages"""
+        room = await database_sync_to_async(ChatRoom.get_or_create_direct)(self.sender.id, self.receiver.id)
+        await message_buffer.add(room.id, self.sender.id, 'buffered', None, sender_name='Persist Sender')
+        communicator = ApplicationCommunicator(LifespanApplication(), {'type': 'lifespan'})
+        await communicator.send_input({'type': 'lifespan.startup'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'lifespan.startup.complete'})
+        
+        await communicator.send_input({'type': 'lifespan.shutdown'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'lifespan.shutdown.complete'})
+        count = await database_sync_to_async(ChatMessage.objects.filter(content='buffered').count)()
+        self.assertEqual(count, 1)
+    
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=100, CHAT_WRITE_BEHIND_INTERVAL=0.01)
+    async def test_write_behind_client_msg_id_is_broadcast_once_saved(self):
+        """Test that a message with a client_msg_id is broadcast after its insert, and retries find it in the database"""
+        frame = {'type': 'message', 'to_user': self.receiver.id, 'content': 'Hello', 'client_msg_id': 'wb-1'}
+        first, = await self.send_messages([frame])
+        saved = await database_sync_to_async(list)(ChatMessage.objects.values_list('id', flat=True))
+        self.assertEqual(saved, [first['data']['id']])
+        
+        # As after a restart, or on another worker: nothing in the dedupe window
+        message_buffer._recent.clear()
+        retry, = await self.send_messages([frame])
+        self.assertEqual(retry['data']['id'], first['data']['id'])
+        count = await database_sync_to_async(ChatMessage.objects.count)()
+        self.assertEqual(count, 1)
+    
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=100, CHAT_WRITE_BEHIND_INTERVAL=0.01)
+    async def test_write_behind_racing_retries_share_one_row(self):
+        """Test that of two sends of one client_msg_id accepted together, only the inserted one counts as created"""
+        room = await database_sync_to_async(ChatRoom.get_or_create_direct)(self.sender.id, self.receiver.id)
+        results = await asyncio.gather(*[
+            message_buffer.add(room.id, self.sender.id, 'Hello', client_msg_id='race-1') for _ in range(2)
+        ])
+        
+        self.assertEqual(sorted(created for _, created in results), [False, True])
+        self.assertEqual(results[0][0].id, results[1][0].id)
+        stored = await database_sync_to_async(list)(ChatMessage.objects.values_list('id', flat=True))
+        self.assertEqual(stored, [results[0][0].id])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class StreakCreditTests(TestCase):
+    """Test cases for once-per-day streak and activity writes"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        streak_credits.clear()
+        activity_buffer.clear()
+        self.user = User.objects.create_user(
+            username='streakuser',
+            email='streakuser@example.com',
+            password='streakuserpass123',
+            first_name='Streak',
+            last_name='User',
+            user_type='student'
+        )
+        self.peer = User.objects.create_user(
+            username='streakpeer',
+            email='streakpeer@example.com',
+            password='streakpeerpass123',
+            first_name='Streak',
+            last_name='Peer',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+    
+    async def test_streak_credited_once_per_day(self):
+        """Test that reconnects and messages do not rewrite the streak"""
+        for _ in range(2):
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            for i in range(3):
+                await communicator.send_json_to({'type': 'message', 'to_user': self.peer.id, 'content': f'Hi {i}'})
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+        
+        # Disconnecting wrote the buffered activity row
+        self.assertEqual(activity_buffer.pending_count, 0)
+        streak = await database_sync_to_async(UserStreak.objects.get)(user=self.user)
+        self.assertEqual(streak.current_streak, 1)
+        self.assertEqual(streak.last_activity_date, timezone.now().date())
+        logs = await database_sync_to_async(ActivityLog.objects.filter(user=self.user).count)()
+        self.assertEqual(logs, 1)
+    
+    async def test_concurrent_flushes_write_each_batch_once(self):
+        """Test that flushes racing each other never hand the same items to the writer twice"""
+        batches = []
+        writer = BatchWriter(batches.append, 'UNSET_BATCH_SIZE', 'UNSET_INTERVAL', default_batch_size=100, default_interval=60)
+        for i in range(5):
+            writer.add(i)
+        await asyncio.gather(writer.flush(), writer.flush(), writer.flush())
+        writer.clear()
+        
+        self.assertEqual(batches, [[0, 1, 2, 3, 4]])
+    
+    def test_credit_cache_expires_with_the_day(self):
+        """Test that a credit only covers the day it was made"""
+        today = timezone.now().date()
+        streak_credits.mark_credited(self.user.id, today)
+        
+        self.assertTrue(streak_credits.is_credited(self.user.id, today))
+        self.assertFalse(streak_credits.is_credited(self.user.id, today + timedelta(days=1)))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class TypingIndicatorTests(TestCase):
+    """Test cases for ephemeral, coalesced typing indicators"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.typer = User.objects.create_user(
+            username='ephemeraltyper',
+            email='ephemeraltyper@example.com',
+            password='typerpass123',
+            first_name='Ephemeral',
+            last_name='Typer',
+            user_type='student'
+        )
+        self.observer = User.objects.create_user(
+            username='ephemeralobserver',
+            email='ephemeralobserver@example.com',
+            password='observerpass123',
+            first_name='Ephemeral',
+            last_name='Observer',
+            user_type='alumni'
+        )
+        self.typer_token = str(RefreshToken.for_user(self.typer).access_token)
+        self.observer_token = str(RefreshToken.for_user(self.observer).access_token)
+    
+    def test_store_coalesces_and_expires(self):
+        """Test coalescing of repeated typing events and TTL expiry"""
+        store = TypingStore()
+        with override_settings(CHAT_TYPING_TTL=6.0, CHAT_TYPING_INTERVAL=2.0):
+            self.assertTrue(store.update(1, 10, True, now=100.0))
+            self.assertFalse(store.update(1, 10, True, now=101.0))
+            self.assertTrue(store.update(1, 10, True, now=102.5))
+            self.assertEqual(store.remaining(1, 10, now=103.0), 5.5)
+            self.assertEqual(store.remaining(1, 10, now=109.0), 0.0)
+            self.assertFalse(store.update(1, 10, False, now=109.0))
+    
+    async def connect_pair(self):
+        typer = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.typer_token}")
+        observer = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.observer_token}")
+        await typer.connect()
+        await observer.connect()
+        return typer, observer
+    
+    async def test_keystrokes_are_coalesced_without_db_writes(self):
+        """Test that a burst of typing events yields one broadcast and no rows"""
+        typer, observer = await self.connect_pair()
+        
+        for _ in range(5):
+            await typer.send_json_to({'type': 'typing', 'to_user': self.observer.id, 'is_typing': True})
+        await typer.send_json_to({'type': 'typing', 'to_user': self.observer.id, 'is_typing': False})
+        
+        started = await observer.receive_json_from()
+        stopped = await observer.receive_json_from()
+        self.assertTrue(started['data']['is_typing'])
+        self.assertGreater(started['data']['expires_in'], 0)
+        self.assertFalse(stopped['data']['is_typing'])
+        self.assertTrue(await observer.receive_nothing())
+        
+        rows = await database_sync_to_async(TypingIndicator.objects.count)()
+        self.assertEqual(rows, 0)
+        
+        await typer.disconnect()
+        await observer.disconnect()
+    
+    @override_settings(CHAT_TYPING_TTL=0.2)
+    async def test_typing_expires_without_trailing_event(self):
+        """Test that the server sends "stopped typing" once the TTL passes"""
+        typer, observer = await self.connect_pair()
+        
+        await typer.send_json_to({'type': 'typing', 'to_user': self.observer.id, 'is_typing': True})
+        started = await observer.receive_json_from()
+        stopped = await observer.receive_json_from(timeout=2)
+        
+        self.assertTrue(started['data']['is_typing'])
+        self.assertFalse(stopped['data']['is_typing'])
+        
+        await typer.disconnect()
+        await observer.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceTests(TestCase):
+    """Test cases for connection-counted presence"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.user = User.objects.create_user(
+            username='presenceuser',
+            email='presenceuser@example.com',
+            password='presenceuserpass123',
+            first_name='Presence',
+            last_name='User',
+            user_type='alumni'
+        )
+        self.offline_user = User.objects.create_user(
+            username='offlineuser',
+            email='offlineuser@example.com',
+            password='offlineuserpass123',
+            first_name='Offline',
+            last_name='User',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        # Presence is process-wide: give each test a backend of its own
+        patcher = patch('chat.presence._backend', LocalPresenceBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    async def test_presence_counts_each_tab(self):
+        """Test that a user stays online until their last connection closes"""
+        tab1 = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        tab2 = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        await tab1.connect()
+        await tab2.connect()
+        
+        await tab1.send_json_to({'type': 'presence', 'user_ids': [self.user.id, self.offline_user.id]})
+        response = await tab1.receive_json_from()
+        self.assertEqual(response['type'], 'presence')
+        self.assertEqual(response['data']['online'], [self.user.id])
+        
+        await tab1.disconnect()
+        self.assertEqual(online_user_ids([self.user.id]), {self.user.id})
+        await tab2.disconnect()
+        self.assertEqual(online_user_ids([self.user.id]), set())
+    
+    async def test_stale_connections_expire(self):
+        """Test that connections which stop heartbeating drop out"""
+        backend = LocalPresenceBackend()
+        await backend.add(1, 'channel-a', ttl=-1)
+        await backend.add(2, 'channel-b', ttl=60)
+        
+        self.assertEqual(await backend.aonline([1, 2]), {2})
+    
+    @skipUnless(fakeredis, "fakeredis is not installed")
+    async def test_redis_backend_bulk_lookup(self):
+        """Test the shared Redis backend against an in-process stand-in"""
+        server = fakeredis.FakeServer()
+        backend = RedisPresenceBackend(
+            client=fakeredis.FakeRedis(server=server),
+            async_client=fakeredis.aioredis.FakeRedis(server=server)
+        )
+        await backend.add(1, 'node1.tab1', ttl=60)
+        await backend.add(1, 'node2.tab2', ttl=60)
+        await backend.add(3, 'dead-node.tab', ttl=-1)
+        await backend.remove(1, 'node1.tab1')
+        
+        self.assertEqual(backend.online(range(1, 501)), {1})
+        self.assertEqual(await backend.aonline([1, 2, 3]), {1})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ReadCursorTests(TestCase):
+    """Test cases for per-room read cursors"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.reader = User.objects.create_user(
+            username='cursorreader',
+            email='cursorreader@example.com',
+            password='readerpass123',
+            first_name='Cursor',
+            last_name='Reader',
+            user_type='student'
+        )
+        self.writer = User.objects.create_user(
+            username='cursorwriter',
+            email='cursorwriter@example.com',
+            password='writerpass123',
+            first_name='Cursor',
+            last_name='Writer',
+            user_type='alumni'
+        )
+        self.reader_token = str(RefreshToken.for_user(self.reader).access_token)
+        self.room = ChatRoom.get_or_create_direct(self.reader.id, self.writer.id)
+        self.messages = [
+            ChatMessage.objects.create(room=self.room, sender=self.writer, content=f'Message {i}')
+            for i in range(5)
+        ]
+    
+    def last_read_seq(self, user):
+        return RoomReadCursor.objects.get(room=self.room, user=user).last_read_seq
+    
+    def test_cursor_only_moves_forward(self):
+        """Test that advancing a cursor never moves it backwards"""
+        self.assertEqual(self.last_read_seq(self.reader), 0)
+        self.assertEqual(self.last_read_seq(self.writer), self.messages[-1].seq)
+        
+        RoomReadCursor.advance(self.room.id, self.reader.id, 3)
+        RoomReadCursor.advance(self.room.id, self.reader.id, 2)
+        self.assertEqual(self.last_read_seq(self.reader), 3)
+        
+        rooms = ChatRoom.with_unread_counts(ChatRoom.objects.filter(id=self.room.id), self.reader.id)
+        self.assertEqual(rooms.get().unread_message_count, 2)
+    
+    async def test_read_up_to_frame(self):
+        """Test that a read_up_to frame moves the cursor and is echoed to participants"""
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.reader_token}")
+        await communicator.connect()
+        
+        await communicator.send_json_to({'type': 'read_up_to', 'room_id': self.room.id, 'seq': 1000})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'read_up_to')
+        # Clamped to the last message in the room
+        self.assertEqual(response['data']['seq'], self.messages[-1].seq)
+        self.assertEqual(await database_sync_to_async(self.last_read_seq)(self.reader), self.messages[-1].seq)
+        
+        await communicator.disconnect()
+    
+    async def test_legacy_read_receipt_moves_cursor(self):
+        """Test that per-message read receipts map onto the room cursor"""
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.reader_token}")
+        await communicator.connect()
+        
+        await communicator.send_json_to({'type': 'read_receipt', 'message_id': self.messages[2].id})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['data']['seq'], self.messages[2].seq)
+        self.assertEqual(await database_sync_to_async(self.last_read_seq)(self.reader), self.messages[2].seq)
+        
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SyncTests(TestCase):
+    """Test cases for reconnect catch-up with the sync frame"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.user = User.objects.create_user(
+            username='syncuser',
+            email='syncuser@example.com',
+            password='syncuserpass123',
+            first_name='Sync',
+            last_name='User',
+            user_type='student'
+        )
+        self.peer = User.objects.create_user(
+            username='syncpeer',
+            email='syncpeer@example.com',
+            password='syncpeerpass123',
+            first_name='Sync',
+            last_name='Peer',
+            user_type='alumni'
+        )
+        self.outsider = User.objects.create_user(
+            username='syncoutsider',
+            email='syncoutsider@example.com',
+            password='outsiderpass123',
+            first_name='Sync',
+            last_name='Outsider',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.room = ChatRoom.get_or_create_direct(self.user.id, self.peer.id)
+        self.other_room = ChatRoom.get_or_create_direct(self.peer.id, self.outsider.id)
+        for i in range(5):
+            ChatMessage.objects.create(room=self.room, sender=self.peer, content=f'Missed {i}')
+        ChatMessage.objects.create(room=self.other_room, sender=self.peer, content='Not yours')
+    
+    async def sync(self, rooms):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'sync', 'rooms': rooms})
+        frames = []
+        while True:
+            frame = await communicator.receive_json_from()
+            frames.append(frame)
+            if frame['type'] in ('sync_complete', 'error'):
+                break
+        await communicator.disconnect()
+        return frames
+    
+    @override_settings(CHAT_SYNC_BATCH_SIZE=2, CHAT_SYNC_ROOM_LIMIT=3)
+    async def test_sync_returns_only_missed_messages_in_batches(self):
+        """Test that sync sends the delta since the client's seq, batched and capped"""
+        frames = await self.sync({str(self.room.id): 1, str(self.other_room.id): 0})
+        
+        batches = [frame['data']['messages'] for frame in frames if frame['type'] == 'sync']
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual([m['seq'] for batch in batches for m in batch], [2, 3, 4])
+        self.assertEqual(batches[0][0]['sender']['id'], self.peer.id)
+        
+        complete = frames[-1]['data']['rooms']
+        self.assertEqual(complete, {str(self.room.id): {'last_seq': 5, 'has_more': True}})
+    
+    async def test_sync_when_up_to_date(self):
+        """Test that an up-to-date client gets only the completion frame"""
+        frames = await self.sync({str(self.room.id): 5})
+        self.assertEqual([frame['type'] for frame in frames], ['sync_complete'])
+        self.assertFalse(frames[0]['data']['rooms'][str(self.room.id)]['has_more'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class GroupRoomTests(TestCase):
+    """Test cases for room-scoped channel groups"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.members = [
+            User.objects.create_user(
+                username=f'groupmember{i}',
+                email=f'groupmember{i}@example.com',
+                password='memberpass123',
+                first_name='Group',
+                last_name=f'Member{i}',
+                user_type='alumni'
+            )
+            for i in range(3)
+        ]
+        self.tokens = [str(RefreshToken.for_user(member).access_token) for member in self.members]
+        self.room = ChatRoom.objects.create(name='Alumni Circle', room_type='group', created_by=self.members[0])
+        self.room.participants.add(self.members[0], self.members[1])
+    
+    async def connect(self, index):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.tokens[index]}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+    
+    def change_membership(self, user, joined):
+        with self.captureOnCommitCallbacks(execute=True):
+            if joined:
+                self.room.participants.add(user)
+            else:
+                self.room.participants.remove(user)
+    
+    async def test_one_group_send_reaches_all_members(self):
+        """Test that a group message is sent once to the room group"""
+        sender, receiver = await self.connect(0), await self.connect(1)
+        
+        with patch('channels.layers.InMemoryChannelLayer.group_send', autospec=True,
+                   side_effect=InMemoryChannelLayer.group_send) as group_send:
+            await sender.send_json_to({'type': 'message', 'room_id': self.room.id, 'content': 'Hello all'})
+            
+            for communicator in (sender, receiver):
+                frame = await communicator.receive_json_from()
+                self.assertEqual(frame['data']['content'], 'Hello all')
+                self.assertEqual(frame['data']['room_id'], self.room.id)
+        
+        self.assertEqual([call.args[1] for call in group_send.call_args_list], [f'room_{self.room.id}'])
+        
+        await sender.disconnect()
+        await receiver.disconnect()
+    
+    async def test_non_member_cannot_post(self):
+        """Test that only members can send to a group room"""
+        outsider = await self.connect(2)
+        await outsider.send_json_to({'type': 'message', 'room_id': self.room.id, 'content': 'Let me in'})
+        frame = await outsider.receive_json_from()
+        self.assertEqual(frame['type'], 'error')
+        await outsider.disconnect()
+    
+    async def test_membership_changes_apply_live(self):
+        """Test that joining and leaving a room updates open connections"""
+        sender, newcomer = await self.connect(0), await self.connect(2)
+        
+        await database_sync_to_async(self.change_membership)(self.members[2], True)
+        frame = await newcomer.receive_json_from()
+        self.assertEqual(frame['type'], 'room_membership')
+        self.assertTrue(frame['data']['joined'])
+        
+        await sender.send_json_to({'type': 'message', 'room_id': self.room.id, 'content': 'Welcome'})
+        self.assertEqual((await newcomer.receive_json_from())['data']['content'], 'Welcome')
+        await sender.receive_json_from()
+        
+        await database_sync_to_async(self.change_membership)(self.members[2], False)
+        self.assertFalse((await newcomer.receive_json_from())['data']['joined'])
+        await sender.send_json_to({'type': 'message', 'room_id': self.room.id, 'content': 'Goodbye'})
+        await sender.receive_json_from()
+        self.assertTrue(await newcomer.receive_nothing())
+        
+        await sender.disconnect()
+        await newcomer.disconnect()
+
+
+class ShardedChannelLayerTests(TestCase):
+    """Test cases for the consistent-hashing sharded channel layer"""
+    
+    def test_adding_a_shard_moves_few_keys(self):
+        """Test that growing the ring only moves keys onto the new shard"""
+        keys = [f"user_{i}" for i in range(5000)]
+        before = HashRing(enumerate(['a', 'b', 'c']))
+        after = HashRing(enumerate(['a', 'b', 'c', 'd']))
+        
+        moved = [key for key in keys if before.get_index(key) != after.get_index(key)]
+        self.assertTrue(all(after.get_index(key) == 3 for key in moved))
+        self.assertLess(len(moved) / len(keys), 0.35)
+        
+        shares = [sum(1 for key in keys if after.get_index(key) == index) / len(keys) for index in range(4)]
+        self.assertTrue(all(0.15 < share < 0.35 for share in shares))
+    
+    def fake_hosts(self, servers):
+        return [
+            {'connection_class': fakeredis.aioredis.FakeAsyncRedisConnection, 'server': server}
+            for server in servers
+        ]
+    
+    @skipUnless(fakeredis and lupa, "fakeredis with Lua support is not installed")
+    async def test_groups_spread_across_shards(self):
+        """Test delivery through groups placed on different shards"""
+        servers = [fakeredis.FakeServer() for _ in range(3)]
+        layer = ShardedRedisChannelLayer(hosts=self.fake_hosts(servers))
+        channels = {}
+        for user_id in range(30):
+            channels[user_id] = await layer.new_channel()
+            await layer.group_add(f"user_{user_id}", channels[user_id])
+        
+        for user_id, channel in channels.items():
+            await layer.group_send(f"user_{user_id}", {'type': 'chat.frame', 'text': str(user_id)})
+            self.assertEqual((await layer.receive(channel))['text'], str(user_id))
+        
+        self.assertEqual({layer.consistent_hash(f"user_{user_id}") for user_id in channels}, {0, 1, 2})
+        await layer.flush()
+    
+    @skipUnless(fakeredis and lupa, "fakeredis with Lua support is not installed")
+    async def test_rebalance_after_adding_a_shard(self):
+        """Test that groups stay reachable while and after moving to a new shard"""
+        servers = [fakeredis.FakeServer() for _ in range(3)]
+        old_layer = ShardedRedisChannelLayer(hosts=self.fake_hosts(servers[:2]))
+        groups = [f"room_{i}" for i in range(40)]
+        channel = await old_layer.new_channel()
+        for group in groups:
+            await old_layer.group_add(group, channel)
+        
+        layer = ShardedRedisChannelLayer(
+            hosts=self.fake_hosts(servers), previous_hosts=self.fake_hosts(servers[:2])
+        )
+        # Receive on the same process-local channel as if this node had been restarted on the new ring
+        layer.client_prefix = old_layer.client_prefix
+        moved = [group for group in groups if layer.consistent_hash(group) == 2]
+        self.assertTrue(moved)
+        
+        # A send during the rebalance window pulls the group over first
+        await layer.group_send(moved[0], {'type': 'chat.frame', 'text': 'hello'})
+        self.assertEqual((await layer.receive(channel))['text'], 'hello')
+        
+        groups_moved, members_moved = await layer.rebalance()
+        self.assertEqual((groups_moved, members_moved), (len(moved) - 1, len(moved) - 1))
+        
+        final_layer = ShardedRedisChannelLayer(hosts=self.fake_hosts(servers))
+        final_layer.client_prefix = old_layer.client_prefix
+        for group in groups:
+            await final_layer.group_send(group, {'type': 'chat.frame', 'text': group})
+            self.assertEqual((await final_layer.receive(channel))['text'], group)
+        await final_layer.flush()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class OutboundQueueTests(TestCase):
+    """Test cases for the bounded per-connection outbound queue"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.user = User.objects.create_user(
+            username='slowreader',
+            email='slowreader@example.com',
+            password='slowpass123',
+            first_name='Slow',
+            last_name='Reader',
+            user_type='student'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.sent = []
+        self.overflows = 0
+    
+    async def record(self, frame):
+        self.sent.append(frame)
+    
+    async def on_overflow(self):
+        self.overflows += 1
+    
+    async def drain(self, queue):
+        while queue.depth:
+            await asyncio.sleep(0)
+        queue.stop()
+    
+    async def test_messages_go_first_and_typing_coalesces(self):
+        """Test that high-priority frames overtake queued typing, which keeps only its latest state"""
+        queue = OutboundQueue(self.record, self.on_overflow, max_messages=10, max_bytes=10000)
+        queue.put('typing-on', LOW, 'typing:1:2')
+        queue.put('typing-off', LOW, 'typing:1:2')
+        queue.put('message', HIGH)
+        queue.start()
+        await self.drain(queue)
+        self.assertEqual(self.sent, ['message', 'typing-off'])
+    
+    async def test_droppable_frames_give_way_under_pressure(self):
+        """Test that typing and presence are evicted or dropped before messages"""
+        dropped = outbound_stats.dropped
+        queue = OutboundQueue(self.record, self.on_overflow, max_messages=3, max_bytes=10000)
+        queue.put('presence', LOW, 'presence')
+        queue.put('typing', LOW, 'typing:1:2')
+        queue.put('message-1', HIGH)
+        queue.put('message-2', HIGH)
+        self.assertFalse(queue.put('typing-late', LOW, 'typing:1:3'))
+        queue.start()
+        await self.drain(queue)
+        
+        self.assertEqual(self.sent, ['message-1', 'message-2', 'typing'])
+        self.assertEqual(outbound_stats.dropped - dropped, 2)
+        self.assertEqual(self.overflows, 0)
+    
+    async def test_backlog_over_cap_triggers_overflow(self):
+        """Test that a high-priority backlog past twice the cap hands the connection to on_overflow"""
+        queue = OutboundQueue(self.record, self.on_overflow, max_messages=2, max_bytes=10000, overflow_grace=60)
+        for i in range(5):
+            queue.put(f"message-{i}", HIGH)
+        await asyncio.sleep(0)
+        self.assertEqual(self.overflows, 1)
+        self.assertFalse(queue.put('message-late', HIGH))
+        self.assertEqual(outbound_stats.snapshot()['over_cap'], 1)
+        queue.stop()
+    
+    async def test_read_markers_coalesce_but_are_never_dropped(self):
+        """Test that a read marker over the cap is queued, keeping only its newest value"""
+        dropped = outbound_stats.dropped
+        queue = OutboundQueue(self.record, self.on_overflow, max_messages=2, max_bytes=10000, overflow_grace=60)
+        queue.put('message-1', HIGH)
+        queue.put('message-2', HIGH)
+        self.assertTrue(queue.put('read-5', frame_priority('read_up_to'), 'read_up_to:1:2'))
+        self.assertTrue(queue.put('read-7', frame_priority('read_up_to'), 'read_up_to:1:2'))
+        queue.start()
+        await self.drain(queue)
+        
+        self.assertEqual(self.sent, ['message-1', 'message-2', 'read-7'])
+        self.assertEqual(outbound_stats.dropped, dropped)
+        self.assertEqual(self.overflows, 0)
+    
+    async def test_backlog_over_cap_is_closed_after_grace_without_more_frames(self):
+        """Test that the grace period runs out on a timer when nothing else is sent"""
+        queue = OutboundQueue(self.record, self.on_overflow, max_messages=1, max_bytes=10000, overflow_grace=0.05)
+        queue.put('message-1', HIGH)
+        queue.put('message-2', HIGH)
+        self.assertEqual(self.overflows, 0)
+        
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.overflows, 1)
+        queue.stop()
+    
+    @override_settings(CHAT_OUTBOUND_MAX_MESSAGES=2, CHAT_OUTBOUND_OVERFLOW_GRACE=0)
+    async def test_slow_consumer_is_closed(self):
+        """Test that a client that stops reading is closed with the slow-consumer code"""
+        stalled = asyncio.Event()
+        
+        async def never_writes(consumer, frame):
+            await stalled.wait()
+        
+        with patch.object(ChatConsumer, 'write_frame', never_writes):
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            
+            layer = get_channel_layer()
+            event = ChatConsumer.frame_event('message', {'content': 'hello'})
+            for _ in range(4):
+                await layer.group_send(user_group_name(self.user.id), event)
+            
+            output = await communicator.receive_output(timeout=2)
+            self.assertEqual(output, {'type': 'websocket.close', 'code': CLOSE_SLOW_CONSUMER})
+            # Released on close, before the client completes the close handshake
+            self.assertEqual(await get_presence_backend().aonline([self.user.id]), set())
+            await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_WIRE_MSGPACK=True)
+class WireFormatTests(TestCase):
+    """Test cases for the negotiated MessagePack subprotocol"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.packer = User.objects.create_user(
+            username='msgpackclient',
+            email='msgpackclient@example.com',
+            password='packerpass123',
+            first_name='Packed',
+            last_name='Client',
+            user_type='student'
+        )
+        self.legacy = User.objects.create_user(
+            username='jsonclient',
+            email='jsonclient@example.com',
+            password='legacypass123',
+            first_name='Json',
+            last_name='Client',
+            user_type='alumni'
+        )
+        self.packer_token = str(RefreshToken.for_user(self.packer).access_token)
+        self.legacy_token = str(RefreshToken.for_user(self.legacy).access_token)
+    
+    def test_short_keys_round_trip(self):
+        """Test that the msgpack codec shortens known keys and restores them"""
+        codec = MsgpackCodec()
+        frame = {'type': 'message', 'data': {'content': 'hi', 'sender': {'id': 1, 'name': 'A'}, 'extra': [{'seq': 2}]}}
+        packed = codec.encode(frame)
+        self.assertEqual(msgpack.unpackb(packed)['d']['s'], {'id': 1, 'n': 'A'})
+        self.assertLess(len(packed), len(JsonCodec().encode(frame)))
+        self.assertEqual(rename_keys(msgpack.unpackb(packed), LONG_KEYS), frame)
+    
+    def test_negotiation_defaults_to_json(self):
+        """Test that only clients offering the msgpack subprotocol get it"""
+        self.assertIsInstance(negotiate_codec([]), JsonCodec)
+        self.assertIsNone(negotiate_codec(['unknown']).subprotocol)
+        self.assertIsInstance(negotiate_codec(['unknown', MSGPACK_SUBPROTOCOL]), MsgpackCodec)
+        self.assertIn('packed', encode_event({'type': 'message'}))
+        with override_settings(CHAT_WIRE_MSGPACK=False):
+            self.assertIsInstance(negotiate_codec([MSGPACK_SUBPROTOCOL]), JsonCodec)
+            # Nobody can have negotiated msgpack, so broadcasts are encoded once
+            self.assertEqual(set(encode_event({'type': 'message'})), {'text'})
+    
+    async def test_msgpack_and_json_clients_share_a_room(self):
+        """Test that each side of a conversation receives the message in its own encoding"""
+        packer = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f"/ws/chat/?token={self.packer_token}", subprotocols=[MSGPACK_SUBPROTOCOL]
+        )
+        legacy = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.legacy_token}")
+        connected, subprotocol = await packer.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        await legacy.connect()
+        
+        await packer.send_to(bytes_data=msgpack.packb({'t': 'message', 'to': self.legacy.id, 'c': 'Hello'}))
+        
+        packed = msgpack.unpackb(await packer.receive_from(), strict_map_key=False)
+        self.assertEqual(packed['t'], 'message')
+        self.assertEqual(packed['d']['c'], 'Hello')
+        self.assertEqual(packed['d']['s']['id'], self.packer.id)
+        
+        plain = await legacy.receive_json_from()
+        self.assertEqual(plain['data']['content'], 'Hello')
+        self.assertEqual(plain['data']['id'], packed['d']['id'])
+        
+        await packer.send_to(bytes_data=b'\xc1')
+        error = msgpack.unpackb(await packer.receive_from())
+        self.assertEqual(error, {'t': 'error', 'm': 'Invalid MessagePack'})
+        
+        await packer.disconnect()
+        await legacy.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class BatchFrameTests(TestCase):
+    """Test cases for batched multi-operation frames"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.user = User.objects.create_user(
+            username='batchsender',
+            email='batchsender@example.com',
+            password='senderpass123',
+            first_name='Batch',
+            last_name='Sender',
+            user_type='student'
+        )
+        self.peer = User.objects.create_user(
+            username='batchpeer',
+            email='batchpeer@example.com',
+            password='peerpass123',
+            first_name='Batch',
+            last_name='Peer',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        self.peer_token = str(RefreshToken.for_user(self.peer).access_token)
+        self.room = ChatRoom.get_or_create_direct(self.user.id, self.peer.id)
+        self.incoming = [
+            ChatMessage.objects.create(room=self.room, sender=self.peer, content=f'Offline {i}')
+            for i in range(3)
+        ]
+    
+    async def receive_types(self, communicator, count):
+        frames = {}
+        for _ in range(count):
+            frame = await communicator.receive_json_from()
+            frames[frame['type']] = frame
+        self.assertTrue(await communicator.receive_nothing())
+        return frames
+    
+    async def test_backlog_is_applied_with_one_ack(self):
+        """Test that receipts, messages and typing in one batch are applied and acknowledged together"""
+        sender = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        peer = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.peer_token}")
+        await sender.connect()
+        await peer.connect()
+        
+        await sender.send_json_to({'type': 'batch', 'id': 'b1', 'ops': [
+            {'type': 'read_receipt', 'message_id': self.incoming[0].id},
+            {'type': 'read_receipt', 'message_id': self.incoming[2].id},
+            {'type': 'message', 'to_user': self.peer.id, 'content': 'Back online', 'client_msg_id': 'm1'},
+            {'type': 'read_up_to', 'room_id': self.room.id, 'seq': 'latest'},
+            {'type': 'meeting_request', 'to_user': self.peer.id},
+            {'type': 'message', 'to_user': 999999, 'content': 'Nobody home'},
+            {'type': 'typing', 'to_user': self.peer.id, 'is_typing': False},
+        ]})
+        
+        frames = await self.receive_types(sender, 3)
+        ack = frames['batch_ack']['data']
+        self.assertEqual(ack['id'], 'b1')
+        self.assertEqual([result['ok'] for result in ack['results']], [True, True, True, False, False, False, True])
+        self.assertEqual(ack['results'][4]['error'], "Unsupported operation in batch")
+        self.assertEqual(ack['results'][5]['error'], "User not found")
+        self.assertTrue(ack['results'][2]['created'])
+        self.assertEqual(frames['message']['data']['content'], 'Back online')
+        # Two receipts for the room go out as one read_up_to with the highest seq
+        self.assertEqual(frames['read_up_to']['data']['seq'], self.incoming[2].seq)
+        
+        peer_frames = await self.receive_types(peer, 2)
+        self.assertEqual(peer_frames['message']['data']['id'], ack['results'][2]['id'])
+        self.assertEqual(peer_frames['read_up_to']['data']['seq'], self.incoming[2].seq)
+        
+        cursor = await database_sync_to_async(RoomReadCursor.objects.get)(room=self.room, user=self.user)
+        # Sending the message moved the sender's own cursor past it
+        self.assertEqual(cursor.last_read_seq, ack['results'][2]['seq'])
+        
+        await sender.disconnect()
+        await peer.disconnect()
+    
+    async def test_batch_validation(self):
+        """Test that malformed and oversized batches are rejected as a whole"""
+        sender = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        await sender.connect()
+        
+        await sender.send_json_to({'type': 'batch', 'ops': []})
+        self.assertEqual((await sender.receive_json_from())['type'], 'error')
+        
+        with override_settings(CHAT_BATCH_MAX_OPS=2):
+            await sender.send_json_to({'type': 'batch', 'ops': [{'type': 'typing', 'to_user': self.peer.id}] * 3})
+            self.assertEqual((await sender.receive_json_from())['message'], "batch is limited to 2 ops")
+        
+        await sender.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class RateLimitTests(TestCase):
+    """Test cases for token-bucket limits on client frames"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.user = User.objects.create_user(
+            username='ratelimited',
+            email='ratelimited@example.com',
+            password='limitedpass123',
+            first_name='Rate',
+            last_name='Limited',
+            user_type='student'
+        )
+        self.peer = User.objects.create_user(
+            username='ratelimitpeer',
+            email='ratelimitpeer@example.com',
+            password='peerpass123',
+            first_name='Rate',
+            last_name='Peer',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        patcher = patch('chat.ratelimit._backend', LocalRateLimitBackend())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_bucket_refills_over_time(self):
+        """Test burst, refusal with a retry hint, and refill"""
+        buckets = LocalRateLimitBackend()
+        self.assertEqual(buckets.take_now('k', 2, 1.0, now=0.0), 0)
+        self.assertEqual(buckets.take_now('k', 2, 1.0, now=0.0), 0)
+        self.assertAlmostEqual(buckets.take_now('k', 2, 1.0, now=0.25), 0.75)
+        self.assertEqual(buckets.take_now('k', 2, 1.0, now=1.0), 0)
+    
+    async def connect(self):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+    
+    async def send_messages(self, communicator, count):
+        frames = []
+        for i in range(count):
+            await communicator.send_json_to({'type': 'message', 'to_user': self.peer.id, 'content': f'Spam {i}'})
+            frames.append(await communicator.receive_json_from())
+        return frames
+    
+    @override_settings(CHAT_RATE_LIMITS={'message': {'connection': (2, 0.01)}})
+    async def test_connection_limit_rejects_before_writing(self):
+        """Test that a flood from one socket is refused without touching the database"""
+        communicator = await self.connect()
+        frames = await self.send_messages(communicator, 3)
+        
+        self.assertEqual([frame['type'] for frame in frames], ['message', 'message', 'error'])
+        self.assertEqual(frames[2]['code'], 'rate_limited')
+        self.assertEqual(frames[2]['frame_type'], 'message')
+        self.assertGreater(frames[2]['retry_after'], 0)
+        count = await database_sync_to_async(ChatMessage.objects.filter(sender=self.user).count)()
+        self.assertEqual(count, 2)
+        
+        await communicator.disconnect()
+    
+    @override_settings(CHAT_RATE_LIMITS={'message': {'connection': (10, 0.01), 'user': (3, 0.01)}})
+    async def test_user_limit_spans_connections(self):
+        """Test that a second tab shares the user's bucket"""
+        first, second = await self.connect(), await self.connect()
+        frames = await self.send_messages(first, 2)
+        await second.receive_json_from()
+        await second.receive_json_from()
+        frames += await self.send_messages(second, 2)
+        
+        self.assertEqual([frame['type'] for frame in frames], ['message', 'message', 'message', 'error'])
+        await first.disconnect()
+        await second.disconnect()
+    
+    @override_settings(CHAT_RATE_LIMITS={'batch': {'connection': (5, 1.0)}, 'read_up_to': {'connection': (3, 1.0)}})
+    async def test_batch_pays_per_operation(self):
+        """Test that batched operations are charged to their own frame types"""
+        communicator = await self.connect()
+        room = await database_sync_to_async(ChatRoom.get_or_create_direct)(self.user.id, self.peer.id)
+        op = {'type': 'read_up_to', 'room_id': room.id, 'seq': 0}
+        
+        await communicator.send_json_to({'type': 'batch', 'ops': [op] * 4})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['code'], 'rate_limited')
+        self.assertEqual(frame['limit'], 3)
+        
+        await communicator.send_json_to({'type': 'batch', 'ops': [op] * 3})
+        frames = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertEqual(sorted(frame['type'] for frame in frames), ['batch_ack', 'read_up_to'])
+        await communicator.send_json_to({'type': 'batch', 'ops': [op]})
+        self.assertEqual((await communicator.receive_json_from())['code'], 'rate_limited')
+        
+        await communicator.disconnect()
+    
+    @override_settings(CHAT_RATE_LIMITS={'batch': {'connection': (5, 0.01)}, 'typing': {'user': (2, 0.01)}})
+    async def test_refused_frame_refunds_earlier_buckets(self):
+        """Test that a frame a later bucket refuses takes nothing from the earlier ones"""
+        limiter = RateLimiter(self.user.id, backend=LocalRateLimitBackend())
+        ops = {'ops': [{'type': 'typing'}] * 2}
+        
+        self.assertEqual(await limiter.check('batch', ops), 0)
+        self.assertGreater(await limiter.check('batch', ops), 0)
+        self.assertGreater(await limiter.check('batch', ops), 0)
+        # Two batches were refused: the batch bucket still holds 4 tokens
+        self.assertEqual(limiter.connection_buckets.take_now('batch', 5, 0.01, cost=4), 0)
+    
+    @skipUnless(fakeredis and lupa, "fakeredis with Lua support is not installed")
+    async def test_redis_refund_restores_tokens(self):
+        """Test that refunded tokens can be taken again, up to the bucket's capacity"""
+        backend = RedisRateLimitBackend(async_client=fakeredis.aioredis.FakeRedis())
+        self.assertEqual(await backend.take('7:message', 2, 0.01, cost=2), 0)
+        await backend.refund('7:message', 2, cost=5)
+        self.assertEqual(await backend.take('7:message', 2, 0.01, cost=2), 0)
+        self.assertGreater(await backend.take('7:message', 2, 0.01), 0)
+    
+    async def test_redis_outage_warns_once(self):
+        """Test that an unreachable Redis falls back locally and warns once, not per frame"""
+        client = MagicMock()
+        client.register_script.return_value = AsyncMock(side_effect=ConnectionError('refused'))
+        backend = RedisRateLimitBackend(async_client=client)
+        
+        with self.assertLogs('chat.ratelimit', level='WARNING') as logs:
+            results = [await backend.take('7:message', 2, 0.01) for _ in range(3)]
+        self.assertEqual(results[:2], [0, 0])
+        self.assertGreater(results[2], 0)
+        self.assertEqual(len(logs.output), 1)
+    
+    @skipUnless(fakeredis and lupa, "fakeredis with Lua support is not installed")
+    async def test_redis_buckets_are_shared_between_nodes(self):
+        """Test that two nodes draw from the same per-user bucket in Redis"""
+        server = fakeredis.FakeServer()
+        nodes = [
+            RedisRateLimitBackend(async_client=fakeredis.aioredis.FakeRedis(server=server))
+            for _ in range(2)
+        ]
+        self.assertEqual(await nodes[0].take('7:message', 2, 0.01), 0)
+        self.assertEqual(await nodes[1].take('7:message', 2, 0.01), 0)
+        self.assertGreater(await nodes[0].take('7:message', 2, 0.01), 0)
+        self.assertEqual(await nodes[1].take('8:message', 2, 0.01), 0)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MetricsTests(TestCase):
+    """Test cases for the WebSocket Prometheus instrumentation"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.user = User.objects.create_user(
+            username='metricssender',
+            email='metricssender@example.com',
+            password='senderpass123',
+            first_name='Metrics',
+            last_name='Sender',
+            user_type='student'
+        )
+        self.peer = User.objects.create_user(
+            username='metricspeer',
+            email='metricspeer@example.com',
+            password='peerpass123',
+            first_name='Metrics',
+            last_name='Peer',
+            user_type='alumni'
+        )
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+    
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+    
+    async def test_frames_are_timed_and_counted(self):
+        """Test connection, frame latency, query count and group_send metrics for one message"""
+        connections = self.sample('chat_ws_connections')
+        frames = self.sample('chat_ws_frame_seconds_count', frame_type='message')
+        queries = self.sample('chat_ws_frame_db_queries_sum', frame_type='message')
+        sends = self.sample('chat_group_send_seconds_count', target='user')
+        
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.token}")
+        await communicator.connect()
+        self.assertEqual(self.sample('chat_ws_connections'), connections + 1)
+        
+        await communicator.send_json_to({'type': 'message', 'to_user': self.peer.id, 'content': 'Counted'})
+        await communicator.receive_json_from()
+        
+        self.assertEqual(self.sample('chat_ws_frame_seconds_count', frame_type='message'), frames + 1)
+        # Room lookup and the message insert run in one database thread hop
+        self.assertGreaterEqual(self.sample('chat_ws_frame_db_queries_sum', frame_type='message'), queries + 2)
+        self.assertEqual(self.sample('chat_group_send_seconds_count', target='user'), sends + 2)
+        
+        await communicator.disconnect()
+        self.assertEqual(self.sample('chat_ws_connections'), connections)
+    
+    async def test_auth_failures_by_reason(self):
+        """Test that rejected connections are counted by reason"""
+        missing = self.sample('chat_ws_auth_failures_total', reason='missing_token')
+        invalid = self.sample('chat_ws_auth_failures_total', reason='invalid_token')
+        
+        for path in ("/ws/chat/", "/ws/chat/?token=not-a-jwt"):
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), path)
+            connected, code = await communicator.connect()
+            self.assertFalse(connected)
+            self.assertEqual(code, 4001)
+        
+        self.assertEqual(self.sample('chat_ws_auth_failures_total', reason='missing_token'), missing + 1)
+        self.assertEqual(self.sample('chat_ws_auth_failures_total', reason='invalid_token'), invalid + 1)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DatabaseUnitTests(TestCase):
+    """Test cases for running each frame's database work as one unit"""
+    
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import RefreshToken
+        self.requester = User.objects.create_user(
+            username='unitrequester',
+            email='unitrequester@example.com',
+            password='requesterpass123',
+            first_name='Unit',
+            last_name='Requester',
+            user_type='student'
+        )
+        self.recipient = User.objects.create_user(
+            username='unitrecipient',
+            email='unitrecipient@example.com',
+            password='recipientpass123',
+            first_name='Unit',
+            last_name='Recipient',
+            user_type='alumni'
+        )
+        self.requester_token = str(RefreshToken.for_user(self.requester).access_token)
+        self.recipient_token = str(RefreshToken.for_user(self.recipient).access_token)
+    
+    async def test_meeting_frames_take_one_database_hop(self):
+        """Test that a meeting request and its approval each run their database work in a single hop"""
+        requester = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.requester_token}")
+        recipient = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/?token={self.recipient_token}")
+        await requester.connect()
+        await recipient.connect()
+        
+        with patch('chat.db.database_sync_to_async', wraps=database_sync_to_async) as hops:
+            await requester.send_json_to({
+                'type': 'meeting_request',
+                'to_user': self.recipient.id,
+                'datetime': '2030-01-15T14:00:00Z',
+                'topic': 'Career Discussion'
+            })
+            request = await recipient.receive_json_from()
+            await requester.receive_json_from()
+            self.assertEqual(hops.call_count, 1)
+            
+            await recipient.send_json_to({
+                'type': 'meeting_approval',
+                'meeting_id': request['data']['meeting_request']['id'],
+                'status': 'approved'
+            })
+            response = await requester.receive_json_from()
+            await recipient.receive_json_from()
+            self.assertEqual(hops.call_count, 2)
+        
+        self.assertEqual(response['type'], 'meeting_response')
+        self.assertEqual(response['data']['meeting_request']['status'], 'approved')
+        self.assertEqual(response['data']['message']['message_type'], 'meeting_approved')
+        
+        await requester.disconnect()
+        await recipient.disconnect()
+    
+    async def test_units_run_on_the_chat_pool_when_configured(self):
+        """Test that CHAT_DB_THREADS moves database units off Django's thread-sensitive thread"""
+        def thread_name():
+            return threading.current_thread().name
+        
+        self.assertFalse((await run_database_unit(thread_name)).startswith('chat-db'))
+        with override_settings(CHAT_DB_THREADS=2):
+            self.assertTrue((await run_database_unit(thread_name)).startswith('chat-db'))
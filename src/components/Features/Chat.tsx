@@ -101,8 +101,8 @@ export function Chat({ currentUser }: ChatProps) {
 
   const fetchMessages = async (roomId: number) => {
     try {
-      const data = await apiClient.get<ChatMessage[]>(`/chat/rooms/${roomId}/messages/`);
-      setMessages(data);
+      const data = await apiClient.get<{ results: ChatMessage[] }>(`/chat/rooms/${roomId}/history/`);
+      setMessages(data.results);
     } catch (error) {
       console.error('Failed to fetch messages:', error);
     }
@@ -44,6 +44,8 @@ class WebSocketService {
   private reconnectDelay = 1000;
   private messageHandlers: Map<string, ((data: any) => void)[]> = new Map();
   private isConnected = false;
+  // Highest message seq seen per room, sent in a sync frame on reconnect
+  private lastSeqs: Map<number, number> = new Map();
 
   connect(): Promise<void> {
     return new Promise((resolve, reject) => {
@@ -61,6 +63,7 @@ class WebSocketService {
           console.log('WebSocket connected');
           this.isConnected = true;
           this.reconnectAttempts = 0;
+          this.sync();
           resolve();
         };
 
@@ -103,10 +106,34 @@ class WebSocketService {
   }
 
   private handleMessage(data: any): void {
+    if (data.type === 'message' && data.data) {
+      this.trackSeq(data.data.room_id, data.data.seq);
+    } else if (data.type === 'sync' && data.data) {
+      data.data.messages.forEach((message: any) => this.trackSeq(data.data.room_id, message.seq));
+    }
     const handlers = this.messageHandlers.get(data.type) || [];
     handlers.forEach(handler => handler(data));
   }
 
+  private trackSeq(roomId: number, seq: number): void {
+    if (roomId && seq && seq > (this.lastSeqs.get(roomId) || 0)) {
+      this.lastSeqs.set(roomId, seq);
+    }
+  }
+
+  // Ask the server for messages missed while disconnected; the reply is
+  // 'sync' frames followed by 'sync_complete'
+  sync(): void {
+    if (!this.isConnected || !this.ws || this.lastSeqs.size === 0) {
+      return;
+    }
+
+    this.ws.send(JSON.stringify({
+      type: 'sync',
+      rooms: Object.fromEntries(this.lastSeqs),
+    }));
+  }
+
   on(event: string, handler: (data: any) => void): void {
     if (!this.messageHandlers.has(event)) {
       this.messageHandlers.set(event, []);